@@ -1,23 +1,32 @@
+import functools
 import gc
+import hashlib
+import importlib
+import inspect
 import itertools
+import json
 import logging
+import multiprocessing
 import os
+import pickle
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import tracemalloc
+import types
 from abc import abstractmethod, ABCMeta, ABC
-from multiprocessing.pool import Pool
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from time import perf_counter
+from time import perf_counter, process_time
 from typing import Union
 
-import keras
-import lightgbm as lgb
 import numpy as np
 import pandas as pd
-import pandas.tseries.offsets as offsets
-import torch
-from keras.callbacks import EarlyStopping, ModelCheckpoint
-from keras.utils import Sequence
 from scipy import sparse
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.compose import ColumnTransformer
@@ -26,12 +35,10 @@ from sklearn.impute import SimpleImputer
 from sklearn.metrics import roc_auc_score
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import FunctionTransformer, StandardScaler, OneHotEncoder
-from torch import nn, optim
-from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.dataloader import default_collate
-from tqdm import tqdm
 
 NEXT_MKTRES_10 = "returnsOpenNextMktres10"
+# market days covered by the target, which are the gap between training rows and validation rows
+TARGET_HORIZON_DAYS = 10
 
 CATEGORY_START_END_PATTERN = r"[\{\}\']"
 
@@ -41,6 +48,48 @@ logger = logging.getLogger(__name__)
 # logger.addHandler(logging.StreamHandler(sys.stdout))
 # logger.addHandler(logging.FileHandler("main.log"))
 
+
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LazyModule(object):
+    """
+    proxy of a module which is imported on the first attribute access.
+    import time and RSS growth of each import are kept in import_profile.
+    """
+    import_profile = []
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            start, start_rss = perf_counter(), get_rss_bytes()
+            self._module = importlib.import_module(self._name)
+            duration, rss = perf_counter() - start, get_rss_bytes() - start_rss
+            LazyModule.import_profile.append((self._name, duration, rss))
+            logger.info("importing %s took %.3f sec and %.1f MB", self._name, duration, rss / 1e6)
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self.load(), item)
+
+
+# heavy dependencies are imported only by the model backend in use
+lgb = LazyModule("lightgbm")
+keras = LazyModule("keras")
+torch = LazyModule("torch")
+nn = LazyModule("torch.nn")
+optim = LazyModule("torch.optim")
+tqdm = LazyModule("tqdm")
+
 try:
     TEST_MARKET_DATA = Path(__file__).parent.joinpath("data/test/marketdata_sample.csv")
     TEST_NEWS_DATA = Path(__file__).parent.joinpath("data/test/news_sample.csv")
@@ -48,6 +97,16 @@ except NameError as e:
     TEST_MARKET_DATA = "data/test/marketdata_sample.csv"
     TEST_NEWS_DATA = "data/test/news_sample.csv"
 
+FEATURE_STORE_DIR = Path("feature_store")
+# binary lgb.Dataset files of LgbWrapper, None disables the cache
+LGB_DATASET_DIR = Path("lgb_dataset")
+# table of the trials of LgbSearch
+LGB_SEARCH_RESULTS = Path("lgb_search_results.csv")
+# seconds between background memory reports, None disables them
+MEMORY_REPORT_INTERVAL = None
+# trace python allocations so that PROFILER records the tracemalloc peak of each stage (slows allocations down)
+TRACE_MALLOC = False
+
 # MODEL_TYPE = "mlp"
 # MODEL_TYPE = "lgb"
 MODEL_TYPE = "sparse_mlp"
@@ -71,10 +130,36 @@ class FeatureSetting(object):
     # since = date(2010, 1, 1)
     since = None
     should_use_prev_news = False
+    should_collapse_news_takes = True
+    keep_take_count = True
+    should_prune_non_universe = True
+    # [(start, end), ...] of market dates which are not used for training
+    drop_date_ranges = []
+    should_bin_features = True
+    n_feature_bins = 200
+    use_feature_store = False
+    # bytes of a projected join output in the linker, None for no limit
+    link_memory_budget = None
+    # "chunk" splits a join over the budget into chunks of the left rows which are filtered one by one, "raise" refuses
+    # it. joins without a row filter are refused in both cases because their chunks add up to the same output
+    link_over_budget = "chunk"
+    # bytes of the market and news rows linked at once, None for linking the whole history at once
+    link_chunk_memory_budget = None
+    # directory where the linked date chunks are kept until all chunks are done, None for keeping them in memory
+    link_spill_dir = None
+    # prediction days between incremental updates of the model on the newly labelled rows, None for the frozen model
+    update_every_days = None
+    # seconds which an incremental update may take
+    update_time_budget = 5.0
+    # newest labelled rows kept for the incremental updates
+    update_buffer_rows = 200000
 
 
 def main():
     logger.info("This model type is {}".format(MODEL_TYPE))
+    limit_threads(RESOURCES.n_cores)
+    if TRACE_MALLOC:
+        PROFILER.enable_trace_malloc()
     # You can only call make_env() once, so don't lose it!
     env, market_train_df, news_train_df = load_train_dfs()
 
@@ -84,43 +169,74 @@ def main():
     #         n_empty = (news_train_df[col] == "").sum()
     #         logger.info("empty value in {}: {}".format(col, n_empty))
 
-    market_preprocess = MarketPreprocess()
-    market_train_df = market_preprocess.fit_transform(market_train_df)
-    news_preprocess = NewsPreprocess()
-    news_train_df = news_preprocess.fit_transform(news_train_df)
-
-    features = Features()
-    market_train_df, news_train_df = features.fit_transform(market_train_df, news_train_df)
-    logger.info("First feature extraction has done")
-
     max_day_diff = 3
-    gc.collect()
+    state = {"market_df": market_train_df, "news_df": news_train_df,
+             "market_preprocess": MarketPreprocess(), "news_preprocess": NewsPreprocess(),
+             "features": Features(),
+             "linker": MarketNewsLinker(max_day_diff) if FeatureSetting.should_use_news_feature else None}
+    del market_train_df
+    del news_train_df
+
+    def preprocess(state):
+        state["market_df"] = state["market_preprocess"].fit_transform(state["market_df"])
+        state["news_df"] = state["news_preprocess"].fit_transform(state["news_df"])
+        return state
+
+    def extract_features(state):
+        state["market_df"], state["news_df"] = state["features"].fit_transform(state["market_df"], state["news_df"])
+        logger.info("First feature extraction has done")
+        gc.collect()
+        return state
 
     # In[ ]:
-    if FeatureSetting.should_use_news_feature:
-        linker = MarketNewsLinker(max_day_diff)
-        linker.link(market_train_df, news_train_df)
-        del news_train_df
-        del market_train_df
+    def link(state):
+        # the targets only give the validation score, so they are taken before they are fanned out with the news.
+        # the linked rows are in the order of the market ids, in which pop_metric takes the validation rows
+        state["valid_metric"] = ModelWrapper.pop_metric(state["market_df"], train_size=0.8)
+        linker = state["linker"]
+        # the date shards are linked in a process per core of RESOURCES
+        linker.link(state["market_df"], state["news_df"], pool=None)
+        state["market_df"] = None
+        state["news_df"] = None
         gc.collect()
-        market_train_df = linker.create_new_market_df()
+        state["market_df"] = linker.create_new_market_df()
         linker.clear()
         gc.collect()
-    else:
-        linker = None
+        return state
 
-        # In[ ]:
-        #
-        # from collections import OrderedDict
+    stages = [("preprocess", [state["market_preprocess"], state["news_preprocess"]], preprocess),
+              ("features", state["features"], extract_features)]
+    if FeatureSetting.should_use_news_feature:
+        stages.append(("link", state["linker"], link))
+
+    memory_inspector = MemoryInspector(state=state)
+    if MEMORY_REPORT_INTERVAL:
+        memory_inspector.start(MEMORY_REPORT_INTERVAL)
+
+    feature_store = FeatureStore(FEATURE_STORE_DIR, enabled=FeatureSetting.use_feature_store)
+    state = feature_store.run(stages, state, [state["market_df"], state["news_df"]])
+    market_train_df = state["market_df"]
+    market_preprocess, news_preprocess = state["market_preprocess"], state["news_preprocess"]
+    features, linker = state["features"], state["linker"]
+    valid_metric = state.get("valid_metric")
+    memory_inspector.remove("state").add("features", features).add("linker", linker)
+    del state
+    gc.collect()
 
-        # # feature extraction II and dimension reduction
+    # In[ ]:
+    #
+    # from collections import OrderedDict
 
-        # In[ ]:
+    # # feature extraction II and dimension reduction
+
+    # In[ ]:
     # feature_matrix = features.get_linked_feature_matrix(market_train_df)
     # features.clear()
     # gc.collect()
 
     model = ModelWrapper.generate(MODEL_TYPE)
+    model.valid_metric = valid_metric
+    memory_inspector.add("model", model)
 
     # In[ ]:
     # logger.info("dtypes before train:")
@@ -132,6 +248,7 @@ def main():
     market_train_df, _ = model.create_dataset(market_train_df, features, train_batch_size=1024,
                                               valid_batch_size=1024)
     gc.collect()
+    memory_inspector.report("before training")
     model.train(sparse_input=True)
     model.clear()
 
@@ -144,6 +261,11 @@ def main():
     # In[ ]:
 
     logger.info('Done!')
+    memory_inspector.stop()
+    RESOURCES.log_layout()
+    PROFILER.log_summary()
+    PROFILER.export("profile_trace.json")
+    PROFILER.export_folded("profile_trace.folded")
 
     # In[ ]:
 
@@ -152,35 +274,448 @@ def main():
     logger.info([filename for filename in os.listdir('.') if '.csv' in filename])
 
 
+def shapes_of(objs):
+    if not isinstance(objs, (list, tuple)):
+        objs = [objs]
+    return [list(obj.shape) for obj in objs if isinstance(getattr(obj, "shape", None), tuple)]
+
+
+class StageProfiler(object):
+    """
+    hierarchical profiler of pipeline stages.
+    each stage records wall time, cpu time, RSS delta, tracemalloc peak (while tracemalloc is tracing)
+    and the shapes of its inputs and outputs. a stage opened inside another stage becomes its child.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.root = None
+        self.reset()
+
+    def reset(self):
+        self.root = self._new_record("run")
+        self._local = threading.local()
+
+    @staticmethod
+    def _new_record(name):
+        return {"name": name, "start": perf_counter(), "thread": threading.get_ident(),
+                "wall": None, "cpu": None, "rss_delta": None, "peak_malloc": None, "peak_malloc_delta": None,
+                "inputs": [], "outputs": [], "children": []}
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = [self.root]
+        return stack
+
+    @staticmethod
+    def enable_trace_malloc():
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, inputs=()):
+        record = self._new_record(name)
+        record["inputs"] = shapes_of(inputs)
+        stack = self._stack()
+        with self._lock:
+            stack[-1]["children"].append(record)
+        stack.append(record)
+
+        cpu_start, rss_start = process_time(), get_rss_bytes()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            malloc_start = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        try:
+            yield record
+        finally:
+            record["wall"] = perf_counter() - record["start"]
+            record["cpu"] = process_time() - cpu_start
+            record["rss_delta"] = get_rss_bytes() - rss_start
+            if tracing and tracemalloc.is_tracing():
+                # reset_peak in children hides the earlier peak of this stage
+                peak = max([tracemalloc.get_traced_memory()[1]] +
+                           [child["peak_malloc"] for child in record["children"] if child["peak_malloc"] is not None])
+                record["peak_malloc"] = peak
+                record["peak_malloc_delta"] = peak - malloc_start
+            stack.pop()
+
+    def _iter_records(self, record=None, path=()):
+        record = record or self.root
+        path = path + (record["name"],)
+        yield path, record
+        for child in record["children"]:
+            yield from self._iter_records(child, path)
+
+    def export(self, path):
+        """
+        write the stages in the chrome trace event format (chrome://tracing, perfetto, speedscope).
+        """
+        events = []
+        for _, record in self._iter_records():
+            wall = record["wall"] if record["wall"] is not None else perf_counter() - record["start"]
+            events.append({"name": record["name"], "ph": "X", "pid": os.getpid(), "tid": record["thread"],
+                           "ts": (record["start"] - self.root["start"]) * 1e6, "dur": wall * 1e6,
+                           "args": {key: record[key] for key in ["cpu", "rss_delta", "peak_malloc_delta",
+                                                                 "inputs", "outputs"]}})
+        with open(str(path), "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def export_folded(self, path):
+        """
+        write the self wall time (microseconds) of each stage path in the folded format of flamegraph.pl.
+        """
+        with open(str(path), "w") as f:
+            for stage_path, record in self._iter_records():
+                if record["wall"] is None:
+                    continue
+                self_time = record["wall"] - sum(child["wall"] or 0 for child in record["children"])
+                f.write("{} {}\n".format(";".join(stage_path), max(int(self_time * 1e6), 0)))
+
+    def log_summary(self):
+        for stage_path, record in self._iter_records():
+            if record["wall"] is None:
+                continue
+            logger.info("%s%s: %.3f sec (cpu %.3f sec), rss %+.1f MB, peak %s, %s -> %s",
+                        "  " * (len(stage_path) - 2), record["name"], record["wall"], record["cpu"],
+                        record["rss_delta"] / 1e6,
+                        "-" if record["peak_malloc_delta"] is None else "%.1f MB" % (
+                                record["peak_malloc_delta"] / 1e6),
+                        record["inputs"], record["outputs"])
+
+
+PROFILER = StageProfiler()
+
+
+def limit_threads(n_threads):
+    """
+    limit the threads of the native libraries of this process, and make n_threads the cpu budget of the process.
+    used as the initializer of the pool workers.
+    """
+    n_threads = max(int(n_threads), 1)
+    for name in ExecutionResources.THREAD_ENV_VARS:
+        os.environ[name] = str(n_threads)
+    try:
+        import threadpoolctl
+        threadpoolctl.threadpool_limits(n_threads)
+    except ImportError:
+        pass
+    if torch._module is not None:
+        torch.set_num_threads(n_threads)
+    RESOURCES.n_cores = n_threads
+
+
+class ExecutionResources(object):
+    """
+    cpu budget of the stages. a stage gets processes or threads within the cores, and the pool workers of a stage
+    limit the OpenMP/BLAS/torch threads to their share of the cores, so that processes x threads never exceed them.
+    """
+    # libraries loaded after these are set, like lightgbm and torch, start with the limited threads
+    THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                       "VECLIB_MAXIMUM_THREADS"]
+
+    def __init__(self, n_cores=None):
+        self.n_cores = self.detect_cores() if n_cores is None else n_cores
+        self.layout = {}
+
+    @staticmethod
+    def detect_cores():
+        """
+        cores available to this process, which is less than os.cpu_count() under cpu affinity or a cgroup cpu quota.
+        """
+        try:
+            n_cores = len(os.sched_getaffinity(0))
+        except AttributeError:
+            n_cores = os.cpu_count() or 1
+        # cgroup v2 keeps "quota period" in one file and v1 in two
+        cgroup_files = [("/sys/fs/cgroup/cpu.max", None),
+                        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")]
+        for quota_path, period_path in cgroup_files:
+            try:
+                with open(quota_path) as f:
+                    values = f.read().split()
+                if period_path is not None:
+                    with open(period_path) as f:
+                        values.append(f.read().strip())
+            except OSError:
+                continue
+            if values[0] not in ("max", "-1"):
+                n_cores = min(n_cores, max(int(int(values[0]) / int(values[1])), 1))
+            break
+        return n_cores
+
+    def processes(self, stage, requested=None):
+        """
+        :param requested: processes wanted by the stage, None for one process per core
+        :return: number of processes of the stage
+        """
+        n_processes = max(min(requested or self.n_cores, self.n_cores), 1)
+        self.layout[stage] = {"processes": n_processes, "threads": max(self.n_cores // n_processes, 1)}
+        return n_processes
+
+    def threads(self, stage, requested=None):
+        """
+        :return: number of threads of the stage running in this process
+        """
+        n_threads = max(min(requested or self.n_cores, self.n_cores), 1)
+        self.layout[stage] = {"processes": 1, "threads": n_threads}
+        return n_threads
+
+    def process_pool(self, stage, requested=None, fork=False):
+        """
+        :param fork: start the workers by fork, which the workers reading inputs from the module globals of this
+        process need. the inputs are then shared copy-on-write instead of pickled to each worker.
+        """
+        n_processes = self.processes(stage, requested)
+        if not fork:
+            return Pool(n_processes, initializer=limit_threads, initargs=(self.layout[stage]["threads"],))
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("{} needs the fork start method, which this platform does not have".format(stage))
+        return multiprocessing.get_context("fork").Pool(n_processes, initializer=limit_threads,
+                                                        initargs=(self.layout[stage]["threads"],))
+
+    def log_layout(self):
+        logger.info("%d cores", self.n_cores)
+        for stage, layout in self.layout.items():
+            logger.info("%s: %d processes x %d threads", stage, layout["processes"], layout["threads"])
+
+
+RESOURCES = ExecutionResources()
+
+
 def measure_time(func):
+    @functools.wraps(func)
     def inner(*args, **kwargs):
-        start = perf_counter()
-        result = func(*args, **kwargs)
-        duration = perf_counter() - start
-        logger.info("%s took %.6f sec", func.__name__, duration)
+        with PROFILER.stage(func.__qualname__, inputs=args) as record:
+            result = func(*args, **kwargs)
+            record["outputs"] = shapes_of(result)
+        logger.info("%s took %.6f sec (cpu %.6f sec, rss %+.1f MB)", func.__qualname__, record["wall"],
+                    record["cpu"], record["rss_delta"] / 1e6)
         return result
 
     return inner
 
 
+class FeatureStore(object):
+    """
+    content addressed store of pipeline stage outputs.
+    the key of each stage is the hash of the previous key, FeatureSetting values and the stage parameters,
+    and the first key is the hash of the input data. run reloads the longest cached prefix of the stages
+    and computes only the rest.
+    """
+    # FeatureSetting values which change how the stages run or what happens after them, but not their outputs
+    RUNTIME_SETTINGS = ["use_feature_store", "link_memory_budget", "link_over_budget", "link_chunk_memory_budget",
+                        "link_spill_dir", "update_every_days", "update_time_budget", "update_buffer_rows"]
+
+    def __init__(self, root=FEATURE_STORE_DIR, enabled=True):
+        self.root = Path(root)
+        self.enabled = enabled
+        if self.enabled:
+            self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def hash_dfs(dfs):
+        md5 = hashlib.md5()
+        for df in dfs:
+            md5.update(str(df.columns.tolist()).encode("utf-8"))
+            md5.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        return md5.hexdigest()
+
+    @staticmethod
+    def hash_arrays(arrays):
+        md5 = hashlib.md5()
+        for array in arrays:
+            if sparse.issparse(array):
+                array = array.tocsr()
+                parts = [array.data, array.indices, array.indptr]
+            else:
+                parts = [np.ascontiguousarray(array)]
+            md5.update(repr((array.shape, str(array.dtype))).encode("utf-8"))
+            for part in parts:
+                md5.update(np.ascontiguousarray(part).view(np.uint8).data)
+        return md5.hexdigest()
+
+    @staticmethod
+    def describe(obj):
+        if isinstance(obj, BaseEstimator):
+            return type(obj).__name__, FeatureStore.describe(obj.get_params(deep=True))
+        if isinstance(obj, dict):
+            return sorted((str(key), FeatureStore.describe(value)) for key, value in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return [FeatureStore.describe(value) for value in obj]
+        if isinstance(obj, (str, int, float, bool, type(None))):
+            return repr(obj)
+        if callable(obj):
+            return getattr(obj, "__qualname__", type(obj).__name__)
+        if hasattr(obj, "__dict__"):
+            return type(obj).__name__, FeatureStore.describe(vars(obj))
+        return repr(obj)
+
+    @staticmethod
+    def setting_fingerprint():
+        return FeatureStore.describe({name: value for name, value in vars(FeatureSetting).items()
+                                      if not name.startswith("_") and name not in FeatureStore.RUNTIME_SETTINGS})
+
+    @staticmethod
+    def stage_key(parent_key, stage_name, params):
+        description = repr((parent_key, stage_name, FeatureStore.setting_fingerprint(), FeatureStore.describe(params)))
+        return hashlib.md5(description.encode("utf-8")).hexdigest()
+
+    def path(self, stage_name, key):
+        return self.root.joinpath("{}-{}.pickle".format(stage_name, key))
+
+    def save(self, stage_name, key, state):
+        path = self.path(stage_name, key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(str(tmp_path), "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.rename(path)
+        logger.info("stage %s is stored in %s", stage_name, path)
+
+    def load(self, stage_name, key):
+        path = self.path(stage_name, key)
+        logger.info("stage %s is loaded from %s", stage_name, path)
+        with open(str(path), "rb") as f:
+            return pickle.load(f)
+
+    def run(self, stages, state, input_dfs):
+        """
+        :param stages: list of (stage name, parameters, function from state to state)
+        :param state: initial state
+        :param input_dfs: data frames to fingerprint the input
+        """
+        if not self.enabled:
+            for stage_name, _, func in stages:
+                with PROFILER.stage(stage_name):
+                    state = func(state)
+            return state
+
+        keys = []
+        key = self.hash_dfs(input_dfs)
+        for stage_name, params, _ in stages:
+            key = self.stage_key(key, stage_name, params)
+            keys.append(key)
+
+        n_cached = 0
+        for i, (stage_name, _, _) in enumerate(stages):
+            if self.path(stage_name, keys[i]).exists():
+                n_cached = i + 1
+        if n_cached > 0:
+            state = self.load(stages[n_cached - 1][0], keys[n_cached - 1])
+
+        for (stage_name, _, func), key in zip(stages[n_cached:], keys[n_cached:]):
+            with PROFILER.stage(stage_name):
+                state = func(state)
+            self.save(stage_name, key, state)
+        return state
+
+
 class UnionFeaturePipeline(object):
+    """
+    run transformers as a dependency graph.
+    a transformer declares input_columns, output_columns and release_columns (see FeatureTransformer).
+    transformers are grouped into waves by their column dependencies, and the transformers in a wave
+    run in parallel threads on their own input columns. a transformer without input_columns reads the whole
+    data frame and may change rows, so it runs alone in its wave.
+    release_columns are dropped as soon as the last transformer reading them has finished.
+    """
 
-    def __init__(self, *args):
+    def __init__(self, *args, n_jobs=1):
         if args is None:
             self.transformers = []
         else:
             self.transformers = list(args)
+        self.n_jobs = n_jobs
+
+    @staticmethod
+    def _reads(transformer):
+        columns = getattr(transformer, "input_columns", None)
+        return None if columns is None else set(columns)
+
+    @staticmethod
+    def _writes(transformer):
+        return set(getattr(transformer, "output_columns", ()))
+
+    def plan(self):
+        """
+        :return: list of waves, each wave is a list of transformer indices
+        """
+        waves_of = []
+        for i, transformer in enumerate(self.transformers):
+            reads, writes = self._reads(transformer), self._writes(transformer)
+            wave = 0
+            for j in range(i):
+                prev_reads, prev_writes = self._reads(self.transformers[j]), self._writes(self.transformers[j])
+                if reads is None or prev_reads is None or prev_writes & (reads | writes) or prev_reads & writes:
+                    wave = max(wave, waves_of[j] + 1)
+            waves_of.append(wave)
+
+        waves = [[] for _ in range(max(waves_of) + 1 if waves_of else 0)]
+        for i, wave in enumerate(waves_of):
+            waves[wave].append(i)
+        return waves
+
+    def release_waves(self, waves):
+        """
+        :return: {column: index of the wave after which the column is dropped}
+        """
+        release_waves = {}
+        for wave_index, wave in enumerate(waves):
+            for i in wave:
+                for col in getattr(self.transformers[i], "release_columns", ()):
+                    release_waves[col] = max(release_waves.get(col, -1), wave_index)
+        for wave_index, wave in enumerate(waves):
+            for i in wave:
+                reads = self._reads(self.transformers[i])
+                for col in release_waves:
+                    if reads is None or col in reads:
+                        release_waves[col] = max(release_waves[col], wave_index)
+        return release_waves
 
     def transform(self, df, include_sparse=True):
-        feature_columns = []
-        for transformer in self.transformers:
-            if isinstance(transformer, NullTransformer):
-                transformer.transform(df)
-            elif isinstance(transformer, DfTransformer):
-                df = transformer.transform(df)
+        waves = self.plan()
+        release_waves = self.release_waves(waves)
+        feature_columns = {}
+
+        for wave_index, wave in enumerate(waves):
+            if self._reads(self.transformers[wave[0]]) is None:
+                transformer = self.transformers[wave[0]]
+                result = transformer.transform(df)
+                if isinstance(transformer, DfTransformer):
+                    df = result
+                elif not isinstance(transformer, NullTransformer) and result is not None:
+                    feature_columns[wave[0]] = result
             else:
-                feature_columns.append(transformer.transform(df))
-
+                inputs = [df[[col for col in self.transformers[i].input_columns if col in df.columns]] for i in wave]
+                if self.n_jobs > 1 and len(wave) > 1:
+                    with ThreadPool(RESOURCES.threads("UnionFeaturePipeline", min(self.n_jobs, len(wave)))) as pool:
+                        results = pool.starmap(lambda transformer, input_df: transformer.transform(input_df),
+                                               [(self.transformers[i], input_df) for i, input_df in zip(wave, inputs)])
+                else:
+                    results = [self.transformers[i].transform(input_df) for i, input_df in zip(wave, inputs)]
+                del inputs
+
+                for i, result in zip(wave, results):
+                    transformer = self.transformers[i]
+                    if isinstance(transformer, DfTransformer):
+                        for col in self._writes(transformer):
+                            if col in result.columns:
+                                df[col] = result[col].values
+                    elif not isinstance(transformer, NullTransformer) and result is not None:
+                        feature_columns[i] = result
+                del results
+
+            released = [col for col, release_wave in release_waves.items()
+                        if release_wave == wave_index and col in df.columns]
+            if len(released) > 0:
+                logger.info("releasing columns %s", released)
+                df.drop(released, axis=1, inplace=True)
+                gc.collect()
+
+        feature_columns = [feature_columns[i] for i in sorted(feature_columns.keys())]
         if include_sparse:
             return df, sparse.hstack(feature_columns, format="csr")
         if len(feature_columns) == 0:
@@ -197,10 +732,65 @@ def make_random_predictions(predictions_df):
     predictions_df.confidenceValue = 2.0 * np.random.rand(len(predictions_df)) - 1.0
 
 
+class CompetitionMetric(object):
+    """
+    score of the competition, the mean over the standard deviation of the daily sums of
+    confidence x returnsOpenNextMktres10 x universe.
+    the days are factorized once, so a score is a np.bincount over the day indices, which is cheap enough for
+    every boosting round or epoch.
+    """
+    NAME = "competition_score"
+
+    def __init__(self, times, returns, universe=None):
+        self.day_indices, self.days = pd.factorize(pd.Series(times), sort=True)
+        weights = np.asarray(returns, dtype="float64")
+        if universe is not None:
+            weights = weights * np.asarray(universe, dtype="float64")
+        self.weights = np.nan_to_num(weights)
+        self.n_days = len(self.days)
+
+    def daily_sums(self, confidence):
+        confidence = np.asarray(confidence, dtype="float64").reshape(-1)
+        return np.bincount(self.day_indices, weights=self.weights * confidence, minlength=self.n_days)
+
+    def score(self, confidence):
+        daily_sums = self.daily_sums(confidence)
+        std = daily_sums.std()
+        return float(daily_sums.mean() / std) if std > 0 else 0.0
+
+    def lgb_feval(self, predictions, dataset):
+        """
+        feval of lgb.train with the binary objective, whose predictions are probabilities.
+        """
+        return self.NAME, self.score(predictions * 2 - 1), True
+
+    def epoch_end_hook(self, predict, x):
+        """
+        :param predict: function which gives the probabilities of x
+        :return: function(epoch, logs) for on_epoch_end of keras.callbacks.LambdaCallback or a torch epoch loop
+        """
+        def on_epoch_end(epoch, logs=None):
+            score = self.score(np.asarray(predict(x)).reshape(-1) * 2 - 1)
+            logger.info("epoch %d %s: %.5f", epoch, self.NAME, score)
+            if logs is not None:
+                logs["val_" + self.NAME] = score
+            return score
+
+        return on_epoch_end
+
+    def report(self, confidence):
+        daily_sums = pd.Series(self.daily_sums(confidence), index=self.days)
+        return {"score": self.score(confidence), "mean": daily_sums.mean(), "std": daily_sums.std(ddof=0),
+                "n_days": self.n_days, "daily_sums": daily_sums}
+
+
 class ModelWrapper(ABC):
+    # whether uint8 bin codes can be passed without dequantization
+    accepts_binned_features = False
 
     def __init__(self, **kwargs):
         self.model = None
+        self.valid_metric: CompetitionMetric = None
         super().__init__(**kwargs)
 
     @abstractmethod
@@ -211,8 +801,16 @@ class ModelWrapper(ABC):
     def train(self, **kwargs):
         return self
 
+    def update(self, x, y, time_budget):
+        """
+        continue training the trained model on newly labelled rows within time_budget seconds.
+        the model is kept as it is unless the wrapper supports incremental updates.
+        """
+        return self
+
     @staticmethod
     def generate(model_type):
+        load_backend(model_type)
         if model_type == "lgb":
             return LgbWrapper()
         elif model_type == "mlp":
@@ -260,32 +858,77 @@ class ModelWrapper(ABC):
         # gc.collect()
         return train_Y, market_obs_ids
 
+    @staticmethod
+    def pop_metric(df, train_size):
+        """
+        drop the target columns of the competition score from df.
+        the validation rows are the last ones of split_train_validation, in the order of the market ids if df has them.
+        :return: CompetitionMetric of the validation rows, None if df has no target
+        """
+        if NEXT_MKTRES_10 not in df.columns:
+            return None
+        if MARKET_ID in df.columns:
+            order = np.argsort(df[MARKET_ID].values, kind="mergesort")
+            valid_df = df.iloc[order[int(len(df) * train_size):]]
+        else:
+            valid_df = df.iloc[int(len(df) * train_size):]
+        metric = CompetitionMetric(valid_df["time"], valid_df[NEXT_MKTRES_10], valid_df["universe"])
+        df.drop([NEXT_MKTRES_10, "universe"], axis=1, inplace=True)
+        return metric
+
+    def set_valid_metric(self, df, train_size):
+        """
+        pop the metric of the validation rows from df, or keep the one which main popped before linking.
+        """
+        metric = ModelWrapper.pop_metric(df, train_size)
+        if metric is not None:
+            self.valid_metric = metric
+
     @abstractmethod
     def create_dataset(self, market_train, features, train_batch_size, valid_batch_size):
         return None, None
 
 
 class LgbWrapper(ModelWrapper):
-
-    def __init__(self, **kwargs):
+    accepts_binned_features = True
+    # parameters of the Dataset construction, which are a part of the key of the cached binary datasets
+    DATASET_PARAMS = {"max_bin": 205, "min_data_in_leaf": 210}
+    # rows of a shard of the linked feature matrix when the Dataset is built out of core
+    SEQUENCE_BATCH_SIZE = 100000
+    # boosting rounds added by an incremental update
+    UPDATE_ROUNDS = 10
+    # num_threads is given by RESOURCES unless it is set
+    HYPER_PARAMS = {"objective": "binary", "boosting": "gbdt", "num_iterations": 500,
+                    "learning_rate": 0.2, "num_leaves": 2500,
+                    "seed": 10, "early_stopping_round": 10
+                    }
+
+    def __init__(self, dataset_dir=LGB_DATASET_DIR, params=None, **kwargs):
+        """
+        :param params: hyper parameters overriding HYPER_PARAMS, like the best ones of LgbSearch
+        """
         super().__init__(**kwargs)
+        self.dataset_dir = None if dataset_dir is None else Path(dataset_dir)
+        self.params = {} if params is None else dict(params)
+
+    def hyper_params(self, **params):
+        hyper_params = dict(self.HYPER_PARAMS)
+        hyper_params.update(self.params)
+        hyper_params.update(params)
+        # the parameters of the constructed Dataset can not be changed
+        hyper_params.update(self.DATASET_PARAMS)
+        hyper_params["num_threads"] = RESOURCES.threads("LgbWrapper", hyper_params.get("num_threads"))
+        return hyper_params
 
     @measure_time
     def train(self, **kwargs):
         # len(self.feature_names)
         gc.collect()
-        # In[ ]:
-        RANDOM_SEED = 10
-        # In[ ]:
-
-        hyper_params = {"objective": "binary", "boosting": "gbdt", "num_iterations": 500,
-                        "learning_rate": 0.2, "num_leaves": 2500,
-                        "num_threads": 2, "max_bin": 205, 'min_data_in_leaf': 210,
-                        "seed": RANDOM_SEED, "early_stopping_round": 10
-                        }
+        hyper_params = self.hyper_params()
         # ## train
         # In[ ]:
-        model = lgb.train(params=hyper_params, train_set=self.x, valid_sets=[self.valid_X])
+        model = lgb.train(params=hyper_params, train_set=self.x, valid_sets=[self.valid_X],
+                          feval=self.valid_metric.lgb_feval if self.valid_metric is not None else None)
         # In[ ]:
         for feature, imp in zip(model.feature_name(), model.feature_importance()):
             logger.info("{}: {}".format(feature, imp))
@@ -303,22 +946,374 @@ class LgbWrapper(ModelWrapper):
     def predict(self, X):
         return self.model.predict(X)
 
+    def update(self, x, y, time_budget):
+        """
+        the time budget starts with the call, so the construction of the Dataset is taken out of it.
+        """
+        start = perf_counter()
+        # the raw rows are kept for the init scores of the current model, which lgb.train predicts on them
+        train_set = lgb.Dataset(x, label=y, params=self.DATASET_PARAMS, free_raw_data=False).construct()
+        remaining = time_budget - (perf_counter() - start)
+        if remaining <= 0:
+            logger.info("lgb model is not updated: the Dataset of %d rows took the time budget", len(y))
+            return self
+        deadline = perf_counter() + remaining
+
+        def stop_at_deadline(env):
+            if perf_counter() > deadline:
+                raise lgb.callback.EarlyStopException(env.iteration, env.evaluation_result_list)
+
+        params = self.hyper_params(num_iterations=self.UPDATE_ROUNDS)
+        params.pop("early_stopping_round", None)
+        self.model = lgb.train(params=params, train_set=train_set, init_model=self.model, keep_training_booster=True,
+                               callbacks=[stop_at_deadline])
+        logger.info("lgb model is updated to %d trees with %d rows", self.model.current_iteration(), len(y))
+        return self
+
     def create_dataset(self, df, features, train_batch_size, valid_batch_size):
+        """
+        :param features: the linked feature matrix, or Features to build the Dataset out of core from the links in df
+        """
         y, self.market_obs_ids = ModelWrapper.to_x_y(df)
         train_size = 0.8
-        self.x, self.valid_X, y, valid_Y = ModelWrapper.split_train_validation(
+        self.set_valid_metric(df, train_size)
+        if isinstance(features, Features):
+            self.x, self.valid_X = self.construct_sequence_datasets(df, features, y, train_size)
+            return None, None
+        x, valid_x, y, valid_y = ModelWrapper.split_train_validation(
             features, y,
             train_size
         )
         # if is_not_empty(train_X2):
         #     self.x = sparse.hstack([self.x, train_X2])
-        self.x = lgb.Dataset(self.x, label=y,
-                             free_raw_data=False)
-
-        self.valid_X = self.x.create_valid(self.valid_X, label=valid_Y)
-        del valid_Y
+        fingerprint = FeatureStore.hash_arrays([x, np.asarray(y), valid_x, np.asarray(valid_y)])
+        self.x, self.valid_X = self.load_or_construct_datasets(
+            fingerprint, lambda: self.construct_datasets(x, y, valid_x, valid_y))
+        del x, valid_x, valid_y
         return None, None
 
+    def construct_datasets(self, x, y, valid_x, valid_y):
+        train_set = lgb.Dataset(x, label=y, params=self.DATASET_PARAMS, free_raw_data=True).construct()
+        return train_set, train_set.create_valid(valid_x, label=valid_y).construct()
+
+    def load_or_construct_datasets(self, fingerprint, construct):
+        """
+        load the binary datasets saved by a previous run with the same fingerprint of the data and DATASET_PARAMS,
+        or construct and save them.
+        :param fingerprint: hash of the training and validation data, which is cheaper than constructing them
+        :param construct: function which gives the constructed (train dataset, validation dataset)
+        :return: (train dataset, validation dataset)
+        """
+        if self.dataset_dir is None:
+            return construct()
+
+        key = hashlib.md5(repr((fingerprint, FeatureStore.describe(self.DATASET_PARAMS),
+                                lgb.__version__)).encode("utf-8"))
+        train_path = self.dataset_dir.joinpath("train-{}.bin".format(key.hexdigest()))
+        valid_path = self.dataset_dir.joinpath("valid-{}.bin".format(key.hexdigest()))
+        if train_path.exists() and valid_path.exists():
+            logger.info("lgb datasets are loaded from %s", self.dataset_dir)
+            train_set = lgb.Dataset(str(train_path), params=self.DATASET_PARAMS, free_raw_data=True)
+            return train_set, lgb.Dataset(str(valid_path), reference=train_set, free_raw_data=True)
+
+        train_set, valid_set = construct()
+        self.dataset_dir.mkdir(parents=True, exist_ok=True)
+        for dataset, path in [(train_set, train_path), (valid_set, valid_path)]:
+            tmp_path = path.with_suffix(".tmp")
+            dataset.save_binary(str(tmp_path))
+            tmp_path.rename(path)
+        logger.info("lgb datasets are stored in %s", self.dataset_dir)
+        return train_set, valid_set
+
+    def construct_sequence_datasets(self, df, features, y, train_size):
+        """
+        construct the datasets from LinkedFeatureSequence, which produces the linked feature rows shard by shard.
+        the binary cache is keyed on Features.fingerprint of the links instead of the linked matrix.
+        :return: (train dataset, validation dataset)
+        """
+        define_lgb_classes()
+        list_of_indices = df[NEWS_ID].tolist() if NEWS_ID in df.columns else None
+        market_indices, valid_market_indices, y, valid_y = ModelWrapper.split_train_validation(
+            np.asarray(self.market_obs_ids), y, train_size)
+        if list_of_indices is None:
+            valid_list_of_indices = None
+        else:
+            list_of_indices, valid_list_of_indices = list_of_indices[:len(y)], list_of_indices[len(y):]
+        fingerprint = (features.fingerprint(market_indices, list_of_indices),
+                       features.fingerprint(valid_market_indices, valid_list_of_indices),
+                       FeatureStore.hash_arrays([np.asarray(y), np.asarray(valid_y)]))
+
+        def construct():
+            train_set = lgb.Dataset(
+                LinkedFeatureSequence(features, market_indices, list_of_indices, self.SEQUENCE_BATCH_SIZE),
+                label=y, params=self.DATASET_PARAMS, free_raw_data=True).construct()
+            valid_set = train_set.create_valid(
+                LinkedFeatureSequence(features, valid_market_indices, valid_list_of_indices, self.SEQUENCE_BATCH_SIZE),
+                label=valid_y).construct()
+            return train_set, valid_set
+
+        return self.load_or_construct_datasets(fingerprint, construct)
+
+
+def hyperband_brackets(min_rounds, max_rounds, eta=3):
+    """
+    :return: [(number of trials, [boosting rounds of each rung]), ...] of the brackets of hyperband, from the most
+    exploring bracket to the one which trains every trial for max_rounds
+    """
+    s_max = int(np.floor(np.log(max_rounds / min_rounds) / np.log(eta) + 1e-9))
+    return [(int(np.ceil((s_max + 1) / (s + 1) * eta ** s)),
+             [int(round(max_rounds * eta ** (rung - s))) for rung in range(s + 1)])
+            for s in range(s_max, -1, -1)]
+
+
+class LgbSearch(object):
+    """
+    hyperband search of the hyper parameters of LgbWrapper over the boosting rounds. every trial is a Booster on the
+    datasets built once by LgbWrapper.create_dataset, and a trial surviving a rung keeps boosting from its rounds.
+    the trials of a rung run in threads, which share the thread budget.
+    the process RSS is recorded as the memory of a trial, which includes the other trials running at the same time.
+    """
+    # choices of each hyper parameter. the parameters of the Dataset are fixed by the constructed Dataset.
+    SPACE = {"learning_rate": [0.02, 0.05, 0.1, 0.2],
+             "num_leaves": [63, 255, 1023, 2500],
+             "feature_fraction": [0.5, 0.8, 1.0],
+             "bagging_fraction": [0.7, 1.0],
+             "bagging_freq": [0, 1],
+             "lambda_l2": [0.0, 1.0, 10.0]}
+
+    def __init__(self, model: LgbWrapper, space=None, min_rounds=20, max_rounds=500, eta=3, n_threads=None,
+                 n_concurrent=2, results_path=LGB_SEARCH_RESULTS, random_state=10):
+        """
+        :param model: LgbWrapper whose create_dataset has been called
+        :param n_threads: threads of all the concurrent trials, None for all the cores of RESOURCES
+        """
+        self.model = model
+        self.space = self.SPACE if space is None else space
+        if set(self.space) & set(model.DATASET_PARAMS):
+            raise ValueError("parameters of the Dataset can not be searched: {}".format(
+                sorted(set(self.space) & set(model.DATASET_PARAMS))))
+        self.min_rounds = min_rounds
+        self.max_rounds = max_rounds
+        self.eta = eta
+        self.n_concurrent = n_concurrent
+        self.threads_per_trial = max(RESOURCES.threads("LgbSearch", n_threads) // n_concurrent, 1)
+        self.results_path = None if results_path is None else Path(results_path)
+        self.random_state = np.random.RandomState(random_state)
+        self.results = []
+        self.best_params = None
+        self.best_score = -np.inf
+
+    def sample_params(self):
+        return {name: values[self.random_state.randint(len(values))] for name, values in self.space.items()}
+
+    def advance(self, trial, rounds):
+        start = perf_counter()
+        if trial["booster"] is None:
+            params = self.model.hyper_params(num_threads=self.threads_per_trial, **trial["params"])
+            for name in ["num_iterations", "early_stopping_round"]:
+                params.pop(name, None)
+            trial["booster"] = lgb.Booster(params, self.model.x)
+            trial["booster"].add_valid(self.model.valid_X, "valid")
+        for _ in range(rounds - trial["rounds"]):
+            if trial["booster"].update():
+                break
+        trial["rounds"] = rounds
+
+        metric = self.model.valid_metric
+        evals = trial["booster"].eval_valid(metric.lgb_feval if metric is not None else None)
+        _, _, value, is_higher_better = evals[-1]
+        trial["score"] = value if is_higher_better else -value
+        trial["wall"] += perf_counter() - start
+        return trial
+
+    def record(self, trials, bracket, rung):
+        rss = get_rss_bytes()
+        for trial in trials:
+            self.results.append({"bracket": bracket, "rung": rung, "trial": trial["id"], "rounds": trial["rounds"],
+                                 "score": trial["score"], "wall": trial["wall"], "rss": rss,
+                                 "params": json.dumps(trial["params"], sort_keys=True)})
+        if self.results_path is not None:
+            pd.DataFrame(self.results).to_csv(str(self.results_path), index=False)
+
+    @measure_time
+    def run(self):
+        """
+        :return: DataFrame of every rung of every trial
+        """
+        # the Datasets are constructed lazily, so the first Boosters of the threads would construct them concurrently
+        self.model.x.construct()
+        self.model.valid_X.construct()
+        n_trials = 0
+        for bracket, (n_bracket_trials, rung_rounds) in enumerate(
+                hyperband_brackets(self.min_rounds, self.max_rounds, self.eta)):
+            trials = [{"id": n_trials + i, "params": self.sample_params(), "booster": None, "rounds": 0,
+                       "score": None, "wall": 0.0} for i in range(n_bracket_trials)]
+            n_trials += n_bracket_trials
+            for rung, rounds in enumerate(rung_rounds):
+                with ThreadPool(min(self.n_concurrent, len(trials))) as pool:
+                    trials = pool.map(functools.partial(self.advance, rounds=rounds), trials, chunksize=1)
+                self.record(trials, bracket, rung)
+                trials.sort(key=lambda trial: trial["score"], reverse=True)
+                # the trials out of the next rung are pruned
+                n_kept = max(len(trials) // self.eta, 1) if rung < len(rung_rounds) - 1 else 1
+                for trial in trials[n_kept:]:
+                    trial["booster"] = None
+                trials = trials[:n_kept]
+                logger.info("bracket %d rung %d: %d rounds, best score %.5f with %s", bracket, rung, rounds,
+                            trials[0]["score"], trials[0]["params"])
+            if trials[0]["score"] > self.best_score:
+                self.best_score = trials[0]["score"]
+                self.best_params = dict(trials[0]["params"], num_iterations=trials[0]["rounds"])
+            trials[0]["booster"] = None
+            gc.collect()
+        logger.info("best score %.5f with %s", self.best_score, self.best_params)
+        return pd.DataFrame(self.results)
+
+
+def walk_forward_folds(times, n_folds, valid_days, train_days=None, embargo_days=TARGET_HORIZON_DAYS):
+    """
+    split rows into walk forward folds by market day. the validation ranges are the last n_folds ranges of valid_days
+    days, and the training rows of a fold end embargo_days before its validation range, so that their targets do not
+    overlap the validation range.
+    :param train_days: days of the sliding training window, None for the expanding window from the first day
+    :return: [(training row positions, validation row positions), ...] in the order of the dates, each sorted by time
+    """
+    day_indices, days = pd.factorize(pd.Series(times), sort=True)
+    order = np.argsort(day_indices, kind="mergesort")
+    day_starts = np.searchsorted(day_indices[order], np.arange(len(days) + 1))
+    folds = []
+    for fold in range(n_folds):
+        valid_start = len(days) - (n_folds - fold) * valid_days
+        train_end = valid_start - embargo_days
+        train_start = 0 if train_days is None else max(train_end - train_days, 0)
+        if train_end <= train_start:
+            raise ValueError("{} days are too few for {} folds of {} days with {} days embargo".format(
+                len(days), n_folds, valid_days, embargo_days))
+        folds.append((order[day_starts[train_start]:day_starts[train_end]],
+                      order[day_starts[valid_start]:day_starts[valid_start + valid_days]]))
+    return folds
+
+
+# (cv, df, matrix_paths) inherited by the forked processes of WalkForwardCV.run, whose pool is started with fork
+CV_FOLD_INPUTS = None
+
+
+def run_cv_fold(fold_id, train_indices, valid_indices):
+    cv, df, matrix_paths = CV_FOLD_INPUTS
+    return cv.run_fold(fold_id, df, cv.load_feature_matrix(matrix_paths), train_indices, valid_indices)
+
+
+class WalkForwardCV(object):
+    """
+    walk forward cross validation over the linked market rows. the feature matrix (or the arrays of a sparse one) is
+    saved once as .npy and the folds read it memory mapped, so the forked fold processes share its pages instead of
+    copying it.
+    """
+
+    def __init__(self, model_factory, n_folds=4, valid_days=60, train_days=None, embargo_days=TARGET_HORIZON_DAYS,
+                 pool=2, work_dir=None):
+        """
+        :param model_factory: function which gives a new ModelWrapper taking the feature matrix, like LgbWrapper.
+        the datasets of the folds are not cached in the dataset_dir of LgbWrapper.
+        :param work_dir: directory of the memory mapped feature matrix, None for a temporary directory
+        """
+        self.model_factory = model_factory
+        self.n_folds = n_folds
+        self.valid_days = valid_days
+        self.train_days = train_days
+        self.embargo_days = embargo_days
+        self.pool = pool
+        self.work_dir = work_dir
+
+    @staticmethod
+    def save_feature_matrix(work_dir, feature_matrix):
+        """
+        save the dense matrix, or the arrays of the CSR matrix without densifying it, as .npy files.
+        :return: {array name: path}
+        """
+        if sparse.issparse(feature_matrix):
+            feature_matrix = feature_matrix.tocsr()
+            arrays = {"data": feature_matrix.data, "indices": feature_matrix.indices, "indptr": feature_matrix.indptr,
+                      "shape": np.array(feature_matrix.shape)}
+        else:
+            arrays = {"dense": feature_matrix}
+        paths = {}
+        for name, array in arrays.items():
+            paths[name] = work_dir.joinpath("cv_feature_matrix_{}.npy".format(name))
+            np.save(str(paths[name]), array)
+        return paths
+
+    @staticmethod
+    def load_feature_matrix(paths):
+        arrays = {name: np.load(str(path), mmap_mode="r") for name, path in paths.items()}
+        if "dense" in arrays:
+            return arrays["dense"]
+        return sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(arrays["shape"]))
+
+    @staticmethod
+    def take_rows(feature_matrix, indices):
+        rows = feature_matrix[indices]
+        return rows if sparse.issparse(rows) else np.asarray(rows)
+
+    def run_fold(self, fold_id, df, feature_matrix, train_indices, valid_indices):
+        start = perf_counter()
+        model = self.model_factory()
+        if isinstance(model, LgbWrapper):
+            # the rows of a fold are not worth caching, and the fold processes must not write the shared cache
+            model.dataset_dir = None
+        model.create_dataset(df.iloc[train_indices].reset_index(drop=True),
+                             self.take_rows(feature_matrix, train_indices), train_batch_size=1024,
+                             valid_batch_size=1024)
+        model.train()
+        confidence = np.asarray(model.predict(self.take_rows(feature_matrix, valid_indices))).reshape(-1) * 2 - 1
+        valid_df = df.iloc[valid_indices]
+        report = CompetitionMetric(valid_df["time"], valid_df[NEXT_MKTRES_10], valid_df["universe"]).report(confidence)
+        train_times = df["time"].iloc[train_indices]
+        result = {"fold": fold_id, "train_start": train_times.min(), "train_end": train_times.max(),
+                  "valid_start": valid_df["time"].min(), "valid_end": valid_df["time"].max(),
+                  "n_train": len(train_indices), "n_valid": len(valid_indices),
+                  "score": report["score"], "wall": perf_counter() - start}
+        logger.info("fold %d from %s to %s: score %.5f in %.3f sec", fold_id, result["valid_start"],
+                    result["valid_end"], result["score"], result["wall"])
+        return result
+
+    @measure_time
+    def run(self, df, feature_matrix):
+        """
+        :param df: linked market rows with time, confidence, market_id, returnsOpenNextMktres10 and universe in the
+        row order of feature_matrix
+        :param feature_matrix: dense or sparse matrix. the folds pass the rows of a sparse one as CSR to the models.
+        :return: DataFrame of the dates, the score and the wall time of each fold
+        """
+        folds = walk_forward_folds(df["time"], self.n_folds, self.valid_days, self.train_days, self.embargo_days)
+        work_dir = Path(tempfile.mkdtemp() if self.work_dir is None else self.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        matrix_paths = self.save_feature_matrix(work_dir, feature_matrix)
+        try:
+            if self.pool > 1:
+                global CV_FOLD_INPUTS
+                CV_FOLD_INPUTS = (self, df, matrix_paths)
+                try:
+                    with RESOURCES.process_pool("WalkForwardCV", min(self.pool, len(folds)),
+                                                fork=True) as process_pool:
+                        results = process_pool.starmap(
+                            run_cv_fold, [(i, train, valid) for i, (train, valid) in enumerate(folds)], chunksize=1)
+                finally:
+                    CV_FOLD_INPUTS = None
+            else:
+                feature_matrix = self.load_feature_matrix(matrix_paths)
+                results = [self.run_fold(i, df, feature_matrix, train, valid)
+                           for i, (train, valid) in enumerate(folds)]
+        finally:
+            if self.work_dir is None:
+                shutil.rmtree(str(work_dir), ignore_errors=True)
+            else:
+                for path in matrix_paths.values():
+                    path.unlink()
+        results = pd.DataFrame(results)
+        logger.info("walk forward cv score: %.5f +- %.5f", results["score"].mean(), results["score"].std(ddof=0))
+        return results
+
 
 def is_not_empty(list_like):
     if list_like is None:
@@ -328,6 +1323,46 @@ def is_not_empty(list_like):
     return len(list_like) > 0
 
 
+def bytes_per_row(df, n_samples=10000):
+    """
+    bytes of a row including the python objects of its object columns, measured on n_samples sampled rows.
+    the categories of categorical columns are shared by all rows and not counted.
+    """
+    if len(df) == 0:
+        return 0.0
+    sample = df if len(df) <= n_samples else df.sample(n_samples, random_state=0)
+    sample_bytes = 0
+    for col, dtype in zip(sample.columns, sample.dtypes):
+        if dtype.name == "category":
+            sample_bytes += sample[col].cat.codes.memory_usage(index=False)
+        else:
+            sample_bytes += sample[col].memory_usage(index=False, deep=True)
+    return sample_bytes / len(sample)
+
+
+def estimate_join(left, right, left_on, right_on, how="inner"):
+    """
+    estimate the output of a merge from the key histogram of the right data frame.
+    :return: (output rows of each left row, bytes of an output row)
+    """
+    if len(left) == 0:
+        return np.zeros(0, dtype="int64"), 0.0
+    key_counts = right.groupby(right_on, observed=True).size().rename("fanOut").reset_index()
+    fan_out = left[left_on].merge(key_counts, left_on=left_on, right_on=right_on, how="left")["fanOut"]
+    fan_out = fan_out.fillna(1 if how == "left" else 0).values.astype("int64")
+    row_bytes = bytes_per_row(left) + bytes_per_row(right.drop(right_on, axis=1))
+    return fan_out, float(row_bytes)
+
+
+def log_fan_out(name, fan_out, groups):
+    percentiles = [0.5, 0.9, 0.99]
+    logger.info("%s: links per row %s", name,
+                pd.Series(fan_out).describe(percentiles=percentiles).round(2).to_dict())
+    for group_name, keys in groups.items():
+        links = pd.Series(fan_out).groupby(np.asarray(keys), observed=True).sum()
+        logger.info("%s: links per %s %s", name, group_name, links.describe(percentiles=percentiles).round(2).to_dict())
+
+
 class MarketNewsLinker(object):
 
     def __init__(self, max_day_diff):
@@ -338,11 +1373,58 @@ class MarketNewsLinker(object):
         self.datatypes_before_aggregation = None
         # self.concatable_features = concatable_fields
         self.news_columns = None
+        # projected and actual sizes of the joins
+        self.join_traces = []
+        # whether market_df is already aggregated by linking date shards
+        self.is_aggregated = False
+
+    def merge(self, name, left, right, left_on, right_on, how="inner", row_filter=None, fan_out_groups=None):
+        """
+        merge after estimating the output size from the key histograms.
+        the join is split into chunks of left rows or refused if the projected size exceeds
+        FeatureSetting.link_memory_budget. chunks only shrink the peak when row_filter drops the rows of each chunk,
+        so a join over the budget without row_filter is always refused.
+        :param row_filter: function applied to the merged data frame (of each chunk)
+        :param fan_out_groups: {group name: column of left}, over which the links are summed for the log
+        """
+        fan_out, row_bytes = estimate_join(left, right, left_on, right_on, how)
+        projected_bytes = fan_out.sum() * row_bytes
+        logger.info("%s: projected %d rows, %.1f MB", name, fan_out.sum(), projected_bytes / 1e6)
+        log_fan_out(name, fan_out, {group_name: left[column].values
+                                    for group_name, column in (fan_out_groups or {}).items()})
+
+        budget = FeatureSetting.link_memory_budget
+        bounds = [0, len(left)]
+        if budget is not None and projected_bytes > budget:
+            if FeatureSetting.link_over_budget == "raise" or row_filter is None:
+                raise MemoryError("{} is projected to {:.1f} MB over the budget {:.1f} MB".format(
+                    name, projected_bytes / 1e6, budget / 1e6))
+            cumulative_bytes = np.cumsum(fan_out) * row_bytes
+            n_chunks = int(np.ceil(projected_bytes / budget))
+            bounds = np.searchsorted(cumulative_bytes, np.arange(1, n_chunks) * budget).tolist()
+            bounds = sorted(set([0] + bounds + [len(left)]))
+            logger.info("%s: split into %d chunks", name, len(bounds) - 1)
+
+        with PROFILER.stage(name, inputs=[left, right]) as record:
+            merged_dfs = []
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                merged_df = left.iloc[start:end].merge(right, left_on=left_on, right_on=right_on, how=how)
+                if row_filter is not None:
+                    merged_df = row_filter(merged_df)
+                merged_dfs.append(merged_df)
+            merged_df = merged_dfs[0] if len(merged_dfs) == 1 else pd.concat(merged_dfs, ignore_index=True)
+            record["outputs"] = shapes_of(merged_df)
+
+        self.join_traces.append({"name": name, "projected_rows": int(fan_out.sum()),
+                                 "projected_bytes": projected_bytes, "rows": len(merged_df),
+                                 "n_chunks": len(bounds) - 1})
+        return merged_df
 
-    def link_market_assetCode_and_news_assetCodes(self):
-        assetCodes_in_markests = self.market_df.assetCode.unique().tolist()
+    @staticmethod
+    def create_asset_code_links(market_df, news_df):
+        assetCodes_in_markests = market_df.assetCode.unique().tolist()
         logger.info("assetCodes pattern in markets: {}".format(len(assetCodes_in_markests)))
-        assetCodes_in_news = self.news_df.assetCodes.unique()
+        assetCodes_in_news = news_df.assetCodes.unique()
         assetCodes_in_news_size = len(assetCodes_in_news)
         logger.info("assetCodes pattern in news: {}".format(assetCodes_in_news_size))
         parse_multiple_codes = lambda codes: re.sub(SPLIT_PATTERN, "", str(codes)).split(", ")
@@ -357,17 +1439,23 @@ class MarketNewsLinker(object):
         logger.info("links for assetCodes: {}".format(len(links_assetCodes)))
         links_assetCodes = pd.DataFrame(links_assetCodes, columns=["newsAssetCodes", "marketAssetCode"],
                                         dtype='category')
-
         logger.info(links_assetCodes.shape)
+        return links_assetCodes
+
+    @measure_time
+    def link_market_assetCode_and_news_assetCodes(self, links_assetCodes=None):
+        if links_assetCodes is None:
+            links_assetCodes = self.create_asset_code_links(self.market_df, self.news_df)
         # self.market_df = self.market_df.merge(links_assetCodes, left_on="assetCode", right_on="marketAssetCode",
         #                                       copy=False, how="left", left_index=True)
-        self.market_df = self.market_df.merge(links_assetCodes, left_on="assetCode", right_on="marketAssetCode",
-                                              copy=False, how="left")
+        self.market_df = self.merge("merge assetCodes", self.market_df, links_assetCodes, ["assetCode"],
+                                    ["marketAssetCode"], how="left", fan_out_groups={"asset": "assetCode"})
         logger.info(self.market_df.shape)
         # merge assetCodes links
         self.market_df.drop(["marketAssetCode"], axis=1, inplace=True)
         # self.market_df.drop(["marketAssetCode"], axis=1)
 
+    @measure_time
     def append_working_date_on_market(self):
         self.market_df["date"] = self.market_df.time.dt.date
         self.news_df["firstCreatedDate"] = self.news_df.firstCreated.dt.date
@@ -395,6 +1483,7 @@ class MarketNewsLinker(object):
         self.market_df.date = self.market_df.date.astype(np.datetime64)
         self.market_df = self.market_df.merge(date_df, left_on="date", right_on="date", how="left")
 
+    @measure_time
     def link_market_id_and_news_id(self):
         logger.info("linking ids...")
         self.news_columns = self.news_df.columns.tolist()
@@ -402,27 +1491,29 @@ class MarketNewsLinker(object):
         market_link_columns = [MARKET_ID, "time", "newsAssetCodes", "date", "prevDate"]
         news_link_df = self.news_df[["assetCodes", "firstCreated", "firstCreatedDate", NEWS_ID]]
         self.news_df.drop(["assetCodes", "firstCreated", "firstCreatedDate"], axis=1, inplace=True)
-        link_df = self.market_df[market_link_columns].merge(news_link_df, left_on=["newsAssetCodes", "date"],
-                                                            right_on=["assetCodes", "firstCreatedDate"], how='left')
+        fan_out_groups = {"asset": "assetCode", "day": "date"}
+        market_link_df = self.market_df[market_link_columns + ["assetCode"]]
         # remove news after market obs
-        link_df = link_df[link_df["time"] > link_df["firstCreated"]]
-        link_df.drop(["time", "newsAssetCodes", "date", "prevDate"], axis=1, inplace=True)
+        link_df = self.merge("merge news", market_link_df, news_link_df, ["newsAssetCodes", "date"],
+                             ["assetCodes", "firstCreatedDate"], how="left",
+                             row_filter=lambda df: df[df["time"] > df["firstCreated"]], fan_out_groups=fan_out_groups)
+        link_df.drop(["time", "newsAssetCodes", "date", "prevDate", "assetCode"], axis=1, inplace=True)
         # link_df = link_df.drop(["time", "newsAssetCodes", "date", "prevDate"], axis=1)
 
         # self.link_df.sort_values(by=["time"],inplace=True)
         # self.link_df.drop_duplicates(subset=[MARKET_ID], keep="last", inplace=True)
 
         if FeatureSetting.should_use_prev_news:
-            prev_day_link_df = self.market_df[market_link_columns].merge(
-                news_link_df, left_on=["newsAssetCodes", "prevDate"],
-                right_on=["assetCodes", "firstCreatedDate"])
-            prev_day_link_df = prev_day_link_df[
-                prev_day_link_df["time"] - pd.Timedelta(days=1) < prev_day_link_df["firstCreated"]]
+            prev_day_link_df = self.merge(
+                "merge previous day news", market_link_df, news_link_df, ["newsAssetCodes", "prevDate"],
+                ["assetCodes", "firstCreatedDate"],
+                row_filter=lambda df: df[df["time"] - pd.Timedelta(days=1) < df["firstCreated"]],
+                fan_out_groups=fan_out_groups)
             prev_day_link_df = prev_day_link_df.drop(
-                ["time", "newsAssetCodes", "date", "prevDate"], axis=1, inplace=True)
+                ["time", "newsAssetCodes", "date", "prevDate", "assetCode"], axis=1, inplace=True)
             # prev_day_link_df = prev_day_link_df.drop(["time", "newsAssetCodes", "date", "prevDate"], axis=1)
 
-        del news_link_df
+        del news_link_df, market_link_df
         gc.collect()
 
         if FeatureSetting.should_use_prev_news:
@@ -431,7 +1522,8 @@ class MarketNewsLinker(object):
             del prev_day_link_df
             gc.collect()
 
-        self.market_df = self.market_df.merge(link_df, on=MARKET_ID, how="left", copy=False)
+        self.market_df = self.merge("merge links", self.market_df, link_df, [MARKET_ID], [MARKET_ID], how="left",
+                                    fan_out_groups={"asset": "assetCode", "day": "date"})
         # self.market_df = self.market_df.merge(link_df, on=MARKET_ID, how="left")
         del link_df
         gc.collect()
@@ -448,6 +1540,7 @@ class MarketNewsLinker(object):
         # del prev_day_link_df
         # gc.collect()
 
+    @measure_time
     def aggregate_day_asset_news(self):
         logger.info("aggregating....")
         agg_func_map = {column: "mean" for column in self.market_df.columns.tolist()
@@ -499,16 +1592,32 @@ class MarketNewsLinker(object):
     #             self.market_df[col] = self.market_df[col].astype("float32")
 
     @measure_time
-    def link(self, market_df, news_df, pool=4):
+    def link(self, market_df, news_df, pool=1, links_assetCodes=None):
+        """
+        :param pool: number of processes which link and aggregate date shards of the market rows, capped by the cores
+        of RESOURCES, None for all of them. the date shards are also used with FeatureSetting.link_chunk_memory_budget.
+        """
+        pool = RESOURCES.processes("MarketNewsLinker.link", pool)
+        if pool > 1 or FeatureSetting.link_chunk_memory_budget is not None:
+            self.market_df = self.link_in_date_chunks(market_df, news_df, FeatureSetting.link_chunk_memory_budget,
+                                                      FeatureSetting.link_spill_dir, pool=pool)
+            self.is_aggregated = True
+            return
+        return self._link_unchunked(market_df, news_df, links_assetCodes)
+
+    def _link_unchunked(self, market_df, news_df, links_assetCodes=None):
+        """
+        link all the rows at once in this process. create_new_market_df aggregates them.
+        """
         self.market_df = market_df
         self.news_df = news_df
-        self.pool = pool
+        self.join_traces = []
         self.market_columns = self.market_df.columns.tolist()
         self.datatypes_before_aggregation = {col: t for col, t in zip(self.market_columns, self.market_df.dtypes)}
         self.datatypes_before_aggregation.update(
             {col: t for col, t in zip(self.news_df.columns, self.news_df.dtypes)}
         )
-        self.link_market_assetCode_and_news_assetCodes()
+        self.link_market_assetCode_and_news_assetCodes(links_assetCodes)
 
         self.append_working_date_on_market()
 
@@ -516,17 +1625,128 @@ class MarketNewsLinker(object):
 
     @measure_time
     def create_new_market_df(self):
+        if self.is_aggregated:
+            return self.market_df
         logger.info("updating market df....")
         dropped_columns = ["date", "prevDate", "newsAssetCodes",
                            "assetCodes",
                            "firstCreated", "firstCreatedDate"]
         logger.info(self.market_df.columns)
         self.market_df.drop(dropped_columns, axis=1, inplace=True)
-        self.market_df.sort_values(by=MARKET_ID, inplace=True)
+        # stable sort keeps the order of the news in each market row, which the chunks have to reproduce
+        self.market_df.sort_values(by=MARKET_ID, inplace=True, kind="mergesort")
         self.aggregate_day_asset_news()
         logger.info("linking done")
         return self.market_df
 
+    def split_date_ranges(self, market_df, news_df, memory_budget):
+        """
+        split the market days into ranges whose market rows and news rows fit in memory_budget bytes.
+        the news of a calendar day are counted on the next market day.
+        :return: [(first day, last day), ...]
+        """
+        market_days = market_df["time"].dt.normalize()
+        days = pd.DatetimeIndex(market_days.unique()).sort_values()
+        market_row_bytes = bytes_per_row(market_df)
+        news_row_bytes = bytes_per_row(news_df)
+        market_bytes = market_days.value_counts().reindex(days).values * market_row_bytes
+        news_day_indices = days.searchsorted(news_df["firstCreated"].dt.normalize())
+        news_bytes = np.bincount(news_day_indices, minlength=len(days) + 1)[:len(days)] * news_row_bytes
+
+        date_ranges = []
+        start, chunk_bytes = 0, 0.0
+        for i, day_bytes in enumerate(market_bytes + news_bytes):
+            if i > start and chunk_bytes + day_bytes > memory_budget:
+                date_ranges.append((days[start], days[i - 1]))
+                start, chunk_bytes = i, 0.0
+            chunk_bytes += day_bytes
+        if len(days) > 0:
+            date_ranges.append((days[start], days[-1]))
+        return date_ranges
+
+    def link_date_range(self, market_df, news_df, links_assetCodes, start, end, spill_path=None):
+        """
+        link and aggregate the market rows from start to end with the news from max_day_diff days before start.
+        :return: aggregated data frame, or spill_path where it is pickled
+        """
+        market_days = market_df["time"].dt.normalize()
+        news_days = news_df["firstCreated"].dt.normalize()
+        market_chunk = market_df[(market_days >= start) & (market_days <= end)].copy()
+        news_chunk = news_df[(news_days >= start - pd.Timedelta(days=self.max_day_diff)) & (news_days <= end)].copy()
+        del market_days, news_days
+        with PROFILER.stage("link chunk", inputs=[market_chunk, news_chunk]) as record:
+            self._link_unchunked(market_chunk, news_chunk, links_assetCodes)
+            del market_chunk, news_chunk
+            chunk = self.create_new_market_df()
+            self.clear()
+            record["outputs"] = shapes_of(chunk)
+        if spill_path is None:
+            return chunk
+        spill_path.parent.mkdir(parents=True, exist_ok=True)
+        chunk.to_pickle(str(spill_path))
+        return spill_path
+
+    @measure_time
+    def link_in_date_chunks(self, market_df, news_df, memory_budget=None, spill_dir=None, pool=1):
+        """
+        link and aggregate date ranges of the market rows with the news of the range and max_day_diff days before it.
+        the result is the same as link and create_new_market_df over the whole data.
+        :param memory_budget: bytes of the market and news rows of a date range, None for splitting into pool ranges
+        :param spill_dir: directory where the aggregated chunks are pickled until they are copied into the output
+        :param pool: number of processes. the workers are forked (so pool > 1 needs a platform with fork) and read the
+        inputs from the memory shared with this process instead of a pickled copy each.
+        """
+        if memory_budget is None:
+            memory_budget = (bytes_per_row(market_df) * len(market_df) +
+                             bytes_per_row(news_df) * len(news_df)) / max(pool, 1)
+        links_assetCodes = self.create_asset_code_links(market_df, news_df)
+        date_ranges = self.split_date_ranges(market_df, news_df, memory_budget)
+        spill_paths = [None if spill_dir is None else Path(spill_dir) / "link_chunk_{}.pkl".format(i)
+                       for i in range(len(date_ranges))]
+        logger.info("linking in %d date chunks with %d processes", len(date_ranges), pool)
+
+        # the aggregated rows are indexed by the sorted market ids, which are filled chunk by chunk
+        market_ids = np.sort(market_df[MARKET_ID].unique())
+        shards = [(start, end, spill_path) for (start, end), spill_path in zip(date_ranges, spill_paths)]
+        if pool > 1 and len(date_ranges) > 1:
+            global LINK_SHARD_INPUTS
+            LINK_SHARD_INPUTS = (self, market_df, news_df, links_assetCodes)
+            try:
+                with RESOURCES.process_pool("MarketNewsLinker.link", min(pool, len(date_ranges)),
+                                            fork=True) as process_pool:
+                    return self.fill_linked_chunks(market_ids, process_pool.imap(link_date_shard, shards, chunksize=1))
+            finally:
+                LINK_SHARD_INPUTS = None
+        chunks = (self.link_date_range(market_df, news_df, links_assetCodes, start, end, spill_path)
+                  for start, end, spill_path in shards)
+        return self.fill_linked_chunks(market_ids, chunks)
+
+    @staticmethod
+    def fill_linked_chunks(market_ids, chunks):
+        """
+        copy the aggregated chunks into a data frame of market_ids allocated from the first chunk,
+        so that only the output and one chunk are held at once.
+        :param chunks: iterable of aggregated data frames or paths where they are pickled
+        """
+        linked_df = None
+        for chunk in chunks:
+            if isinstance(chunk, Path):
+                chunk = pd.read_pickle(str(chunk))
+            if linked_df is None:
+                # repeating the first row gives the columns with their dtypes, categories and time zones
+                linked_df = chunk.iloc[np.zeros(len(market_ids), dtype="int64")]
+                linked_df.index = pd.Index(market_ids, name=chunk.index.name)
+            positions = market_ids.searchsorted(chunk.index.values)
+            for i, (col, dtype) in enumerate(zip(chunk.columns, chunk.dtypes)):
+                if dtype != linked_df.dtypes.iloc[i]:
+                    # e.g. an integer column which has no missing values only in some chunks
+                    linked_df[col] = linked_df[col].astype(np.result_type(linked_df.dtypes.iloc[i], dtype)
+                                                           if isinstance(dtype, np.dtype) else object)
+                linked_df.iloc[positions, i] = chunk[col].array
+            del chunk
+            gc.collect()
+        return linked_df
+
     #
     # def full_fill_new_columns(self, old_columns, new_columns):
     #     for col in set(new_columns) - set(old_columns):
@@ -549,6 +1769,18 @@ class MarketNewsLinker(object):
         self.news_df = None
         self.market_columns = None
         self.datatypes_before_aggregation = None
+        self.is_aggregated = False
+
+
+# (linker, market_df, news_df, links_assetCodes) inherited by the forked processes of link_in_date_chunks.
+# only fork copies it into the workers, so their pool is started with fork whatever the default start method is
+LINK_SHARD_INPUTS = None
+
+
+def link_date_shard(shard):
+    start, end, spill_path = shard
+    linker, market_df, news_df, links_assetCodes = LINK_SHARD_INPUTS
+    return linker.link_date_range(market_df, news_df, links_assetCodes, start, end, spill_path)
 
 
 def compress_dtypes(news_df):
@@ -612,33 +1844,239 @@ def load_train_dfs():
     return env, market_train_df, news_train_df
 
 
-class TorchDataset(Dataset):
-    def __init__(self, matrix, labels, transformers=None):
-        self._matrix = matrix
-        self._labels = labels
-        self._transformers = transformers
-        self.n_features = matrix.shape[-1]
-
-    def __getitem__(self, index):
-        item = self._matrix[index, :]
-        if self._transformers is None:
-            return item, torch.Tensor(self._labels[index:index + 1])
-        return self._transformers(item), torch.Tensor(self._labels[index:index + 1])
-
-    def __len__(self):
-        return self._matrix.shape[0]
+BACKEND_MODULES = {"lgb": [lgb], "mlp": [torch, nn, optim], "sparse_mlp": [keras]}
+# classes which inherit classes of the backend dependencies are defined by load_backend
+BACKEND_CLASSES = {"TorchDataset": "mlp", "TorchDataLoader": "mlp", "BaseMLPClassifier": "mlp",
+                   "TfDataGenerator": "sparse_mlp", "LinkedFeatureSequence": "lgb"}
 
 
-class TorchDataLoader(DataLoader):
-
-    def __init__(self, dataset: TorchDataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
-                 num_workers=0,
-                 collate_fn=default_collate, pin_memory=False, drop_last=False, timeout=0, worker_init_fn=None):
-        super().__init__(dataset, batch_size, shuffle, sampler, batch_sampler, num_workers, collate_fn, pin_memory,
-                         drop_last, timeout, worker_init_fn)
-
-    def __len__(self):
-        return len(self.dataset)
+def load_backend(model_type):
+    """
+    import the dependencies of the model type and define the classes inheriting their classes.
+    """
+    if model_type not in BACKEND_MODULES:
+        raise ValueError("unknown model type: {}".format(model_type))
+    for module in BACKEND_MODULES[model_type]:
+        module.load()
+    if model_type == "mlp":
+        define_torch_classes()
+    elif model_type == "sparse_mlp":
+        define_keras_classes()
+    elif model_type == "lgb":
+        define_lgb_classes()
+
+
+def register_backend_classes(*classes):
+    for cls in classes:
+        cls.__qualname__ = cls.__name__
+        globals()[cls.__name__] = cls
+
+
+def define_torch_classes():
+    if "BaseMLPClassifier" in globals():
+        return
+
+    class TorchDataset(torch.utils.data.Dataset):
+        def __init__(self, matrix, labels, transformers=None):
+            self._matrix = matrix
+            self._labels = labels
+            self._transformers = transformers
+            self.n_features = matrix.shape[-1]
+
+        def __getitem__(self, index):
+            item = self._matrix[index, :]
+            if self._transformers is None:
+                return item, torch.Tensor(self._labels[index:index + 1])
+            return self._transformers(item), torch.Tensor(self._labels[index:index + 1])
+
+        def __len__(self):
+            return self._matrix.shape[0]
+
+
+    class TorchDataLoader(torch.utils.data.DataLoader):
+
+        def __init__(self, dataset: TorchDataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
+                     num_workers=0,
+                     collate_fn=torch.utils.data.dataloader.default_collate, pin_memory=False, drop_last=False, timeout=0, worker_init_fn=None):
+            super().__init__(dataset, batch_size, shuffle, sampler, batch_sampler, num_workers, collate_fn, pin_memory,
+                             drop_last, timeout, worker_init_fn)
+
+        def __len__(self):
+            return len(self.dataset)
+
+    class BaseMLPClassifier(nn.Module):
+
+        def __init__(self, fc_layer_params: list):
+            super().__init__()
+            layers = [
+                nn.Sequential(
+                    nn.Linear(**params),
+                    nn.BatchNorm1d(params["out_features"]),
+                    nn.ReLU(),
+                    nn.Dropout(0.4)
+                )
+                for i, params in enumerate(fc_layer_params[:-1])
+            ]
+            for layer in layers:
+                layer.apply(self.init_weights)
+
+            self.fc_layers = nn.Sequential(*layers)
+            self.output_layer = nn.Linear(**fc_layer_params[-1])
+            # if self.output_layer.out_features == 1:
+            self.sigmoid = nn.Sigmoid()
+
+        @staticmethod
+        def init_weights(m):
+            if isinstance(m, nn.Linear):
+                nn.init.xavier_uniform(m.weight.data)
+                m.bias.data.zero_()
+
+        def forward(self, x):
+            out = self.fc_layers(x)
+            out = self.output_layer(out)
+            # if self.output_layer.out_features == 1:
+            out = self.sigmoid(out)
+            # out = self.softmax(out)
+            return out
+
+        # # self.softmax = nn.Softmax()
+
+    register_backend_classes(TorchDataset, TorchDataLoader, BaseMLPClassifier)
+
+
+def define_keras_classes():
+    if "TfDataGenerator" in globals():
+        return
+
+    class TfDataGenerator(keras.utils.Sequence):
+
+        def __init__(self, list_of_indices, features: Features, labels, batch_size=200):
+            self.list_of_indices = list_of_indices
+            # print(list_of_indices)
+            self.features = features
+            self.labels = labels
+            self.batch_size = batch_size
+            self.n_samples = len(self.list_of_indices)
+            self.n_batches = self.n_samples // self.batch_size + int(bool(self.n_samples % self.batch_size))
+            self._current_batch_num = 0
+
+        # def __next__(self):
+        #     while True:
+        #         start = self._current_batch_num * self.batch_size
+        #         if self._current_batch_num < self.n_batches - 1:
+        #             end = (self._current_batch_num + 1) * self.batch_size
+        #             yield self.features.get_linked_feature_matrix(self.list_of_indices[start:end]), self.labels[start:end]
+        #             self._current_batch_num += 1
+        #         else:
+        #             yield self.features.get_linked_feature_matrix(self.list_of_indices[start:]), self.labels[start:]
+        #             self._current_batch_num = 0
+
+        def __len__(self):
+            return self.n_batches
+
+        def __getitem__(self, index):
+            'Generate one batch of data'
+            # Generate indexes of the batch
+
+            start = index * self.batch_size
+
+            if index < self.n_batches - 1:
+                end = (index + 1) * self.batch_size
+                return self.features.get_linked_feature_matrix(
+                    self.list_of_indices[start:end], market_indices=list(range(start, end)),
+                    dequantize=True), self.labels[start:end]
+                # index += 1
+            else:
+                return self.features.get_linked_feature_matrix(self.list_of_indices[start:],
+                                                               market_indices=list(
+                                                                   range(start, len(self.list_of_indices))),
+                                                               dequantize=True), \
+                       self.labels[start:]
+                # index = 0
+
+        def on_epoch_end(self):
+            pass
+
+    register_backend_classes(TfDataGenerator)
+
+
+def define_lgb_classes():
+    if "LinkedFeatureSequence" in globals():
+        return
+
+    class LinkedFeatureSequence(lgb.Sequence):
+        """
+        rows of the linked feature matrix for lgb.Dataset, which are produced shard by shard from the news links.
+        only the last shard is kept in memory, so the whole matrix never is. the shard stays float32 and only the
+        requested rows are converted to the float64 which lgb.Dataset reads from a Sequence.
+        """
+
+        def __init__(self, features: Features, market_indices, list_of_indices=None, batch_size=100000):
+            self.features = features
+            self.market_indices = np.asarray(market_indices)
+            self.list_of_indices = list_of_indices
+            self.batch_size = batch_size
+            self._shard_id = None
+            self._shard = None
+
+        def __len__(self):
+            return len(self.market_indices)
+
+        def shard(self, shard_id):
+            if shard_id != self._shard_id:
+                start, end = shard_id * self.batch_size, min((shard_id + 1) * self.batch_size, len(self))
+                self._shard = self.features.get_dense_feature_rows(
+                    self.market_indices[start:end],
+                    None if self.list_of_indices is None else self.list_of_indices[start:end])
+                self._shard_id = shard_id
+            return self._shard
+
+        def __getitem__(self, idx):
+            if isinstance(idx, (int, np.integer)):
+                if idx < 0:
+                    idx += len(self)
+                return self.shard(idx // self.batch_size)[idx % self.batch_size].astype("float64")
+            indices = np.arange(len(self))[idx]
+            shard_ids = indices // self.batch_size
+            return np.vstack([self.shard(shard_id)[indices[shard_ids == shard_id] % self.batch_size]
+                              for shard_id in np.unique(shard_ids)]).astype("float64")
+
+    register_backend_classes(LinkedFeatureSequence)
+
+
+_IMPORT_PROFILE_SCRIPT = """
+import importlib, json, os, sys, time
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+start, start_rss = time.perf_counter(), rss()
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+print(json.dumps({"seconds": time.perf_counter() - start, "rss_bytes": rss() - start_rss}))
+"""
+
+
+def profile_backend_imports(model_types=None):
+    """
+    import the dependencies of each backend in a new interpreter and report the import time and RSS growth.
+    "core" is the dependencies imported by every model type.
+    """
+    modules = {"core": ["numpy", "pandas", "scipy.sparse", "sklearn.compose", "sklearn.pipeline"]}
+    modules.update({model_type: [module._name for module in BACKEND_MODULES[model_type]]
+                    for model_type in (model_types or BACKEND_MODULES.keys())})
+    profile = {}
+    for model_type, names in modules.items():
+        try:
+            output = subprocess.check_output([sys.executable, "-c", _IMPORT_PROFILE_SCRIPT] + names,
+                                             stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            logger.warning("backend %s can not be imported", model_type)
+            profile[model_type] = None
+            continue
+        profile[model_type] = json.loads(output.decode("utf-8").strip().split("\n")[-1])
+        logger.info("backend %s: import %.3f sec, %.1f MB", model_type, profile[model_type]["seconds"],
+                    profile[model_type]["rss_bytes"] / 1e6)
+    return profile
 
 
 def create_data_loader(matrix: Union[np.ndarray, sparse.coo_matrix, sparse.csr_matrix],
@@ -669,46 +2107,12 @@ def create_data_loader(matrix: Union[np.ndarray, sparse.coo_matrix, sparse.csr_m
     return TorchDataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
 
 
-class BaseMLPClassifier(nn.Module):
-
-    def __init__(self, fc_layer_params: list):
-        super().__init__()
-        layers = [
-            nn.Sequential(
-                nn.Linear(**params),
-                nn.BatchNorm1d(params["out_features"]),
-                nn.ReLU(),
-                nn.Dropout(0.4)
-            )
-            for i, params in enumerate(fc_layer_params[:-1])
-        ]
-        for layer in layers:
-            layer.apply(self.init_weights)
-
-        self.fc_layers = nn.Sequential(*layers)
-        self.output_layer = nn.Linear(**fc_layer_params[-1])
-        # if self.output_layer.out_features == 1:
-        self.sigmoid = nn.Sigmoid()
-
-    @staticmethod
-    def init_weights(m):
-        if isinstance(m, nn.Linear):
-            nn.init.xavier_uniform(m.weight.data)
-            m.bias.data.zero_()
-
-    def forward(self, x):
-        out = self.fc_layers(x)
-        out = self.output_layer(out)
-        # if self.output_layer.out_features == 1:
-        out = self.sigmoid(out)
-        # out = self.softmax(out)
-        return out
-
-    # # self.softmax = nn.Softmax()
-
-
 class BaseMLPTrainer(object):
-    def __init__(self, model, loss_function, score_function, optimizer_factory):
+    def __init__(self, model, loss_function, score_function, optimizer_factory, epoch_end_hook=None):
+        """
+        :param epoch_end_hook: function(epoch, logs) called after the validation of every epoch, like
+        CompetitionMetric.epoch_end_hook
+        """
         self.model: nn.Module = model
         # self.loss_function = nn.BCELoss()
         self.loss_function = loss_function
@@ -730,6 +2134,7 @@ class BaseMLPTrainer(object):
         self._early_stop_count = 0
 
         self.save_name = "twosigma.model"
+        self.epoch_end_hook = epoch_end_hook
 
     def train(self, train_data_loader, valid_data_loader, n_epochs):
         self.clear_history()
@@ -741,13 +2146,17 @@ class BaseMLPTrainer(object):
         logger.info("train with: {}".format(self.train_data_loader.dataset._matrix.shape))
         logger.info("valid with: {}".format(self.valid_data_loader.dataset._matrix.shape))
 
-        iterator = tqdm(range(n_epochs))
+        iterator = tqdm.tqdm(range(n_epochs))
         for epoch in iterator:
             self._current_epoch = epoch + 1
             logger.info("training %d epoch / n_epochs", self._current_epoch)
 
             self._train_epoch()
             self._valid_epoch()
+            if self.epoch_end_hook is not None:
+                self.epoch_end_hook(self._current_epoch, {"loss": self.train_losses[-1],
+                                                          "val_loss": self.valid_losses[-1],
+                                                          "val_score": self.valid_scores[-1]})
 
             if self.valid_scores[-1] <= self._current_max_valid_score:
                 self._early_stop_count += 1
@@ -835,9 +2244,40 @@ class BaseMLPTrainer(object):
 
 
 class MLPWrapper(ModelWrapper):
+    # SGD steps of an incremental update
+    UPDATE_STEPS = 20
+    UPDATE_BATCH_SIZE = 1024
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.update_optimizer = None
+        self.train_data_loader = None
+        self.valid_data_loader = None
+        # validation rows for the competition score of each epoch
+        self.valid_matrix = None
+
+    def update(self, x, y, time_budget):
+        deadline = perf_counter() + time_budget
+        if self.update_optimizer is None:
+            self.update_optimizer = optim.SGD(self.model.parameters(), lr=1e-4)
+        if sparse.issparse(x):
+            x = x.toarray()
+        x = torch.from_numpy(np.asarray(x, dtype="float32"))
+        y = torch.from_numpy(np.asarray(y, dtype="float32").reshape((-1, 1)))
+        loss_function = nn.BCELoss()
+
+        self.model.train()
+        for step in range(self.UPDATE_STEPS):
+            if perf_counter() > deadline:
+                break
+            batch = torch.from_numpy(np.random.randint(0, len(y), min(self.UPDATE_BATCH_SIZE, len(y))))
+            self.update_optimizer.zero_grad()
+            loss = loss_function(self.model(x[batch]), y[batch])
+            loss.backward()
+            self.update_optimizer.step()
+        self.model.eval()
+        logger.info("mlp model is updated with %d steps on %d rows", step + 1, len(y))
+        return self
 
     def predict(self, x: Union[np.ndarray, sparse.spmatrix]):
         logger.info("predicting %d samples...".format(x.shape[0]))
@@ -848,6 +2288,7 @@ class MLPWrapper(ModelWrapper):
         return self.model(x).detach().numpy().reshape((-1))
 
     def train(self, **kwargs):
+        torch.set_num_threads(RESOURCES.threads("MLPWrapper"))
         classes = 1
         model = BaseMLPClassifier(
             [{"in_features": self.train_data_loader.dataset.n_features, "out_features": 128, "bias": True},
@@ -861,24 +2302,32 @@ class MLPWrapper(ModelWrapper):
             return roc_auc_score(labels, predicted)
 
         optimizer_factory = lambda model: optim.Adam(model.parameters(), lr=1e-3, weight_decay=0.0001)
+        # predict uses self.model, which the hook calls on the model being trained
+        self.model = model
+        epoch_end_hook = None
+        if self.valid_metric is not None:
+            epoch_end_hook = self.valid_metric.epoch_end_hook(self.predict, self.valid_matrix)
         trainer = BaseMLPTrainer(model, loss_function=nn.BCELoss(),
                                  score_function=score_function,
-                                 optimizer_factory=optimizer_factory)
+                                 optimizer_factory=optimizer_factory,
+                                 epoch_end_hook=epoch_end_hook)
 
         trainer.train(self.train_data_loader, self.valid_data_loader, 50)
 
-        self.model = model
         return self
 
     def create_dataset(self, market_train, features, train_batch_size, valid_batch_size):
-        feature_names, market_obs_ids, market_train, labels = ModelWrapper.to_x_y(market_train)
-        logger.info("concatenating train x....")
-        market_train = market_train.astype("float32")
-        if is_not_empty(features):
-            features = features.astype("float32")
-            market_train = sparse.hstack([market_train, features], format="csr")
+        """
+        :param features: the linked feature matrix, or Features to link the rows of market_train
+        """
+        labels, market_obs_ids = ModelWrapper.to_x_y(market_train)
+        self.set_valid_metric(market_train, train_size=0.8)
+        if isinstance(features, Features):
+            logger.info("linking train x....")
+            features = features.get_linked_feature_matrix(market_train, market_indices=market_obs_ids.values,
+                                                          dequantize=not self.accepts_binned_features)
         market_train, valid_matrix, labels, valid_labels, = ModelWrapper.split_train_validation(
-            market_train,
+            features,
             labels,
             train_size=0.8)
         logger.info("creating torch dataset....")
@@ -887,6 +2336,7 @@ class MLPWrapper(ModelWrapper):
         self.train_data_loader = create_data_loader(market_train, labels, batch_size=train_batch_size, shuffle=True)
         self.valid_data_loader = create_data_loader(valid_matrix, valid_labels, batch_size=valid_batch_size,
                                                     shuffle=True)
+        self.valid_matrix = valid_matrix
         logger.info("torch dataset is created!")
         return None, None
 
@@ -951,24 +2401,41 @@ class MarketPreprocess(Preprocess):
         if FeatureSetting.since is not None:
             transformers.append(DateFilterTransformer(FeatureSetting.since, "time"))
 
+        lag_transformer = LagAggregationTransformer(lags=[3, 5, 10], shift_size=1, scale=True)
+        self.id_appender = IdAppender(MARKET_ID)
+        self.lag_transformer = lag_transformer
         transformers.extend([
-            IdAppender(MARKET_ID),
+            self.id_appender,
             ConfidenceAppender(),
-            LagAggregationTransformer(lags=[3, 5, 10], shift_size=1, scale=True, n_pool=3)
+            lag_transformer
         ])
 
         self.pipeline: UnionFeaturePipeline = UnionFeaturePipeline(
-            *transformers
+            *transformers, n_jobs=2
         )
+        self.row_pruner = RowPruningTransformer(universe_only=FeatureSetting.should_prune_non_universe,
+                                                drop_date_ranges=FeatureSetting.drop_date_ranges,
+                                                n_context_rows=max(lag_transformer.lags) + lag_transformer.shift_size)
 
     def fit_transform(self, df: pd.DataFrame):
         df = super().fit_transform(df)
-        return self.pipeline.transform(df, include_sparse=False)[0]
+        # the pruned rows are a part of the lag windows of the prediction days
+        self.lag_transformer.update_history(df)
+        df = self.row_pruner.transform(df)
+        df = self.pipeline.transform(df, include_sparse=False)[0]
+        return self.row_pruner.drop_lag_context(df)
 
     def transform(self, df: pd.DataFrame):
         df = super().transform(df)
         return self.pipeline.transform(df, include_sparse=False)[0]
 
+    def transform_next(self, df: pd.DataFrame):
+        """
+        transform the rows of a new day with the lag history kept by the lag transformer. the row order is kept.
+        """
+        df = super().transform(df.reset_index(drop=True))
+        return self.lag_transformer.transform_next(self.id_appender.transform(df))
+
 
 class NewsPreprocess(Preprocess):
     # COLUMNS_SCALED = [
@@ -1004,6 +2471,8 @@ class NewsPreprocess(Preprocess):
 
         if FeatureSetting.since is not None:
             transformers.append(DateFilterTransformer(FeatureSetting.since, "firstCreated"))
+        if FeatureSetting.should_collapse_news_takes:
+            transformers.append(LatestTakeTransformer(keep_take_count=FeatureSetting.keep_take_count))
         transformers.append(IdAppender(NEWS_ID))
         self.pipeline: UnionFeaturePipeline = UnionFeaturePipeline(
             *transformers
@@ -1096,6 +2565,74 @@ class TahnEstimators(BaseEstimator, TransformerMixin):
         return 0.5 * (np.tanh(0.01 * (to_2d_array(X) - self.mean_) / self.std_) + 1)
 
 
+class QuantileBinner(BaseEstimator, TransformerMixin):
+    """
+    encode each feature into uint8 quantile bin codes.
+    the edges are learned on a row sample and bin_values_ (mean of the sampled values in each bin)
+    is the lookup table for dequantize. NaN is encoded as NAN_CODE.
+    """
+    NAN_CODE = 255
+
+    def __init__(self, n_bins=200, sample_size=200000, random_state=10):
+        if n_bins >= self.NAN_CODE:
+            raise ValueError("n_bins should be less than {}".format(self.NAN_CODE))
+        self.n_bins = n_bins
+        self.sample_size = sample_size
+        self.random_state = random_state
+        self.edges_ = None
+        self.bin_values_ = None
+
+    def fit(self, X, y=None):
+        X = self._to_dense(X)
+        if X.shape[0] > self.sample_size:
+            X = X[np.random.RandomState(self.random_state).choice(X.shape[0], self.sample_size, replace=False)]
+        quantiles = np.linspace(0, 1, self.n_bins + 1)[1:-1]
+        self.edges_ = []
+        self.bin_values_ = np.full((X.shape[1], self.NAN_CODE + 1), np.nan, dtype="float32")
+        for i in range(X.shape[1]):
+            column = X[:, i].astype("float64")
+            column = column[~np.isnan(column)]
+            if len(column) == 0:
+                self.edges_.append(np.empty(0))
+                continue
+            edges = np.unique(np.quantile(column, quantiles))
+            self.edges_.append(edges)
+
+            n_codes = len(edges) + 1
+            codes = np.searchsorted(edges, column, side="right")
+            counts = np.bincount(codes, minlength=n_codes)
+            sums = np.bincount(codes, weights=column, minlength=n_codes)
+            lower_edges = np.concatenate([edges[:1], edges])
+            self.bin_values_[i, :n_codes] = np.where(counts > 0, sums / np.maximum(counts, 1), lower_edges)
+        return self
+
+    def transform(self, X):
+        X = self._to_dense(X)
+        codes = np.empty(X.shape, dtype="uint8")
+        for i, edges in enumerate(self.edges_):
+            column = X[:, i]
+            codes[:, i] = np.searchsorted(edges, column, side="right")
+            codes[np.isnan(column), i] = self.NAN_CODE
+        return codes
+
+    def dequantize(self, codes):
+        return self.bin_values_[np.arange(codes.shape[1]), codes]
+
+    def codes_with_nan(self, codes):
+        """
+        float32 codes with NaN for NAN_CODE, which lightgbm would take as the largest bin instead of a missing value.
+        """
+        codes = codes.astype("float32")
+        codes[codes == self.NAN_CODE] = np.nan
+        return codes
+
+    @staticmethod
+    def _to_dense(X):
+        if sparse.issparse(X):
+            return X.toarray()
+        return np.asarray(X)
+
+
 class Features(object):
     # @staticmethod
     # def post_merge_feature_extraction(features, market_train_df):
@@ -1130,6 +2667,9 @@ class Features(object):
         # self.news_feature_names = None
         self.market_transformer = MarketFeatureTransformer()
         self.news_transformer = NewsFeatureTransformer()
+        # the pipelines drop the raw columns as soon as the transformers have encoded them
+        self.market_pipeline = UnionFeaturePipeline(self.market_transformer)
+        self.news_pipeline = UnionFeaturePipeline(self.news_transformer)
 
     def fit(self, market_train_df: pd.DataFrame, news_train_df: pd.DataFrame):
         self.market_transformer.fit(market_train_df)
@@ -1139,12 +2679,18 @@ class Features(object):
 
     def transform(self, market_train_df: pd.DataFrame, news_train_df: pd.DataFrame):
         logger.info("transforming into feature")
-        return self.market_transformer.transform(market_train_df), self.news_transformer.transform(news_train_df)
+        return self.transform_market(market_train_df), self.transform_news(news_train_df)
+
+    def transform_market(self, market_df: pd.DataFrame):
+        return self.market_pipeline.transform(market_df, include_sparse=False)[0]
+
+    def transform_news(self, news_df: pd.DataFrame):
+        return self.news_pipeline.transform(news_df, include_sparse=False)[0]
 
     def fit_transform(self, market_train_df: pd.DataFrame, news_train_df: pd.DataFrame):
         return self.fit(market_train_df, news_train_df).transform(market_train_df, news_train_df)
 
-    def get_linked_feature_matrix(self, link_df, market_indices=None):
+    def get_linked_feature_matrix(self, link_df, market_indices=None, dequantize=False):
         # print(link_df)
         link_df, news_feature_matrix = self.news_transformer.post_link_transform(link_df)
         # return sparse.hstack([self.market_transformer.feature_matrix, news_feature_matrix], dtype="float32",
@@ -1154,7 +2700,45 @@ class Features(object):
         if market_indices is None and isinstance(link_df, pd.DataFrame):
             market_indices = link_df[MARKET_ID].tolist()
 
-        return np.hstack([self.market_transformer.feature_matrix[market_indices], news_feature_matrix])
+        market_feature_matrix = self.get_market_rows(market_indices, dequantize)
+        # the news aggregate is a csr matrix, and the rows are dense as in get_dense_feature_rows
+        return np.hstack([market_feature_matrix, news_feature_matrix.toarray()])
+
+    def get_market_rows(self, market_indices, dequantize=False):
+        """
+        rows of the market feature matrix. the bin codes are dequantized, or given NaN for the missing values.
+        """
+        market_feature_matrix = self.market_transformer.feature_matrix[market_indices]
+        binner = self.market_transformer.binner
+        if binner is None:
+            return market_feature_matrix
+        if dequantize:
+            return binner.dequantize(market_feature_matrix)
+        return binner.codes_with_nan(market_feature_matrix)
+
+    def get_dense_feature_rows(self, market_indices, list_of_indices=None):
+        """
+        dense float32 rows of the linked feature matrix. market features stay bin codes as in the feature matrix,
+        with NaN for the missing values.
+        :param list_of_indices: news ids linked to each row, None for the market features only
+        """
+        rows = [self.get_market_rows(market_indices).astype("float32")]
+        if list_of_indices is not None:
+            _, news_feature_matrix = self.news_transformer.post_link_transform(list(list_of_indices))
+            rows.append(news_feature_matrix.toarray())
+        return np.hstack(rows)
+
+    def fingerprint(self, market_indices, list_of_indices=None):
+        """
+        hash of the rows of get_dense_feature_rows, computed from the feature matrices and the links without
+        building the rows.
+        """
+        arrays = [self.market_transformer.feature_matrix, np.asarray(market_indices)]
+        if list_of_indices is not None:
+            arrays += [self.news_transformer.feature_matrix,
+                       np.array([len(indices) for indices in list_of_indices], dtype="int64"),
+                       np.array(list(itertools.chain.from_iterable(list_of_indices)), dtype="float64")]
+        return FeatureStore.hash_arrays(arrays), FeatureStore.setting_fingerprint()
 
     def clear(self):
         self.market_transformer.clear()
@@ -1164,12 +2748,131 @@ class Features(object):
         return self.market_transformer.feature_matrix.shape[1] + self.news_transformer.feature_matrix.shape[1]
 
 
-def log_object_sizes():
-    for memory_info in ["{}: {}".format(v, sys.getsizeof(eval(v)) / 1000000000) for v in dir()]:
-        logger.info(memory_info)
+def has_inspectable_attributes(obj):
+    return hasattr(obj, "__dict__") and not (
+            isinstance(obj, (type, types.ModuleType, LazyModule)) or inspect.isroutine(obj))
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    bytes of obj including the payloads of data frames, numpy arrays, sparse matrices and tensors.
+    objects already in seen are not counted again.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True, index=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) if obj.base is None else obj.nbytes
+    if sparse.issparse(obj):
+        return sys.getsizeof(obj) + sum(getattr(obj, name).nbytes
+                                        for name in ["data", "indices", "indptr", "row", "col", "offsets"]
+                                        if isinstance(getattr(obj, name, None), np.ndarray))
+    if hasattr(obj, "element_size") and hasattr(obj, "nelement"):
+        return sys.getsizeof(obj) + obj.element_size() * obj.nelement()
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(deep_sizeof(key, seen) + deep_sizeof(value, seen)
+                                        for key, value in list(obj.items()))
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(deep_sizeof(item, seen) for item in list(obj))
+    if has_inspectable_attributes(obj):
+        return sys.getsizeof(obj) + deep_sizeof(vars(obj), seen)
+    return sys.getsizeof(obj)
+
+
+class MemoryInspector(object):
+    """
+    report deep byte sizes of live pipeline objects and their attributes.
+    report can be called at any stage, and start runs it periodically in a background thread.
+    """
+
+    def __init__(self, depth=2, min_bytes=1000000, **objects):
+        self.depth = depth
+        self.min_bytes = min_bytes
+        self.objects = objects
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add(self, name, obj):
+        self.objects[name] = obj
+        return self
+
+    def remove(self, name):
+        self.objects.pop(name, None)
+        return self
+
+    @staticmethod
+    def _children(obj):
+        if isinstance(obj, dict):
+            return [(str(key), value) for key, value in list(obj.items())]
+        if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray)) or sparse.issparse(obj):
+            return []
+        if has_inspectable_attributes(obj):
+            return list(vars(obj).items())
+        return []
+
+    def inspect(self):
+        """
+        :return: list of (attribute path, bytes) with depth first order
+        """
+        sizes = []
+
+        def walk(path, obj, depth):
+            sizes.append((path, deep_sizeof(obj)))
+            if depth > 0:
+                for name, child in self._children(obj):
+                    walk("{}.{}".format(path, name), child, depth - 1)
+
+        for name, obj in list(self.objects.items()):
+            walk(name, obj, self.depth)
+        return sizes
+
+    def report(self, label=""):
+        logger.info("memory report %s: rss %.3f GB", label, get_rss_bytes() / 1e9)
+        sizes = self.inspect()
+        for path, size in sizes:
+            if size >= self.min_bytes:
+                logger.info("  %s: %.3f GB", path, size / 1e9)
+        return sizes
+
+    def start(self, interval=60.0):
+        if self._thread is not None:
+            return self
+        self._stop_event.clear()
+
+        def run():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.report("(timer)")
+                except Exception as e:
+                    # objects can be mutated by the main thread while they are measured
+                    logger.warning("memory report failed: %s", e)
+
+        self._thread = threading.Thread(target=run, name="memory-inspector", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
 
 
 class FeatureTransformer(metaclass=ABCMeta):
+    # columns read by transform. None means the whole data frame is read and rows may be changed
+    input_columns = None
+    # columns added by transform
+    output_columns = ()
+    # input columns which are not used after this transformer
+    release_columns = ()
+
     @abstractmethod
     def transform(self, df):
         pass
@@ -1200,12 +2903,15 @@ class DfTransformer(FeatureTransformer):
 
 
 class DropColumnsTransformer(NullTransformer):
+    input_columns = []
 
     def __init__(self, columns):
         self.columns = columns
+        self.release_columns = columns
 
     def transform(self, df):
-        df.drop(self.columns, axis=1, inplace=True)
+        # in UnionFeaturePipeline, the columns are released by the pipeline after their last reader
+        df.drop([col for col in self.columns if col in df.columns], axis=1, inplace=True)
         gc.collect()
 
 
@@ -1223,22 +2929,172 @@ class DateFilterTransformer(DfTransformer):
         pass
 
 
+class RowPruningTransformer(DfTransformer):
+    """
+    drop training rows with universe == 0 and rows in drop_date_ranges.
+    the previous n_context_rows rows of each kept row in the same asset are kept with LAG_CONTEXT flag
+    so that lag windows are not changed. they should be removed by drop_lag_context after the lag extraction.
+    """
+    LAG_CONTEXT = "isLagContext"
+
+    def __init__(self, universe_only=True, drop_date_ranges=None, n_context_rows=0, column="time"):
+        self.universe_only = universe_only
+        self.drop_date_ranges = drop_date_ranges
+        self.n_context_rows = n_context_rows
+        self.column = column
+
+    def transform(self, df):
+        keep = np.ones(len(df), dtype=bool)
+        if self.universe_only and "universe" in df.columns:
+            keep &= df["universe"].values == 1
+        if self.drop_date_ranges:
+            times = df[self.column]
+            for start, end in self.drop_date_ranges:
+                start, end = pd.Timestamp(start, tz=times.dt.tz), pd.Timestamp(end, tz=times.dt.tz)
+                keep &= ~((times >= start) & (times <= end)).values
+
+        asset_codes, _ = pd.factorize(df["assetCode"])
+        orders = np.lexsort((df[self.column].values, asset_codes))
+        sorted_keep = keep[orders]
+        sorted_codes = asset_codes[orders]
+        sorted_context = np.zeros(len(df), dtype=bool)
+        for shift in range(1, min(self.n_context_rows, len(df) - 1) + 1):
+            sorted_context[:-shift] |= sorted_keep[shift:] & (sorted_codes[:-shift] == sorted_codes[shift:])
+        context = np.zeros(len(df), dtype=bool)
+        context[orders] = sorted_context & ~sorted_keep
+
+        logger.info("rows pruned from %d to %d (+%d lag context rows)", len(df), keep.sum(), context.sum())
+        selected = keep | context
+        df = df[selected].reset_index(drop=True)
+        df[self.LAG_CONTEXT] = context[selected]
+        return df
+
+    def drop_lag_context(self, df):
+        if self.LAG_CONTEXT not in df.columns:
+            return df
+        df = df[~df[self.LAG_CONTEXT].values].reset_index(drop=True)
+        df.drop([self.LAG_CONTEXT], axis=1, inplace=True)
+        if MARKET_ID in df.columns:
+            df[MARKET_ID] = df.index.astype("int32")
+        return df
+
+    def release_raw_field(self, df):
+        pass
+
+    def fit_transform(self, df):
+        return self.transform(df)
+
+
+class LatestTakeTransformer(DfTransformer):
+    """
+    keep only the latest take (max takeSequence) of each sourceId.
+    the number of takes of each story is kept as TAKE_COUNT if keep_take_count is True.
+    """
+    TAKE_COUNT = "takeCount"
+
+    def __init__(self, keep_take_count=True):
+        self.keep_take_count = keep_take_count
+
+    def transform(self, df):
+        source_codes, _ = pd.factorize(df["sourceId"])
+        orders = np.lexsort((df["takeSequence"].values, source_codes))
+        sorted_codes = source_codes[orders]
+        is_last = np.ones(len(orders), dtype=bool)
+        is_last[:-1] = sorted_codes[1:] != sorted_codes[:-1]
+        last_positions = np.flatnonzero(is_last)
+
+        take_counts = np.diff(np.concatenate([[-1], last_positions]))
+        keep = orders[last_positions]
+        positions = np.argsort(keep)
+        logger.info("news takes collapsed from %d to %d rows", len(df), len(keep))
+
+        df = df.iloc[keep[positions]].reset_index(drop=True)
+        if self.keep_take_count:
+            df[self.TAKE_COUNT] = take_counts[positions].astype("int16")
+        return df
+
+    def release_raw_field(self, df):
+        pass
+
+    def fit_transform(self, df):
+        return self.transform(df)
+
+
 class LagAggregationTransformer(DfTransformer):
     LAG_FEATURES = ['returnsClosePrevMktres10', 'returnsClosePrevRaw10', 'open', 'close']
 
-    def __init__(self, lags, shift_size, scale=True, remove_raw=False, n_pool=4):
+    def __init__(self, lags, shift_size, scale=True, remove_raw=False, n_pool=None):
         self.lags = lags
         self.shift_size = shift_size
         self.scale = scale
         if scale:
             self.scaler = None
         self.remove_raw = remove_raw
+        # the raw values are released by UnionFeaturePipeline after the lag extraction
+        self.release_columns = list(self.LAG_FEATURES) if remove_raw else []
         self.imputer = None
         self.n_pool = n_pool
+        # last history_size values of LAG_FEATURES of each asset (assets x history_size x features) for transform_next
+        self.history = None
+        self.history_assets = pd.Index([])
+
+    @property
+    def history_size(self):
+        return max(self.lags) + self.shift_size - 1
+
+    def lag_column_names(self):
+        return list(itertools.chain.from_iterable(
+            [['%s_lag_%s_mean' % (col, lag), '%s_lag_%s_max' % (col, lag), '%s_lag_%s_min' % (col, lag)]
+             for col, lag in itertools.product(self.LAG_FEATURES, self.lags)]))
+
+    def update_history(self, df):
+        """
+        keep the last history_size values of LAG_FEATURES of each asset in df. it is called on the training rows by
+        fit_transform, or by MarketPreprocess.fit_transform before the rows are pruned, and never by transform, which
+        also runs on the rows of the backtest and the predictions.
+        """
+        tail_df = df[["time", "assetCode"] + self.LAG_FEATURES].sort_values(by="time", kind="mergesort")
+        tail_df = tail_df.groupby("assetCode", observed=True).tail(self.history_size)
+        self.history_assets = pd.Index(tail_df["assetCode"].unique())
+        self.history = np.full((len(self.history_assets), self.history_size, len(self.LAG_FEATURES)), np.nan)
+        # the last value of an asset is at the end of its history
+        positions = self.history_size - 1 - tail_df.groupby("assetCode", observed=True).cumcount(ascending=False)
+        rows = self.history_assets.get_indexer(tail_df["assetCode"])
+        self.history[rows, positions.values] = tail_df[self.LAG_FEATURES].values
+
+    def transform_next(self, df):
+        """
+        append the lag features of the rows of a new day (a row for each asset) from the kept history,
+        which gives the same values as transform over the whole history. the values of the day are pushed into the
+        history.
+        """
+        if self.history is None:
+            self.history = np.full((0, self.history_size, len(self.LAG_FEATURES)), np.nan)
+        new_assets = pd.Index(df["assetCode"].unique()).difference(self.history_assets)
+        if len(new_assets) > 0:
+            self.history_assets = self.history_assets.append(new_assets)
+            self.history = np.concatenate(
+                [self.history, np.full((len(new_assets),) + self.history.shape[1:], np.nan)])
+
+        rows = self.history_assets.get_indexer(df["assetCode"])
+        window = self.history[rows]
+        end = self.history_size - self.shift_size + 1
+        for i, col in enumerate(self.LAG_FEATURES):
+            for lag in self.lags:
+                values = window[:, end - lag:end, i]
+                df['%s_lag_%s_mean' % (col, lag)] = values.mean(axis=1).astype("float32")
+                df['%s_lag_%s_max' % (col, lag)] = values.max(axis=1).astype("float32")
+                df['%s_lag_%s_min' % (col, lag)] = values.min(axis=1).astype("float32")
+
+        self.history[rows, :-1] = window[:, 1:]
+        self.history[rows, -1] = df[self.LAG_FEATURES].values
+        if self.remove_raw:
+            df.drop(self.LAG_FEATURES, axis=1, inplace=True)
+        return df
 
     @measure_time
     def transform(self, df, n_pool=None):
-        if not n_pool:
+        if n_pool:
             self.n_pool = n_pool
 
         df.sort_values(by="time", axis=0, inplace=True)
@@ -1248,16 +3104,14 @@ class LagAggregationTransformer(DfTransformer):
         asset_code_groups = [asset_code_group[1][group_features]
                              for asset_code_group in asset_code_groups]
 
-        with Pool(self.n_pool) as pool:
+        with RESOURCES.process_pool("LagAggregationTransformer", self.n_pool) as pool:
             group_dfs = pool.map(self.extract_lag, asset_code_groups)
             group_dfs = pd.concat(group_dfs)
             group_dfs.drop(["time", "assetCode"] + self.LAG_FEATURES, axis=1, inplace=True)
 
             df = df.merge(group_dfs, how="left", copy=False, on=MARKET_ID)
 
-            new_columns = list(itertools.chain.from_iterable(
-                [['%s_lag_%s_mean' % (col, lag), '%s_lag_%s_max' % (col, lag), '%s_lag_%s_min' % (col, lag)]
-                 for col, lag in itertools.product(self.LAG_FEATURES, self.lags)]))
+            new_columns = self.lag_column_names()
 
         # df.drop(["time", "assetCode"], axis=1, inplace=True)
 
@@ -1271,9 +3125,6 @@ class LagAggregationTransformer(DfTransformer):
         #     for col in new_columns:
         #         df[col] = self.scaler[col].transform(df[col].values.reshape((-1, 1)))
 
-        if self.remove_raw:
-            df.drop(self.LAG_FEATURES, axis=1, inplace=True)
-
         # if self.imputer is None:
         #     self.imputer = {col: SimpleImputer(strategy="mean").fit(df[col].values.reshape((-1, 1))) for col in
         #                     new_columns}
@@ -1303,14 +3154,17 @@ class LagAggregationTransformer(DfTransformer):
         pass
 
     def fit_transform(self, df):
+        self.update_history(df)
         return self.transform(df)
 
 
 class IdAppender(DfTransformer):
+    input_columns = []
 
     def __init__(self, id_name):
         super().__init__()
         self.id_name = id_name
+        self.output_columns = [id_name]
 
     def transform(self, df):
         df[self.id_name] = df.index.astype("int32")
@@ -1324,6 +3178,8 @@ class IdAppender(DfTransformer):
 
 
 class ConfidenceAppender(DfTransformer):
+    input_columns = [NEXT_MKTRES_10]
+    output_columns = ["confidence"]
 
     def transform(self, df):
         if NEXT_MKTRES_10 in df.columns:
@@ -1364,31 +3220,12 @@ class NullTransformer(FunctionTransformer):
         return X
 
 
-class WeekDayTransformer(FunctionTransformer):
-    def __init__(self, kw_args=None, inv_kw_args=None):
-        validate = False
-        inverse_func = None
-        accept_sparse = False
-        pass_y = 'deprecated'
-        super().__init__(self.f, inverse_func, validate, accept_sparse, pass_y, kw_args, inv_kw_args)
-
-    def f(self, X, y=None):
-        return np.cos(pd.Series(X).dt.dayofweek.values / 7).astype("float32").reshape((-1, 1))
-
-
-class MonthTransformer(FunctionTransformer):
-    def __init__(self, kw_args=None, inv_kw_args=None):
-        validate = False
-        inverse_func = None
-        accept_sparse = False
-        pass_y = 'deprecated'
-        super().__init__(self.f, inverse_func, validate, accept_sparse, pass_y, kw_args, inv_kw_args)
-
-    def f(self, X, y=None):
-        return np.cos(pd.Series(X).dt.month.values / 12).astype("float32").reshape((-1, 1))
-
+class CalendarTransformer(FunctionTransformer):
+    """
+    cos of day of week, month and day as one float32 block.
+    they are computed on the unique timestamps only and taken back to the rows.
+    """
 
-class DayTransformer(FunctionTransformer):
     def __init__(self, kw_args=None, inv_kw_args=None):
         validate = False
         inverse_func = None
@@ -1397,7 +3234,12 @@ class DayTransformer(FunctionTransformer):
         super().__init__(self.f, inverse_func, validate, accept_sparse, pass_y, kw_args, inv_kw_args)
 
     def f(self, X, y=None):
-        return np.cos(pd.Series(X).dt.day.values / 31).astype("float32").reshape((-1, 1))
+        codes, dates = pd.factorize(pd.Series(X))
+        dates = pd.DatetimeIndex(dates)
+        calendar = np.cos(np.stack([dates.dayofweek.values / 7,
+                                    dates.month.values / 12,
+                                    dates.day.values / 31], axis=1)).astype("float32")
+        return calendar.take(codes, axis=0)
 
 
 class MarketFeatureTransformer(DfTransformer):
@@ -1422,7 +3264,9 @@ class MarketFeatureTransformer(DfTransformer):
          for col, lag in itertools.product(
             ['returnsClosePrevMktres10', 'returnsClosePrevRaw10', 'open', 'close'], [3, 5, 10])]))
     LABEL_OBJECT_FIELDS = ['assetName']
-    DROP_COLS = ['universe', "returnsOpenNextMktres10"]
+    # the target columns are kept for the competition score, which main pops with ModelWrapper.pop_metric before
+    # linking. without the linker, the model wrappers pop it in create_dataset
+    DROP_COLS = []
     TIME_COLS = ['time']
 
     def __init__(self):
@@ -1437,9 +3281,12 @@ class MarketFeatureTransformer(DfTransformer):
         #      [col]) for col in set(self.COLUMNS_SCALED) & set(self.LOG_NORMAL_FIELDS)
         # ])
 
-        scaled_columns = self.NUMERIC_COLUMNS
+        scaled_columns = list(self.NUMERIC_COLUMNS)
         if FeatureSetting.max_shift_date > 0:
             scaled_columns.extend(self.LAG_FEATURES)
+        self.input_columns = scaled_columns + self.TIME_COLS
+        # the raw values are not used after the encoding
+        self.release_columns = scaled_columns + self.LABEL_OBJECT_FIELDS + self.DROP_COLS
 
         transformers.extend(
             [
@@ -1454,9 +3301,7 @@ class MarketFeatureTransformer(DfTransformer):
 
         transformers.extend(
             [
-                ("time_week", WeekDayTransformer(), self.TIME_COLS[0]),
-                ("time_month", MonthTransformer(), self.TIME_COLS[0]),
-                ("time_day", DayTransformer(), self.TIME_COLS[0])
+                ("time_calendar", CalendarTransformer(), self.TIME_COLS[0])
             ]
         )
 
@@ -1474,30 +3319,30 @@ class MarketFeatureTransformer(DfTransformer):
         #       ]), [col]) for col in self.LABEL_OBJECT_FIELDS]),
 
         self.encoder: ColumnTransformer = ColumnTransformer(transformers=transformers)
+        self.binner = QuantileBinner(FeatureSetting.n_feature_bins) if FeatureSetting.should_bin_features else None
         self.feature_matrix = None
 
     def transform(self, df):
-        self.feature_matrix = self.encoder.transform(df).astype("float32")
+        if self.binner is not None:
+            self.feature_matrix = self.binner.transform(self.encoder.transform(df))
+        else:
+            self.feature_matrix = self.encoder.transform(df).astype("float32")
         # self.feature_matrix = self.feature_matrix
-        self.release_raw_field(df)
         return df
 
     def fit(self, df):
+        df = df[self.input_columns]
         self.encoder.fit(df)
+        if self.binner is not None:
+            sample_df = df.sample(min(len(df), self.binner.sample_size), random_state=self.binner.random_state)
+            self.binner.fit(self.encoder.transform(sample_df))
         return self
 
     def fit_transform(self, df):
         return self.fit(df).transform(df)
 
     def release_raw_field(self, df: pd.DataFrame):
-        drop_cols = list \
-            (set(self.NUMERIC_COLUMNS + self.LABEL_OBJECT_FIELDS))
-        for col in self.DROP_COLS:
-            if col in df.columns:
-                drop_cols.append(col)
-
-        df.drop(drop_cols, axis=1, inplace=True)
-        gc.collect()
+        pass
 
     def clear(self):
         self.feature_matrix = None
@@ -1529,6 +3374,10 @@ class NewsFeatureTransformer(DfTransformer):
     LABEL_OBJECT_FIELDS = ['headlineTag']
     DROP_COLS = ['time', 'sourceId', 'sourceTimestamp', "assetName"]
 
+    STORE_COLS = LABEL_COLS + [FIRST_MENTION_SENTENCE] + MULTI_LABEL_COLS + LABEL_OBJECT_FIELDS
+    RELEASE_COLS = list(dict.fromkeys(RAW_COLS + [FIRST_MENTION_SENTENCE] + LABEL_COLS + MULTI_LABEL_COLS + BOW_COLS
+                                      + LOG_NORMAL_FIELDS + LABEL_OBJECT_FIELDS + COLUMNS_SCALED + DROP_COLS))
+
     NUMERIC_COLS = list(set(RAW_COLS + LOG_NORMAL_FIELDS + COLUMNS_SCALED))
     NUMERIC_COL_INDICES = list(range(len(NUMERIC_COLS)))
     N_NUMERIC_COLS = len(NUMERIC_COLS)
@@ -1609,23 +3458,47 @@ class NewsFeatureTransformer(DfTransformer):
              for col in self.LABEL_OBJECT_FIELDS]
         )
 
+        # the encoder is rebuilt by fit from these and the columns of the fitted data
+        self.encoder_transformers = transformers
+        self.input_columns = self.RAW_COLS + self.COLUMNS_SCALED + self.STORE_COLS
+        self.release_columns = self.RELEASE_COLS
         self.encoder: ColumnTransformer = ColumnTransformer(transformers=transformers)
         self.delay_encoder: ColumnTransformer = ColumnTransformer(transformers=delay_transformers)
+        self.binner = QuantileBinner(FeatureSetting.n_feature_bins) if FeatureSetting.should_bin_features else None
         self.feature_matrix = None
         self.store_df: pd.DataFrame = None
         self.n_delay_features = None
 
     def transform(self, df):
-        self.feature_matrix = self.encoder.transform(df).astype("float32")
+        if self.binner is not None:
+            self.feature_matrix = self.binner.transform(self.encoder.transform(df))
+        else:
+            self.feature_matrix = self.encoder.transform(df).astype("float32")
         # self.feature_matrix = self.feature_matrix.tocsr()
-        self.store_df = df[
-            self.LABEL_COLS + [self.FIRST_MENTION_SENTENCE] + self.MULTI_LABEL_COLS + self.LABEL_OBJECT_FIELDS]
-        self.release_raw_field(df)
+        self.store_df = df[self.STORE_COLS]
         return df
 
     def fit(self, df):
+        transformers = list(self.encoder_transformers)
+        self.input_columns = self.RAW_COLS + self.COLUMNS_SCALED + self.STORE_COLS
+        self.release_columns = self.RELEASE_COLS
+        if LatestTakeTransformer.TAKE_COUNT in df.columns:
+            self.input_columns = self.input_columns + [LatestTakeTransformer.TAKE_COUNT]
+            self.release_columns = self.release_columns + [LatestTakeTransformer.TAKE_COUNT]
+            transformers.append(
+                (LatestTakeTransformer.TAKE_COUNT,
+                 Pipeline([
+                     ("log", LogTransformer()),
+                     ("normalize", StandardScaler(copy=False)),
+                     ("fill_missing", SimpleImputer(strategy="median"))]),
+                 [LatestTakeTransformer.TAKE_COUNT]))
+        self.encoder = ColumnTransformer(transformers=transformers)
+        df = df[self.input_columns]
         self.encoder.fit(df)
-        self.delay_encoder.fit(df)
+        self.delay_encoder.fit(df[self.STORE_COLS])
+        if self.binner is not None:
+            sample_df = df.sample(min(len(df), self.binner.sample_size), random_state=self.binner.random_state)
+            self.binner.fit(self.encoder.transform(sample_df))
         self.n_delay_features = self._get_delay_faeture_num()
         return self
 
@@ -1633,11 +3506,7 @@ class NewsFeatureTransformer(DfTransformer):
         return self.fit(df).transform(df)
 
     def release_raw_field(self, df):
-        drop_cols = list \
-            (set(self.RAW_COLS + [self.FIRST_MENTION_SENTENCE] + self.LABEL_COLS + self.MULTI_LABEL_COLS + self.BOW_COLS
-                 + self.LOG_NORMAL_FIELDS + self.LABEL_OBJECT_FIELDS + self.COLUMNS_SCALED + self.DROP_COLS))
-        df.drop(drop_cols, axis=1, inplace=True)
-        gc.collect()
+        pass
 
     def clear(self):
         self.feature_matrix = None
@@ -1686,7 +3555,10 @@ class NewsFeatureTransformer(DfTransformer):
         # encoded_partial = self.feature_matrix[ids][:, self.encoded_cols_indices].sum(axis=0)
         # encoded_partial = self.feature_matrix[ids].sum(axis=0)
         # encoded_partial[encoded_partial != 0] = 1
-        return sparse.hstack([self.feature_matrix[[int(id) for id in ids], :].mean(axis=0).reshape((1, -1)),
+        partial_feature_matrix = self.feature_matrix[[int(id) for id in ids], :]
+        if self.binner is not None:
+            partial_feature_matrix = self.binner.dequantize(partial_feature_matrix)
+        return sparse.hstack([partial_feature_matrix.mean(axis=0).reshape((1, -1)),
                               self.delay_encoder.transform(self.store_df.iloc[ids]).sum(axis=0).reshape((1, -1))],
                              dtype="float32")
 
@@ -1699,66 +3571,65 @@ class NewsFeatureTransformer(DfTransformer):
         return links, aggregate_feature
 
 
-class TfDataGenerator(Sequence):
-
-    def __init__(self, list_of_indices, features: Features, labels, batch_size=200):
-        self.list_of_indices = list_of_indices
-        # print(list_of_indices)
-        self.features = features
-        self.labels = labels
-        self.batch_size = batch_size
-        self.n_samples = len(self.list_of_indices)
-        self.n_batches = self.n_samples // self.batch_size + int(bool(self.n_samples % self.batch_size))
-        self._current_batch_num = 0
-
-    # def __next__(self):
-    #     while True:
-    #         start = self._current_batch_num * self.batch_size
-    #         if self._current_batch_num < self.n_batches - 1:
-    #             end = (self._current_batch_num + 1) * self.batch_size
-    #             yield self.features.get_linked_feature_matrix(self.list_of_indices[start:end]), self.labels[start:end]
-    #             self._current_batch_num += 1
-    #         else:
-    #             yield self.features.get_linked_feature_matrix(self.list_of_indices[start:]), self.labels[start:]
-    #             self._current_batch_num = 0
-
-    def __len__(self):
-        return self.n_batches
-
-    def __getitem__(self, index):
-        'Generate one batch of data'
-        # Generate indexes of the batch
-
-        start = index * self.batch_size
-
-        if index < self.n_batches - 1:
-            end = (index + 1) * self.batch_size
-            return self.features.get_linked_feature_matrix(
-                self.list_of_indices[start:end], market_indices=list(range(start, end))), self.labels[start:end]
-            # index += 1
-        else:
-            return self.features.get_linked_feature_matrix(self.list_of_indices[start:],
-                                                           market_indices=list(
-                                                               range(start, len(self.list_of_indices)))), \
-                   self.labels[start:]
-            # index = 0
-
-    def on_epoch_end(self):
-        pass
-
-
 class SparseMLPWrapper(ModelWrapper):
+    MODEL_PATH = "mlp.model.h5"
+    PREDICT_BATCH_SIZE = 65536
+    # batches of an incremental update
+    UPDATE_STEPS = 20
+    UPDATE_BATCH_SIZE = 1024
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.train_data_generator: TfDataGenerator = None
-        self.valid_data_generator: TfDataGenerator = None
+        self.train_data_generator: "TfDataGenerator" = None
+        self.valid_data_generator: "TfDataGenerator" = None
+        self.sparse_input = False
+
+    def load_best_model(self):
+        """
+        load the best checkpoint once and build its predict function, which is reused by every prediction.
+        """
+        self.model = keras.models.load_model(self.MODEL_PATH)
+        self.sparse_input = keras.backend.is_sparse(self.model.inputs[0])
+        if hasattr(self.model, "_make_predict_function"):
+            self.model._make_predict_function()
+        return self
 
     def predict(self, x: Union[np.ndarray, sparse.spmatrix]):
-        self.model = keras.models.load_model("mlp.model.h5")
-        logger.info("predicting %d samples...".format(x.shape[0]))
-
-        return self.model.predict(x)
+        if self.model is None:
+            self.load_best_model()
+        logger.info("predicting {} samples...".format(x.shape[0]))
+        if sparse.issparse(x):
+            x = x.tocsr()
+
+        predictions = []
+        for start in range(0, x.shape[0], self.PREDICT_BATCH_SIZE):
+            batch = x[start:start + self.PREDICT_BATCH_SIZE]
+            if sparse.issparse(batch) and not self.sparse_input:
+                batch = batch.toarray()
+            elif self.sparse_input and not sparse.issparse(batch):
+                batch = sparse.csr_matrix(batch)
+            predictions.append(self.model.predict_on_batch(batch))
+        if len(predictions) == 0:
+            return np.zeros((0, 1), dtype="float32")
+        return np.concatenate(predictions)
+
+    def update(self, x, y, time_budget):
+        deadline = perf_counter() + time_budget
+        if sparse.issparse(x):
+            x = x.tocsr()
+        y = np.asarray(y, dtype="float32")
+        for step in range(self.UPDATE_STEPS):
+            if perf_counter() > deadline:
+                break
+            batch = np.random.randint(0, len(y), min(self.UPDATE_BATCH_SIZE, len(y)))
+            batch_x = x[batch]
+            if sparse.issparse(batch_x) and not self.sparse_input:
+                batch_x = batch_x.toarray()
+            elif self.sparse_input and not sparse.issparse(batch_x):
+                batch_x = sparse.csr_matrix(batch_x)
+            self.model.train_on_batch(batch_x, y[batch])
+        logger.info("mlp model is updated with %d batches on %d rows", step + 1, len(y))
+        return self
 
     def train(self, sparse_input=False, **kwargs):
         input_ = keras.layers.Input(shape=(self.train_data_generator.features.get_feature_num(),), sparse=sparse_input,
@@ -1776,9 +3647,14 @@ class SparseMLPWrapper(ModelWrapper):
         self.model = keras.Model(inputs=input_, outputs=output_)
         self.model.summary()
 
-        checkpointer = ModelCheckpoint(filepath="mlp.model.h5",
-                                       verbose=1, save_best_only=True)
-        early_stopping = EarlyStopping(monitor='val_loss', min_delta=0, patience=10, verbose=1, mode='auto')
+        checkpointer = keras.callbacks.ModelCheckpoint(filepath=self.MODEL_PATH,
+                                                       verbose=1, save_best_only=True)
+        early_stopping = keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0, patience=10, verbose=1, mode='auto')
+        callbacks = [checkpointer, early_stopping]
+        if self.valid_metric is not None:
+            predict = lambda generator: self.model.predict_generator(generator, generator.n_batches)
+            callbacks.insert(0, keras.callbacks.LambdaCallback(
+                on_epoch_end=self.valid_metric.epoch_end_hook(predict, self.valid_data_generator)))
         self.model.compile(
             loss='binary_crossentropy',
             optimizer=keras.optimizers.Adam(lr=2e-2, decay=0.001),
@@ -1788,10 +3664,14 @@ class SparseMLPWrapper(ModelWrapper):
         self.model.fit_generator(self.train_data_generator, self.train_data_generator.n_batches,
                                  epochs=50, validation_data=self.valid_data_generator,
                                  validation_steps=self.valid_data_generator.n_batches, verbose=0,
-                                 callbacks=[checkpointer, early_stopping], shuffle=True)
+                                 callbacks=callbacks, shuffle=True)
+        # the last epoch is not always the best one
+        self.load_best_model()
+        return self
 
     def create_dataset(self, market_train, features, train_batch_size, valid_batch_size):
         y, _ = ModelWrapper.to_x_y(market_train)
+        self.set_valid_metric(market_train, train_size=0.8)
         # print(market_train[NEWS_ID])
         list_of_indices = market_train[NEWS_ID].tolist()
         list_of_indices, valid_indices, y, valid_y = ModelWrapper.split_train_validation(list_of_indices, y,
@@ -1815,43 +3695,161 @@ class Predictor(object):
         self.features: Features = features
         self.market_preprocess = market_preprocess
         self.news_preprocess = news_preprocess
+        # rolling window of the transformed news of the last max_day_diff days: the columns used by the linker and
+        # the rows of the news feature matrix and store_df, whose positions are the news ids
+        self.news_df = None
+        self.news_feature_matrix = None
+        self.news_store_df = None
+        # (asset codes, feature matrix) of the recent days whose targets are not known yet, and the newest labelled
+        # rows for the incremental updates of the model
+        self.unlabelled_days = deque(maxlen=TARGET_HORIZON_DAYS + 1)
+        self.update_x = None
+        self.update_y = None
+        self.n_predicted_days = 0
 
     def predict_all(self, days, env):
         logger.info("=================prediction start ===============")
-
-        stored_market_df = None
-        stored_news_df = None
-        max_time = None
-        predict_start_id = 0
-
-        def store_past_data(market_df, news_df, max_store_date=0):
-            nonlocal stored_market_df
-            nonlocal stored_news_df
-            nonlocal predict_start_id
-            if stored_market_df is None or max_store_date == 0:
-                stored_market_df = market_df
-                stored_news_df = news_df
-                predict_start_id = 0
-                return
-
-            nonlocal max_time
-            max_time = market_df["time"].max()
-
-            min_time = max_time - offsets.Day(max_store_date)
-            stored_market_df = stored_market_df[stored_market_df["time"] >= min_time]
-            stored_news_df = stored_news_df[stored_news_df["firstCreated"] >= min_time]
-
-            predict_start_id = len(stored_market_df)
-
-            stored_market_df = pd.concat([stored_market_df, market_df], axis=0, ignore_index=True)
-            stored_news_df = pd.concat([stored_news_df, news_df], axis=0, ignore_index=True)
-
-        for (market_obs_df, news_obs_df, predictions_template_df) in tqdm(days):
-            store_past_data(market_obs_df, news_obs_df, FeatureSetting.max_shift_date)
-            market_obs_df_cp, news_obs_df_cp = stored_market_df.copy(), stored_news_df.copy()
-            self.make_predictions(market_obs_df_cp, news_obs_df_cp, predictions_template_df, predict_start_id)
+        for (market_obs_df, news_obs_df, predictions_template_df) in tqdm.tqdm(days):
+            self.predict_day(market_obs_df, news_obs_df, predictions_template_df)
             env.predict(predictions_template_df)
 
+    def update_news_window(self, news_df, min_time):
+        """
+        append the news transformed by the news transformer and drop the news created before min_time.
+        the news ids are renumbered to the positions in the window.
+        """
+        news_transformer = self.features.news_transformer
+        news_dfs, feature_matrices, store_dfs = [], [], []
+        if self.news_df is not None:
+            keep = (self.news_df["firstCreated"] >= min_time).values
+            news_dfs.append(self.news_df[keep])
+            feature_matrices.append(self.news_feature_matrix[keep])
+            store_dfs.append(self.news_store_df[keep])
+        if news_df is not None:
+            news_dfs.append(news_df)
+            feature_matrices.append(news_transformer.feature_matrix)
+            store_dfs.append(news_transformer.store_df)
+
+        self.news_df = pd.concat(news_dfs, ignore_index=True)
+        self.news_df[NEWS_ID] = np.arange(len(self.news_df), dtype="int32")
+        if any(sparse.issparse(matrix) for matrix in feature_matrices):
+            self.news_feature_matrix = sparse.vstack(feature_matrices, format="csr")
+        else:
+            self.news_feature_matrix = np.vstack(feature_matrices)
+        self.news_store_df = pd.concat(store_dfs, ignore_index=True)
+        news_transformer.feature_matrix = self.news_feature_matrix
+        news_transformer.store_df = self.news_store_df
+        return self.news_df.copy()
+
+    @measure_time
+    def predict_day(self, market_obs_df, news_obs_df, predictions_df):
+        """
+        predict the rows of a new day from the kept state, which are the fitted transformers, the lag history of
+        each asset and the rolling window of the transformed news. only the rows of the day are transformed.
+        """
+        if FeatureSetting.update_every_days:
+            returns_df = market_obs_df[["assetCode", "returnsOpenPrevMktres10"]].copy()
+        market_obs_df = self.market_preprocess.transform_next(market_obs_df)
+        market_obs_df = self.features.transform_market(market_obs_df)
+
+        if FeatureSetting.should_use_news_feature:
+            if len(news_obs_df) > 0:
+                news_obs_df = self.news_preprocess.transform(news_obs_df.reset_index(drop=True))
+                news_obs_df = self.features.transform_news(news_obs_df)
+            else:
+                news_obs_df = None
+            min_time = market_obs_df["time"].max().normalize() - pd.Timedelta(days=self.linker.max_day_diff)
+            news_window_df = self.update_news_window(news_obs_df, min_time)
+            del news_obs_df
+
+            self.linker.link(market_obs_df, news_window_df, pool=1)
+            market_obs_df = self.linker.create_new_market_df()
+            self.linker.clear()
+            del news_window_df
+
+        feature_matrix = self.features.get_linked_feature_matrix(
+            market_obs_df, dequantize=not self.model.accepts_binned_features)
+        # the market ids are the positions of the rows of the day and the linked rows are sorted by them
+        predictions = self.model.predict(feature_matrix)
+        predictions_df.confidenceValue = predictions * 2 - 1
+
+        if FeatureSetting.update_every_days:
+            self.learn_day(returns_df, feature_matrix)
+
+    def learn_day(self, returns_df, feature_matrix):
+        """
+        label the rows of the day TARGET_HORIZON_DAYS + 1 days ago, whose returnsOpenNextMktres10 is
+        returnsOpenPrevMktres10 of today, and update the model every FeatureSetting.update_every_days days.
+        :param returns_df: assetCode and returnsOpenPrevMktres10 of today in the row order of feature_matrix
+        """
+        if len(self.unlabelled_days) == self.unlabelled_days.maxlen:
+            asset_codes, day_matrix = self.unlabelled_days[0]
+            returns = returns_df.drop_duplicates("assetCode").set_index("assetCode")["returnsOpenPrevMktres10"]
+            returns = returns.reindex(asset_codes).values
+            labelled = ~np.isnan(returns)
+            self.append_update_rows(day_matrix[labelled], returns[labelled] >= 0)
+        self.unlabelled_days.append((returns_df["assetCode"].values, feature_matrix))
+
+        self.n_predicted_days += 1
+        if self.update_y is not None and self.n_predicted_days % FeatureSetting.update_every_days == 0:
+            with PROFILER.stage("update model", inputs=[self.update_x]):
+                self.model.update(self.update_x, self.update_y, FeatureSetting.update_time_budget)
+
+    def append_update_rows(self, x, y):
+        if self.update_y is not None:
+            if sparse.issparse(x) or sparse.issparse(self.update_x):
+                x = sparse.vstack([self.update_x, x], format="csr")
+            else:
+                x = np.vstack([self.update_x, x])
+            y = np.concatenate([self.update_y, y])
+        self.update_x, self.update_y = x[-FeatureSetting.update_buffer_rows:], y[-FeatureSetting.update_buffer_rows:]
+
+    @measure_time
+    def backtest(self, market_df, news_df, start, end):
+        """
+        predict all the days from start to end at once and score them. preprocessing, linking and feature extraction
+        run once over the whole range, and the rows before start are only used as the look back.
+        :param market_df: market data with returnsOpenNextMktres10 and universe
+        :return: ([(time, predictions_df), ...] of each day, score, daily sums of the score)
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if market_df["time"].dt.tz is not None and start.tzinfo is None:
+            start, end = start.tz_localize(market_df["time"].dt.tz), end.tz_localize(market_df["time"].dt.tz)
+        market_df = market_df[market_df["time"] <= end].reset_index(drop=True)
+        news_df = news_df[news_df["firstCreated"] <= end].reset_index(drop=True)
+        targets_df = market_df[["time", "assetCode", NEXT_MKTRES_10, "universe"]]
+
+        # the market ids are the positions in targets_df
+        market_df = self.market_preprocess.transform(market_df.drop([NEXT_MKTRES_10, "universe"], axis=1))
+        market_df = market_df.sort_values(by=MARKET_ID, kind="mergesort").reset_index(drop=True)
+        news_df = self.news_preprocess.transform(news_df)
+        market_df, news_df = self.features.transform(market_df, news_df)
+        if FeatureSetting.should_use_news_feature:
+            self.linker.link(market_df, news_df)
+            market_df = self.linker.create_new_market_df()
+            self.linker.clear()
+        del news_df
+        gc.collect()
+
+        market_df = market_df[(targets_df["time"] >= start).values[market_df[MARKET_ID].values]]
+        market_ids = market_df[MARKET_ID].values
+        feature_matrix = self.features.get_linked_feature_matrix(
+            market_df, dequantize=not self.model.accepts_binned_features)
+        del market_df
+        logger.info("backtest input size: {}".format(feature_matrix.shape))
+        confidence = np.asarray(self.model.predict(feature_matrix)).reshape(-1) * 2 - 1
+        del feature_matrix
+
+        scored_df = targets_df.iloc[market_ids].reset_index(drop=True)
+        scored_df["confidenceValue"] = confidence
+        daily_predictions = [(time, day_df[["assetCode", "confidenceValue"]].reset_index(drop=True))
+                             for time, day_df in scored_df.groupby("time", sort=True)]
+        report = CompetitionMetric(scored_df["time"], scored_df[NEXT_MKTRES_10], scored_df["universe"]).report(
+            scored_df["confidenceValue"])
+        logger.info("backtest score from %s to %s: %.5f", start, end, report["score"])
+        return daily_predictions, report["score"], report["daily_sums"]
+
+    @measure_time
     def make_predictions(self, market_obs_df, news_obs_df, predictions_df, predict_id_start):
         logger.info("predicting....")
 
@@ -1869,7 +3867,8 @@ class Predictor(object):
         del news_obs_df
         gc.collect()
 
-        feature_matrix = self.features.get_linked_feature_matrix(market_obs_df)
+        feature_matrix = self.features.get_linked_feature_matrix(
+            market_obs_df, dequantize=not self.model.accepts_binned_features)
 
         logger.info("input size: {}".format(feature_matrix.shape))
         predictions = self.model.predict(feature_matrix)
@@ -1886,6 +3885,14 @@ class Predictor(object):
         logger.info("prediction done")
 
 
+def __getattr__(name):
+    # backend classes are defined on demand (PEP 562)
+    if name in BACKEND_CLASSES:
+        load_backend(BACKEND_CLASSES[name])
+        return globals()[name]
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
 if __name__ == '__main__':
     logger = logging.getLogger("root")
     logger.setLevel(logging.INFO)
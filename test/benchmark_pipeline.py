@@ -0,0 +1,171 @@
+"""
+scaling benchmark of the pipeline stages over synthetic inputs of increasing size.
+
+each stage is run in a PROFILER stage with tracemalloc on, so the wall time and the peak of traced memory are
+recorded per stage and size. the scaling exponent of a stage is the slope of log(measure) over log(rows).
+the results are compared with the stored baseline (benchmark_baseline.json), which is written on the first run or
+by `python -m test.benchmark_pipeline --update-baseline`.
+"""
+import argparse
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from not_final_kernels.final_local_but_oom_kernel import PROFILER, MarketPreprocess, NewsPreprocess, Features, \
+    MarketNewsLinker, LgbWrapper, Predictor, ModelWrapper, NEXT_MKTRES_10
+from test.synthetic_data import generate_train_dfs
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = [10000, 30000, 100000]
+BASELINE_PATH = Path(__file__).parent / "benchmark_baseline.json"
+# allowed ratio to the baseline
+TIME_TOLERANCE = 1.5
+MEMORY_TOLERANCE = 1.3
+# allowed increase of the scaling exponents
+EXPONENT_TOLERANCE = 0.3
+# stages profiled by measure_time inside the benchmark stages
+NESTED_STAGES = {"LagAggregationTransformer.transform": "lag aggregation"}
+MAX_DAY_DIFF = 3
+
+
+def split_last_day(market_df, news_df):
+    last_time = market_df["time"].max()
+    market_obs_df = market_df[market_df["time"] == last_time].drop([NEXT_MKTRES_10, "universe"], axis=1)
+    news_obs_df = news_df[news_df["firstCreated"] > last_time - pd.Timedelta(days=1)]
+    market_df = market_df[market_df["time"] < last_time].reset_index(drop=True)
+    news_df = news_df[news_df["firstCreated"] <= last_time - pd.Timedelta(days=1)].reset_index(drop=True)
+    return market_df, news_df, market_obs_df.reset_index(drop=True), news_obs_df.reset_index(drop=True)
+
+
+def run_pipeline(n_rows, seed=10):
+    """
+    run the pipeline stages once.
+    :return: {stage name: record of the stage}
+    """
+    market_df, news_df, market_obs_df, news_obs_df = split_last_day(*generate_train_dfs(n_rows, seed=seed))
+    market_preprocess, news_preprocess = MarketPreprocess(), NewsPreprocess()
+    features, linker, model = Features(), MarketNewsLinker(MAX_DAY_DIFF), LgbWrapper(dataset_dir=None)
+
+    PROFILER.reset()
+    PROFILER.enable_trace_malloc()
+    with PROFILER.stage("preprocess", inputs=[market_df, news_df]):
+        market_df = market_preprocess.fit_transform(market_df)
+        news_df = news_preprocess.fit_transform(news_df)
+    with PROFILER.stage("features", inputs=[market_df, news_df]):
+        market_df, news_df = features.fit_transform(market_df, news_df)
+    # as in main, the targets are taken before the linker
+    model.valid_metric = ModelWrapper.pop_metric(market_df, train_size=0.8)
+    with PROFILER.stage("link", inputs=[market_df, news_df]):
+        linker.link(market_df, news_df)
+    del market_df, news_df
+    with PROFILER.stage("create_new_market_df"):
+        market_df = linker.create_new_market_df()
+        linker.clear()
+    with PROFILER.stage("get_linked_feature_matrix", inputs=[market_df]):
+        feature_matrix = features.get_linked_feature_matrix(market_df)
+    with PROFILER.stage("train", inputs=[feature_matrix]):
+        model.create_dataset(market_df, feature_matrix, train_batch_size=1024, valid_batch_size=1024)
+        model.train()
+    del market_df, feature_matrix
+
+    predictions_df = pd.DataFrame({"assetCode": market_obs_df["assetCode"], "confidenceValue": 0.0})
+    predictor = Predictor(linker, model, features, market_preprocess, news_preprocess)
+    with PROFILER.stage("predict day", inputs=[market_obs_df, news_obs_df]):
+        predictor.predict_day(market_obs_df, news_obs_df, predictions_df)
+
+    records = {record["name"]: record for record in PROFILER.root["children"]}
+    for _, record in PROFILER._iter_records():
+        if record["name"] in NESTED_STAGES:
+            records[NESTED_STAGES[record["name"]]] = record
+    return records
+
+
+def scaling_exponent(sizes, values):
+    sizes, values = np.asarray(sizes, dtype="float64"), np.maximum(np.asarray(values, dtype="float64"), 1e-9)
+    return float(np.polyfit(np.log(sizes), np.log(values), 1)[0])
+
+
+def run_benchmark(sizes=BENCHMARK_SIZES, seed=10):
+    """
+    :return: {"sizes": sizes, "stages": {stage: {"wall": [...], "peak_malloc": [...],
+                                                  "wall_exponent": float, "memory_exponent": float}}}
+    """
+    stages = {}
+    for n_rows in sizes:
+        logger.info("benchmarking %d rows", n_rows)
+        for name, record in run_pipeline(n_rows, seed=seed).items():
+            stage = stages.setdefault(name, {"wall": [], "peak_malloc": []})
+            stage["wall"].append(record["wall"])
+            stage["peak_malloc"].append(record["peak_malloc_delta"])
+    for stage in stages.values():
+        stage["wall_exponent"] = scaling_exponent(sizes, stage["wall"])
+        stage["memory_exponent"] = scaling_exponent(sizes, stage["peak_malloc"])
+    return {"sizes": list(sizes), "stages": stages}
+
+
+def find_regressions(results, baseline):
+    """
+    :return: messages of the stages which regress past the baseline
+    """
+    regressions = []
+    baseline_sizes = baseline["sizes"]
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        base = baseline["stages"][name]
+        for i, n_rows in enumerate(results["sizes"]):
+            if n_rows not in baseline_sizes:
+                continue
+            j = baseline_sizes.index(n_rows)
+            if stage["wall"][i] > base["wall"][j] * TIME_TOLERANCE:
+                regressions.append("{} with {} rows took {:.3f} sec (baseline {:.3f} sec)".format(
+                    name, n_rows, stage["wall"][i], base["wall"][j]))
+            if stage["peak_malloc"][i] > base["peak_malloc"][j] * MEMORY_TOLERANCE:
+                regressions.append("{} with {} rows used {:.1f} MB (baseline {:.1f} MB)".format(
+                    name, n_rows, stage["peak_malloc"][i] / 1e6, base["peak_malloc"][j] / 1e6))
+        for key in ["wall_exponent", "memory_exponent"]:
+            if stage[key] > base[key] + EXPONENT_TOLERANCE:
+                regressions.append("{} {} is {:.2f} (baseline {:.2f})".format(name, key, stage[key], base[key]))
+    return regressions
+
+
+def load_baseline(path=BASELINE_PATH):
+    path = Path(path)
+    if not path.exists():
+        return None
+    with path.open() as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with Path(path).open("w") as f:
+        json.dump(results, f, indent=1)
+
+
+def log_results(results):
+    for name, stage in results["stages"].items():
+        logger.info("%s: %s sec, %s MB, time ~ n^%.2f, memory ~ n^%.2f", name,
+                    ["%.3f" % wall for wall in stage["wall"]],
+                    ["%.1f" % (peak / 1e6) for peak in stage["peak_malloc"]],
+                    stage["wall_exponent"], stage["memory_exponent"])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=BENCHMARK_SIZES)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes)
+    log_results(results)
+    baseline = load_baseline()
+    if args.update_baseline or baseline is None:
+        save_baseline(results)
+    else:
+        for regression in find_regressions(results, baseline):
+            logger.error(regression)
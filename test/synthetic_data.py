@@ -0,0 +1,213 @@
+"""
+seeded generator of market and news data frames with the schema of the Two Sigma competition data.
+
+the sizes are parameterized by the number of market rows (10k to 10M), and news rows are generated with
+multi code assetCodes sets, "{'...'}" subjects/audiences strings, takeSequence chains and skewed
+news per asset so that the linker, lag and encoder stages can be benchmarked offline.
+"""
+import numpy as np
+import pandas as pd
+
+MARKET_COLUMNS = ['time', 'assetCode', 'assetName', 'volume', 'close', 'open',
+                  'returnsClosePrevRaw1', 'returnsOpenPrevRaw1',
+                  'returnsClosePrevMktres1', 'returnsOpenPrevMktres1',
+                  'returnsClosePrevRaw10', 'returnsOpenPrevRaw10',
+                  'returnsClosePrevMktres10', 'returnsOpenPrevMktres10',
+                  'returnsOpenNextMktres10', 'universe']
+
+NEWS_COLUMNS = ['time', 'sourceTimestamp', 'firstCreated', 'sourceId', 'headline', 'urgency', 'takeSequence',
+                'provider', 'subjects', 'audiences', 'bodySize', 'companyCount', 'headlineTag',
+                'marketCommentary', 'sentenceCount', 'wordCount', 'assetCodes', 'assetName',
+                'firstMentionSentence', 'relevance', 'sentimentClass', 'sentimentNegative', 'sentimentNeutral',
+                'sentimentPositive', 'sentimentWordCount', 'noveltyCount12H', 'noveltyCount24H',
+                'noveltyCount3D', 'noveltyCount5D', 'noveltyCount7D', 'volumeCounts12H', 'volumeCounts24H',
+                'volumeCounts3D', 'volumeCounts5D', 'volumeCounts7D']
+
+EXCHANGE_SUFFIXES = [".N", ".O", ".A", ".OQ", ".K"]
+PROVIDERS = ["RTRS", "BSW", "PRN", "MKW", "GNW"]
+PROVIDER_WEIGHTS = [0.8, 0.08, 0.06, 0.03, 0.03]
+HEADLINE_TAGS = ["", "BRIEF", "DIARY", "PRESS DIGEST", "RPT-", "UPDATE 1"]
+HEADLINE_TAG_WEIGHTS = [0.75, 0.1, 0.04, 0.03, 0.04, 0.04]
+HEADLINE_WORDS = ["shares", "rise", "fall", "profit", "loss", "quarter", "results", "deal", "merger", "buy",
+                  "sell", "rating", "upgrade", "downgrade", "forecast", "revenue", "dividend", "bond", "offer",
+                  "stake", "sees", "beats", "misses", "estimates", "plans", "cuts", "jobs", "court", "probe"]
+MARKET_CLOSE_HOUR = 22
+
+
+def zipf_weights(n, exponent=1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def to_set_strings(random_state, vocabulary, n_strings, min_size, max_size):
+    sizes = random_state.randint(min_size, max_size + 1, n_strings)
+    return ["{" + ", ".join("'{}'".format(code) for code in random_state.choice(vocabulary, size, replace=False))
+            + "}" for size in sizes]
+
+
+def create_assets(random_state, n_companies):
+    """
+    :return: (asset codes, company index of each asset code, assetCodes set string of each company)
+    """
+    tickers = ["".join(chars) for chars in
+               random_state.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"), (n_companies * 2, 4))]
+    tickers = list(dict.fromkeys(tickers))[:n_companies]
+    # some companies have several listed codes, like GOOG.O and GOOGL.O
+    n_codes = 1 + random_state.binomial(1, 0.15, n_companies) + random_state.binomial(1, 0.03, n_companies)
+    asset_codes, companies, news_asset_codes = [], [], []
+    for company, (ticker, n_code) in enumerate(zip(tickers, n_codes)):
+        suffix = EXCHANGE_SUFFIXES[company % 2]
+        codes = [ticker + suffix] + [ticker + extra + suffix for extra in "ABCDE"[:n_code - 1]]
+        asset_codes.extend(codes)
+        companies.extend([company] * len(codes))
+        # news also mention codes which are not in the market data
+        news_codes = codes + [ticker + ".F", ticker + "n.DE"][:random_state.randint(0, 3)]
+        news_asset_codes.append("{" + ", ".join("'{}'".format(code) for code in news_codes) + "}")
+    return np.array(asset_codes), np.array(companies), np.array(news_asset_codes)
+
+
+def generate_market_df(n_rows, asset_codes, asset_names, random_state, start="2007-02-01"):
+    n_assets = len(asset_codes)
+    n_days = int(np.ceil(n_rows / n_assets))
+    days = pd.bdate_range(start, periods=n_days, tz="UTC") + pd.Timedelta(hours=MARKET_CLOSE_HOUR)
+
+    log_returns = random_state.normal(0.0, 0.02, (n_days + 11, n_assets))
+    market_returns = log_returns.mean(axis=1, keepdims=True)
+    close = 20.0 * np.exp(random_state.normal(0, 1, n_assets)) * np.exp(np.cumsum(log_returns, axis=0))
+    open_ = close * np.exp(random_state.normal(0, 0.005, close.shape))
+
+    def returns(prices, lag):
+        result = np.full(prices.shape, np.nan)
+        result[lag:] = prices[lag:] / prices[:-lag] - 1
+        return result
+
+    close_raw1, open_raw1 = returns(close, 1), returns(open_, 1)
+    close_raw10, open_raw10 = returns(close, 10), returns(open_, 10)
+    market_raw1 = np.exp(market_returns) - 1
+    market_raw10 = np.exp(pd.DataFrame(market_returns).rolling(10).sum().values) - 1
+    open_next10 = np.full(open_.shape, np.nan)
+    open_next10[:-11] = open_[11:] / open_[1:-10] - 1 - market_raw10[11:]
+
+    # the first 10 days are only used for the look back
+    rows = slice(10, 10 + n_days)
+    columns = {
+        "close": close[rows], "open": open_[rows],
+        "returnsClosePrevRaw1": close_raw1[rows], "returnsOpenPrevRaw1": open_raw1[rows],
+        "returnsClosePrevMktres1": close_raw1[rows] - market_raw1[rows],
+        "returnsOpenPrevMktres1": open_raw1[rows] - market_raw1[rows],
+        "returnsClosePrevRaw10": close_raw10[rows], "returnsOpenPrevRaw10": open_raw10[rows],
+        "returnsClosePrevMktres10": close_raw10[rows] - market_raw10[rows],
+        "returnsOpenPrevMktres10": open_raw10[rows] - market_raw10[rows],
+        "returnsOpenNextMktres10": np.nan_to_num(open_next10[rows]),
+    }
+    df = pd.DataFrame({"time": np.repeat(days, n_assets),
+                       "assetCode": np.tile(asset_codes, n_days),
+                       "assetName": pd.Categorical(np.tile(asset_names, n_days))})
+    df["volume"] = np.round(np.exp(random_state.normal(13, 1.5, n_days * n_assets)))
+    for name, values in columns.items():
+        df[name] = values.reshape(-1)
+    # mktres are missing around listing days
+    for name in ["returnsClosePrevMktres1", "returnsOpenPrevMktres1",
+                 "returnsClosePrevMktres10", "returnsOpenPrevMktres10"]:
+        df.loc[random_state.rand(len(df)) < 0.01, name] = np.nan
+    asset_in_universe = random_state.rand(n_assets) < 0.7
+    df["universe"] = (np.tile(asset_in_universe, n_days) & (random_state.rand(len(df)) < 0.95)).astype("float64")
+    return df.iloc[:n_rows][MARKET_COLUMNS].reset_index(drop=True)
+
+
+def generate_news_df(n_rows, news_asset_codes, company_names, start_time, end_time, random_state,
+                     mean_takes=1.5):
+    n_companies = len(company_names)
+    # each story is split into takes with the same sourceId
+    n_takes = np.minimum(random_state.geometric(1.0 / mean_takes, n_rows), 8)
+    n_stories = max(int(np.searchsorted(np.cumsum(n_takes), n_rows)) + 1, 1)
+    n_takes = n_takes[:n_stories]
+    n_takes[-1] -= max(n_takes.sum() - n_rows, 0)
+
+    story_companies = random_state.choice(n_companies, n_stories, p=zipf_weights(n_companies, 0.8))
+    span = (end_time - start_time).value
+    story_created = np.sort(random_state.randint(0, span // 10 ** 9, n_stories)) * 10 ** 9 + start_time.value
+    source_ids = np.array(["{:016x}".format(value) for value in random_state.randint(0, 2 ** 62, n_stories,
+                                                                                      dtype=np.int64)])
+
+    story_index = np.repeat(np.arange(n_stories), n_takes)
+    take_sequence = np.arange(len(story_index)) - np.repeat(np.cumsum(n_takes) - n_takes, n_takes) + 1
+    take_delay = (take_sequence - 1) * random_state.randint(60, 1800, len(story_index)) * 10 ** 9
+    first_created = pd.to_datetime(story_created[story_index], utc=True)
+    time = pd.to_datetime(story_created[story_index] + take_delay, utc=True)
+
+    n_headlines = max(n_stories // 3, 1)
+    headline_pool = np.array([" ".join(words) for words in
+                              random_state.choice(HEADLINE_WORDS, (n_headlines, 6))])
+    subjects_pool = pd.unique(np.array(to_set_strings(random_state, ["SUB{}".format(i) for i in range(200)],
+                                            max(n_stories // 50, 100), 3, 15)))
+    audiences_pool = pd.unique(np.array(to_set_strings(random_state, ["AUD{}".format(i) for i in range(40)],
+                                                       300, 1, 5)))
+    headlines = headline_pool[random_state.choice(n_headlines, n_stories, p=zipf_weights(n_headlines, 0.6))]
+    subjects = random_state.choice(len(subjects_pool), n_stories, p=zipf_weights(len(subjects_pool), 0.8))
+    audiences = random_state.choice(len(audiences_pool), n_stories, p=zipf_weights(len(audiences_pool), 0.8))
+
+    n = len(story_index)
+    sentiment = random_state.dirichlet([1.0, 1.5, 1.0], n).astype("float32")
+    word_count = random_state.randint(20, 2000, n)
+    novelty = np.cumsum(random_state.poisson(0.5, (n, 5)), axis=1)
+    volume_counts = novelty + np.cumsum(random_state.poisson(2.0, (n, 5)), axis=1)
+    companies = story_companies[story_index]
+
+    df = pd.DataFrame({
+        "time": time,
+        "sourceTimestamp": time,
+        "firstCreated": first_created,
+        "sourceId": source_ids[story_index],
+        "headline": headlines[story_index],
+        "urgency": random_state.choice([1, 2, 3], n, p=[0.3, 0.01, 0.69]).astype("int8"),
+        "takeSequence": take_sequence.astype("int16"),
+        "provider": pd.Categorical.from_codes(random_state.choice(len(PROVIDERS), n, p=PROVIDER_WEIGHTS),
+                                              PROVIDERS),
+        "subjects": pd.Categorical.from_codes(subjects[story_index], subjects_pool),
+        "audiences": pd.Categorical.from_codes(audiences[story_index], audiences_pool),
+        "bodySize": (word_count * random_state.uniform(5, 7, n)).astype("int32"),
+        "companyCount": random_state.randint(1, 6, n).astype("int8"),
+        "headlineTag": random_state.choice(HEADLINE_TAGS, n, p=HEADLINE_TAG_WEIGHTS),
+        "marketCommentary": random_state.rand(n) < 0.05,
+        "sentenceCount": np.maximum(word_count // 20, 1).astype("int16"),
+        "wordCount": word_count.astype("int32"),
+        "assetCodes": pd.Categorical.from_codes(companies, news_asset_codes),
+        "assetName": pd.Categorical.from_codes(companies, company_names),
+        "firstMentionSentence": random_state.choice([0, 1, 2, 3, 4, 5, 10], n,
+                                                    p=[0.1, 0.55, 0.12, 0.08, 0.05, 0.05, 0.05]).astype("int16"),
+        "relevance": random_state.beta(2, 1, n).astype("float32"),
+        "sentimentClass": (np.argmax(sentiment, axis=1) - 1).astype("int8"),
+        "sentimentNegative": sentiment[:, 0],
+        "sentimentNeutral": sentiment[:, 1],
+        "sentimentPositive": sentiment[:, 2],
+        "sentimentWordCount": (word_count * random_state.uniform(0.3, 1.0, n)).astype("int32"),
+    })
+    for i, window in enumerate(["12H", "24H", "3D", "5D", "7D"]):
+        df["noveltyCount" + window] = novelty[:, i].astype("int16")
+        df["volumeCounts" + window] = volume_counts[:, i].astype("int16")
+    return df[NEWS_COLUMNS]
+
+
+def generate_train_dfs(n_market_rows=10000, news_per_market_row=2.3, seed=10, start="2007-02-01"):
+    """
+    generate market and news data frames which are reproducible with the same arguments.
+    :param n_market_rows: number of market rows (10k to 10M)
+    :param news_per_market_row: ratio of news rows to market rows (about 2.3 in the competition data)
+    :return: (market_df, news_df)
+    """
+    random_state = np.random.RandomState(seed)
+    n_assets = int(np.clip(np.sqrt(n_market_rows * 0.6), 10, 3500))
+    n_companies = max(int(n_assets / 1.2), 1)
+    asset_codes, asset_companies, news_asset_codes = create_assets(random_state, n_companies)
+    company_names = np.array(["Company {}".format(i) for i in range(n_companies)])
+
+    asset_codes, asset_companies = asset_codes[:n_assets], asset_companies[:n_assets]
+    market_df = generate_market_df(n_market_rows, asset_codes, company_names[asset_companies], random_state,
+                                   start=start)
+
+    start_time = market_df["time"].min() - pd.Timedelta(days=3)
+    end_time = market_df["time"].max()
+    news_df = generate_news_df(int(n_market_rows * news_per_market_row), news_asset_codes, company_names,
+                               start_time, end_time, random_state)
+    return market_df, news_df
@@ -0,0 +1,47 @@
+import logging
+import os
+import sys
+from unittest import TestCase, skipUnless
+
+from test.benchmark_pipeline import scaling_exponent, find_regressions, run_benchmark, load_baseline, \
+    save_baseline, log_results
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+
+class TestBenchmarkPipeline(TestCase):
+
+    def test_scaling_exponent(self):
+        sizes = [1000, 10000, 100000]
+        self.assertAlmostEqual(scaling_exponent(sizes, [size * 2e-6 for size in sizes]), 1.0)
+        self.assertAlmostEqual(scaling_exponent(sizes, [size ** 2 * 1e-9 for size in sizes]), 2.0)
+
+    def test_find_regressions(self):
+        baseline = {"sizes": [1000, 10000],
+                    "stages": {"link": {"wall": [1.0, 10.0], "peak_malloc": [1e6, 1e7],
+                                        "wall_exponent": 1.0, "memory_exponent": 1.0}}}
+        results = {"sizes": [1000, 10000],
+                   "stages": {"link": {"wall": [1.1, 100.0], "peak_malloc": [1e6, 1e7],
+                                       "wall_exponent": 2.0, "memory_exponent": 1.0},
+                              "train": {"wall": [1.0, 10.0], "peak_malloc": [1e6, 1e7],
+                                        "wall_exponent": 1.0, "memory_exponent": 1.0}}}
+
+        regressions = find_regressions(results, baseline)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("link with 10000 rows"))
+        self.assertTrue(regressions[1].startswith("link wall_exponent"))
+        self.assertListEqual(find_regressions(baseline, baseline), [])
+
+    @skipUnless(os.environ.get("RUN_BENCHMARK"), "the benchmark takes minutes; set RUN_BENCHMARK=1")
+    def test_benchmark(self):
+        results = run_benchmark()
+        log_results(results)
+        baseline = load_baseline()
+        if baseline is None:
+            save_baseline(results)
+            return
+        regressions = find_regressions(results, baseline)
+        self.assertListEqual(regressions, [], "\n".join(regressions))
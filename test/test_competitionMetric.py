@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from not_final_kernels.final_local_but_oom_kernel import CompetitionMetric, ModelWrapper, LgbWrapper, MARKET_ID, \
+    NEXT_MKTRES_10
+
+
+class TestCompetitionMetric(TestCase):
+    RANDOM_SEED = 10
+
+    def setUp(self):
+        random_state = np.random.RandomState(self.RANDOM_SEED)
+        n = 5000
+        self.times = pd.Series(pd.date_range("2010-01-01", periods=50, tz="UTC")).sample(
+            n, replace=True, random_state=self.RANDOM_SEED).reset_index(drop=True)
+        self.returns = random_state.normal(0, 0.05, n)
+        self.universe = random_state.randint(0, 2, n).astype("float64")
+        self.confidence = random_state.uniform(-1, 1, n)
+
+    def test_score(self):
+        sut = CompetitionMetric(self.times, self.returns, self.universe)
+
+        daily_sums = pd.Series(self.confidence * self.returns * self.universe).groupby(self.times).sum()
+        np.testing.assert_allclose(sut.daily_sums(self.confidence), daily_sums.values)
+        self.assertAlmostEqual(sut.score(self.confidence), daily_sums.mean() / daily_sums.std(ddof=0))
+        self.assertEqual(sut.score(np.zeros(len(self.times))), 0.0)
+
+    def test_hooks(self):
+        sut = CompetitionMetric(self.times, self.returns, self.universe)
+        probabilities = (self.confidence + 1) / 2
+
+        name, value, is_higher_better = sut.lgb_feval(probabilities, None)
+        self.assertEqual(name, CompetitionMetric.NAME)
+        self.assertAlmostEqual(value, sut.score(self.confidence))
+        self.assertTrue(is_higher_better)
+
+        logs = {}
+        sut.epoch_end_hook(lambda x: x.reshape((-1, 1)), probabilities)(0, logs)
+        self.assertAlmostEqual(logs["val_" + CompetitionMetric.NAME], value)
+
+        report = sut.report(self.confidence)
+        self.assertEqual(report["n_days"], 50)
+        self.assertAlmostEqual(report["score"], report["mean"] / report["std"])
+
+    def test_pop_metric(self):
+        df = pd.DataFrame({"time": self.times, NEXT_MKTRES_10: self.returns, "universe": self.universe,
+                           MARKET_ID: np.random.RandomState(self.RANDOM_SEED).permutation(len(self.times))})
+        # the linked rows are in the order of the market ids
+        valid_df = df.sort_values(by=MARKET_ID).iloc[4000:]
+        expected = CompetitionMetric(valid_df["time"], valid_df[NEXT_MKTRES_10], valid_df["universe"])
+
+        sut = ModelWrapper.pop_metric(df, train_size=0.8)
+
+        self.assertNotIn(NEXT_MKTRES_10, df.columns)
+        self.assertNotIn("universe", df.columns)
+        np.testing.assert_allclose(sut.daily_sums(self.confidence[4000:]), expected.daily_sums(self.confidence[4000:]))
+        self.assertIsNone(ModelWrapper.pop_metric(df, train_size=0.8))
+        model = LgbWrapper(dataset_dir=None)
+        model.valid_metric = sut
+        model.set_valid_metric(df, train_size=0.8)
+        self.assertIs(model.valid_metric, sut)
@@ -0,0 +1,52 @@
+import os
+from unittest import TestCase
+
+from not_final_kernels import final_local_but_oom_kernel
+from not_final_kernels.final_local_but_oom_kernel import ExecutionResources
+
+
+def worker_budget(_):
+    return os.environ["OMP_NUM_THREADS"], final_local_but_oom_kernel.RESOURCES.n_cores
+
+
+def worker_inputs(i):
+    return final_local_but_oom_kernel.LINK_SHARD_INPUTS[i]
+
+
+class TestExecutionResources(TestCase):
+
+    def test_detect_cores(self):
+        n_cores = ExecutionResources.detect_cores()
+
+        self.assertGreaterEqual(n_cores, 1)
+        self.assertLessEqual(n_cores, os.cpu_count())
+
+    def test_budget(self):
+        sut = ExecutionResources(n_cores=8)
+
+        self.assertEqual(sut.processes("link"), 8)
+        self.assertEqual(sut.processes("lag", 3), 3)
+        self.assertEqual(sut.processes("cv", 16), 8)
+        self.assertEqual(sut.threads("lgb"), 8)
+        self.assertEqual(sut.threads("search", 2), 2)
+        self.assertDictEqual(sut.layout["lag"], {"processes": 3, "threads": 2})
+        self.assertDictEqual(sut.layout["cv"], {"processes": 8, "threads": 1})
+
+    def test_process_pool(self):
+        sut = ExecutionResources(n_cores=4)
+
+        with sut.process_pool("stage", 2) as pool:
+            budgets = pool.map(worker_budget, range(2))
+
+        self.assertListEqual(budgets, [("2", 2), ("2", 2)])
+
+    def test_fork_pool(self):
+        sut = ExecutionResources(n_cores=2)
+        final_local_but_oom_kernel.LINK_SHARD_INPUTS = ["inherited", "inputs"]
+        try:
+            with sut.process_pool("stage", 2, fork=True) as pool:
+                inputs = pool.map(worker_inputs, range(2))
+        finally:
+            final_local_but_oom_kernel.LINK_SHARD_INPUTS = None
+
+        self.assertListEqual(inputs, ["inherited", "inputs"])
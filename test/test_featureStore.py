@@ -0,0 +1,75 @@
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from not_final_kernels.final_local_but_oom_kernel import FeatureStore, FeatureSetting
+
+
+class TestFeatureStore(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.df = pd.DataFrame({"a": np.arange(10), "b": np.arange(10) * 0.5})
+        self.calls = []
+        self.n_feature_bins = FeatureSetting.n_feature_bins
+        self.chunk_budget = FeatureSetting.link_chunk_memory_budget
+
+    def tearDown(self):
+        FeatureSetting.n_feature_bins = self.n_feature_bins
+        FeatureSetting.link_chunk_memory_budget = self.chunk_budget
+        self.tmp_dir.cleanup()
+
+    def stage(self, name, column):
+        def func(state):
+            self.calls.append(name)
+            state = dict(state)
+            state["df"] = state["df"].assign(**{column: state["df"]["a"] + len(state["df"].columns)})
+            return state
+
+        return name, {"column": column}, func
+
+    def run_stages(self, stages):
+        sut = FeatureStore(self.tmp_dir.name)
+        return sut.run(stages, {"df": self.df.copy()}, [self.df])
+
+    def test_run(self):
+        stages = [self.stage("first", "c"), self.stage("second", "d")]
+        expected = self.run_stages(stages)
+        self.assertListEqual(self.calls, ["first", "second"])
+
+        # the cached prefix is reloaded and only the new stage is computed
+        self.calls.clear()
+        actual = self.run_stages(stages + [self.stage("third", "e")])
+        self.assertListEqual(self.calls, ["third"])
+        pd.testing.assert_frame_equal(actual["df"].drop("e", axis=1), expected["df"])
+
+        self.calls.clear()
+        self.run_stages(stages)
+        self.assertListEqual(self.calls, [])
+
+        # a changed setting or input invalidates every stage
+        FeatureSetting.n_feature_bins += 1
+        self.run_stages(stages)
+        self.assertListEqual(self.calls, ["first", "second"])
+
+        self.calls.clear()
+        self.df.loc[0, "a"] = 100
+        self.run_stages(stages)
+        self.assertListEqual(self.calls, ["first", "second"])
+
+    def test_setting_fingerprint(self):
+        fingerprint = FeatureStore.setting_fingerprint()
+
+        FeatureSetting.link_chunk_memory_budget = 1e9
+        self.assertEqual(FeatureStore.setting_fingerprint(), fingerprint)
+        FeatureSetting.n_feature_bins += 1
+        self.assertNotEqual(FeatureStore.setting_fingerprint(), fingerprint)
+
+    def test_disabled(self):
+        stages = [self.stage("first", "c")]
+        for _ in range(2):
+            FeatureStore(self.tmp_dir.name, enabled=False).run(stages, {"df": self.df.copy()}, [self.df])
+
+        self.assertListEqual(self.calls, ["first", "first"])
@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from not_final_kernels.final_local_but_oom_kernel import hyperband_brackets, LgbSearch, LgbWrapper, RESOURCES
+
+
+class TestLgbSearch(TestCase):
+
+    def test_hyperband_brackets(self):
+        brackets = hyperband_brackets(1, 81, eta=3)
+
+        self.assertListEqual([n_trials for n_trials, _ in brackets], [81, 34, 15, 8, 5])
+        self.assertListEqual(brackets[0][1], [1, 3, 9, 27, 81])
+        self.assertListEqual(brackets[-1][1], [81])
+        self.assertListEqual(hyperband_brackets(20, 500, eta=3), [(9, [56, 167, 500]), (5, [167, 500]), (3, [500])])
+
+    def test_space(self):
+        sut = LgbSearch(LgbWrapper(dataset_dir=None), n_threads=8, n_concurrent=3, results_path=None)
+
+        params = sut.sample_params()
+        self.assertSetEqual(set(params), set(LgbSearch.SPACE))
+        self.assertEqual(sut.threads_per_trial, max(min(8, RESOURCES.n_cores) // 3, 1))
+        with self.assertRaises(ValueError):
+            LgbSearch(LgbWrapper(dataset_dir=None), space={"max_bin": [63, 255]})
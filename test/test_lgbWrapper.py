@@ -0,0 +1,76 @@
+import importlib.util
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase, skipUnless
+
+import numpy as np
+from scipy import sparse
+
+from not_final_kernels.final_local_but_oom_kernel import LgbWrapper, Features, lgb
+
+
+class TestLgbWrapper(TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(10)
+        self.x = random_state.normal(size=(1000, 4))
+        self.y = (self.x[:, 0] > 0).astype("int8")
+        self.n_constructed = 0
+
+    def construct(self):
+        self.n_constructed += 1
+        train_set = lgb.Dataset(self.x[:800], label=self.y[:800], params=LgbWrapper.DATASET_PARAMS).construct()
+        return train_set, train_set.create_valid(self.x[800:], label=self.y[800:]).construct()
+
+    @skipUnless(importlib.util.find_spec("lightgbm"), "lightgbm is not installed")
+    def test_load_or_construct_datasets(self):
+        with tempfile.TemporaryDirectory() as dataset_dir:
+            sut = LgbWrapper(dataset_dir=dataset_dir)
+
+            constructed = sut.load_or_construct_datasets("data", self.construct)
+            loaded = sut.load_or_construct_datasets("data", self.construct)
+            self.assertEqual(self.n_constructed, 1)
+            self.assertEqual(len(os.listdir(dataset_dir)), 2)
+            for expected, actual in zip(constructed, loaded):
+                actual.construct()
+                self.assertEqual(actual.num_data(), expected.num_data())
+                np.testing.assert_array_equal(actual.get_label(), expected.get_label())
+
+            sut.load_or_construct_datasets("other data", self.construct)
+            self.assertEqual(self.n_constructed, 2)
+            self.assertEqual(len(os.listdir(dataset_dir)), 4)
+
+    @skipUnless(importlib.util.find_spec("lightgbm"), "lightgbm is not installed")
+    def test_update(self):
+        sut = LgbWrapper(dataset_dir=None, params={"num_iterations": 5})
+        sut.x, sut.valid_X = self.construct()
+        sut.train()
+        y = (self.x[:, 0] + np.random.RandomState(10).normal(size=len(self.x)) > 0).astype("int8")
+
+        # the construction of the Dataset takes the whole budget
+        sut.update(self.x, y, time_budget=0.0)
+        self.assertEqual(sut.model.current_iteration(), 5)
+        sut.update(self.x, y, time_budget=60.0)
+        self.assertEqual(sut.model.current_iteration(), 5 + LgbWrapper.UPDATE_ROUNDS)
+
+    def test_without_cache(self):
+        sut = LgbWrapper(dataset_dir=None)
+        datasets = ("train", "valid")
+
+        self.assertIs(sut.load_or_construct_datasets("data", lambda: datasets), datasets)
+        self.assertIs(sut.load_or_construct_datasets("data", lambda: datasets), datasets)
+
+    def test_fingerprint(self):
+        features = Features.__new__(Features)
+        features.market_transformer = SimpleNamespace(feature_matrix=np.arange(20, dtype="uint8").reshape(10, 2))
+        features.news_transformer = SimpleNamespace(feature_matrix=sparse.csr_matrix(np.eye(5, dtype="float32")))
+        links = [[0, 1], [2], [np.nan]]
+
+        fingerprint = features.fingerprint([1, 3, 5], links)
+        self.assertEqual(features.fingerprint([1, 3, 5], [list(indices) for indices in links]), fingerprint)
+        self.assertNotEqual(features.fingerprint([1, 3, 6], links), fingerprint)
+        self.assertNotEqual(features.fingerprint([1, 3, 5], [[0], [1, 2], [np.nan]]), fingerprint)
+        self.assertNotEqual(features.fingerprint([1, 3, 5]), fingerprint)
+        features.news_transformer.feature_matrix = sparse.csr_matrix(np.eye(5, dtype="float32") * 2)
+        self.assertNotEqual(features.fingerprint([1, 3, 5], links), fingerprint)
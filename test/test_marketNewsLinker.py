@@ -0,0 +1,138 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from not_final_kernels.final_local_but_oom_kernel import MarketNewsLinker, FeatureSetting, estimate_join, MARKET_ID, \
+    NEWS_ID, RESOURCES
+from test.synthetic_data import generate_train_dfs
+
+
+class TestMarketNewsLinker(TestCase):
+    RANDOM_SEED = 10
+
+    def setUp(self):
+        random_state = np.random.RandomState(self.RANDOM_SEED)
+        self.left = pd.DataFrame({"key": random_state.randint(0, 50, 1000), "day": random_state.randint(0, 5, 1000),
+                                  "value": random_state.rand(1000)})
+        self.right = pd.DataFrame({"newsKey": random_state.randint(0, 60, 3000),
+                                   "newsDay": random_state.randint(0, 5, 3000),
+                                   "score": random_state.rand(3000)})
+        self.budget, self.over_budget = FeatureSetting.link_memory_budget, FeatureSetting.link_over_budget
+        self.chunk_budget = FeatureSetting.link_chunk_memory_budget
+
+    def tearDown(self):
+        FeatureSetting.link_memory_budget, FeatureSetting.link_over_budget = self.budget, self.over_budget
+        FeatureSetting.link_chunk_memory_budget = self.chunk_budget
+
+    def test_estimate_join(self):
+        for how in ["inner", "left"]:
+            fan_out, row_bytes = estimate_join(self.left, self.right, ["key", "day"], ["newsKey", "newsDay"], how)
+            merged_df = self.left.merge(self.right, left_on=["key", "day"], right_on=["newsKey", "newsDay"], how=how)
+
+            self.assertEqual(fan_out.sum(), len(merged_df))
+            self.assertEqual(len(fan_out), len(self.left))
+            self.assertGreater(row_bytes, 0)
+
+    def test_estimate_join_counts_objects(self):
+        _, row_bytes = estimate_join(self.left, self.right, ["key"], ["newsKey"])
+        right = self.right.assign(headline=["headline {}".format(i) for i in range(len(self.right))])
+
+        _, object_row_bytes = estimate_join(self.left, right, ["key"], ["newsKey"])
+
+        self.assertGreater(object_row_bytes - row_bytes, 40)
+
+    def test_merge_in_chunks(self):
+        sut = MarketNewsLinker(3)
+        row_filter = lambda df: df[df["value"] > df["score"]]
+        expected = sut.merge("merge", self.left, self.right, ["key", "day"], ["newsKey", "newsDay"], how="left",
+                             row_filter=row_filter, fan_out_groups={"day": "day"})
+
+        FeatureSetting.link_memory_budget = sut.join_traces[0]["projected_bytes"] / 4
+        actual = sut.merge("merge", self.left, self.right, ["key", "day"], ["newsKey", "newsDay"], how="left",
+                           row_filter=row_filter)
+
+        self.assertGreaterEqual(sut.join_traces[1]["n_chunks"], 4)
+        self.assertEqual(sut.join_traces[1]["rows"], len(expected))
+        pd.testing.assert_frame_equal(actual, expected.reset_index(drop=True))
+
+    def test_refuse_over_budget(self):
+        FeatureSetting.link_memory_budget = 1000
+        FeatureSetting.link_over_budget = "raise"
+        sut = MarketNewsLinker(3)
+
+        with self.assertRaises(MemoryError):
+            sut.merge("merge", self.left, self.right, ["key"], ["newsKey"])
+
+    def test_refuse_chunks_without_filter(self):
+        FeatureSetting.link_memory_budget = 1000
+        FeatureSetting.link_over_budget = "chunk"
+        sut = MarketNewsLinker(3)
+
+        with self.assertRaises(MemoryError):
+            sut.merge("merge", self.left, self.right, ["key"], ["newsKey"], how="left")
+
+    def test_split_date_ranges(self):
+        market_df, news_df = generate_train_dfs(5000, seed=self.RANDOM_SEED)
+        sut = MarketNewsLinker(3)
+
+        date_ranges = sut.split_date_ranges(market_df, news_df, 1e5)
+
+        self.assertGreater(len(date_ranges), 1)
+        self.assertEqual(date_ranges[0][0], market_df["time"].min().normalize())
+        self.assertEqual(date_ranges[-1][1], market_df["time"].max().normalize())
+        for (_, end), (start, _) in zip(date_ranges[:-1], date_ranges[1:]):
+            self.assertLess(end, start)
+        self.assertEqual(len(sut.split_date_ranges(market_df, news_df, 1e12)), 1)
+
+    def test_fill_linked_chunks(self):
+        assets = pd.Categorical(["a", "b", "c", "a"])
+        first = pd.DataFrame({"asset": assets[:2], "count": np.array([1, 2], dtype="int16")},
+                             index=pd.Index([4, 1], name=MARKET_ID))
+        second = pd.DataFrame({"asset": assets[2:], "count": [np.nan, 3.5]}, index=pd.Index([2, 7], name=MARKET_ID))
+
+        actual = MarketNewsLinker.fill_linked_chunks(np.array([1, 2, 4, 7]), iter([first, second]))
+
+        expected = pd.concat([first, second]).sort_index()
+        expected["asset"] = expected["asset"].astype(assets.dtype)
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_link_in_date_chunks(self):
+        market_df, news_df = generate_train_dfs(5000, seed=self.RANDOM_SEED)
+        market_df[MARKET_ID] = market_df.index.astype("int32")
+        news_df[NEWS_ID] = news_df.index.astype("int32")
+        news_df = news_df[["firstCreated", "assetCodes", NEWS_ID, "relevance", "urgency"]]
+        sut = MarketNewsLinker(3)
+        sut.link(market_df.copy(), news_df.copy(), pool=1)
+        expected = sut.create_new_market_df()
+        sut.clear()
+
+        pd.testing.assert_frame_equal(sut.link_in_date_chunks(market_df, news_df, 2e5), expected)
+        pd.testing.assert_frame_equal(sut.link_in_date_chunks(market_df, news_df, 2e5, pool=2), expected)
+
+        n_cores, RESOURCES.n_cores = RESOURCES.n_cores, 2
+        try:
+            sut.link(market_df.copy(), news_df.copy())
+            self.assertFalse(sut.is_aggregated)
+            sut.clear()
+            sut.link(market_df, news_df, pool=2)
+        finally:
+            RESOURCES.n_cores = n_cores
+        self.assertTrue(sut.is_aggregated)
+        pd.testing.assert_frame_equal(sut.create_new_market_df(), expected)
+
+    def test_link_with_chunk_budget(self):
+        market_df, news_df = generate_train_dfs(5000, seed=self.RANDOM_SEED)
+        market_df[MARKET_ID] = market_df.index.astype("int32")
+        news_df[NEWS_ID] = news_df.index.astype("int32")
+        news_df = news_df[["firstCreated", "assetCodes", NEWS_ID, "relevance", "urgency"]]
+        sut = MarketNewsLinker(3)
+        sut.link(market_df.copy(), news_df.copy())
+        expected = sut.create_new_market_df()
+        sut.clear()
+
+        FeatureSetting.link_chunk_memory_budget = 2e5
+        sut.link(market_df, news_df)
+
+        self.assertTrue(sut.is_aggregated)
+        pd.testing.assert_frame_equal(sut.create_new_market_df(), expected)
@@ -2,7 +2,9 @@ import logging
 import sys
 from unittest import TestCase
 
-from not_final_kernels.final_local_but_oom_kernel import measure_time
+import numpy as np
+
+from not_final_kernels.final_local_but_oom_kernel import measure_time, PROFILER
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -21,3 +23,28 @@ class TestMeasure_time(TestCase):
 
         total = repeat_add(1000000)
         logger.info("%d", total)
+
+    def test_nested_stages(self):
+        @measure_time
+        def create_matrix(n):
+            return np.ones((n, 3))
+
+        @measure_time
+        def run(matrix):
+            create_matrix(10)
+            with PROFILER.stage("inner"):
+                create_matrix(20)
+            return matrix
+
+        PROFILER.reset()
+        run(np.zeros((5, 2)))
+
+        self.assertEqual(run.__name__, "run")
+        stage = PROFILER.root["children"][0]
+        self.assertEqual(stage["name"], "TestMeasure_time.test_nested_stages.<locals>.run")
+        self.assertListEqual(stage["inputs"], [[5, 2]])
+        self.assertListEqual(stage["outputs"], [[5, 2]])
+        self.assertEqual(len(stage["children"]), 2)
+        self.assertEqual(stage["children"][1]["name"], "inner")
+        self.assertListEqual(stage["children"][1]["children"][0]["outputs"], [[20, 3]])
+        self.assertGreaterEqual(stage["wall"], stage["children"][1]["wall"])
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from not_final_kernels.final_local_but_oom_kernel import MemoryInspector, deep_sizeof
+
+
+class Holder(object):
+    pass
+
+
+class TestMemoryInspector(TestCase):
+
+    def test_deep_sizeof(self):
+        df = pd.DataFrame({"value": np.arange(100000, dtype="int64"), "name": ["abc"] * 100000})
+        matrix = sparse.random(1000, 100, density=0.1, format="csr", dtype="float32")
+
+        self.assertEqual(deep_sizeof(df), df.memory_usage(deep=True, index=True).sum())
+        self.assertGreaterEqual(deep_sizeof(matrix),
+                                matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes)
+
+    def test_inspect(self):
+        holder = Holder()
+        holder.matrix = np.zeros((1000, 100), dtype="float32")
+        holder.same_matrix = holder.matrix
+        holder.child = Holder()
+        holder.child.df = pd.DataFrame({"value": np.arange(1000)})
+
+        sizes = dict(MemoryInspector(depth=2, holder=holder).inspect())
+
+        self.assertGreaterEqual(sizes["holder.matrix"], holder.matrix.nbytes)
+        self.assertGreaterEqual(sizes["holder.child.df"], holder.child.df.memory_usage(deep=True).sum())
+        self.assertLess(sizes["holder"], 2 * holder.matrix.nbytes)
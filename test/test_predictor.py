@@ -0,0 +1,179 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from not_final_kernels.final_local_but_oom_kernel import Predictor, ModelWrapper, FeatureSetting, \
+    TARGET_HORIZON_DAYS, CompetitionMetric, MARKET_ID, NEXT_MKTRES_10, MarketPreprocess, NewsPreprocess, Features, \
+    MarketNewsLinker
+from test.synthetic_data import generate_train_dfs
+
+
+class RecordingModel(ModelWrapper):
+
+    def __init__(self):
+        super().__init__()
+        self.updates = []
+
+    def create_dataset(self, market_train, features, train_batch_size, valid_batch_size):
+        return None, None
+
+    def train(self, **kwargs):
+        return self
+
+    def predict(self, X):
+        return np.full(len(X), 0.5)
+
+    def update(self, x, y, time_budget):
+        self.updates.append((x.copy(), y.copy()))
+        return self
+
+
+class ReturnsModel(ModelWrapper):
+
+    def create_dataset(self, market_train, features, train_batch_size, valid_batch_size):
+        return None, None
+
+    def train(self, **kwargs):
+        return self
+
+    def predict(self, X):
+        return 1 / (1 + np.exp(-X[:, 0] * 10))
+
+
+class SumModel(ModelWrapper):
+    """
+    predicts from all the columns, so the news features change the predictions. the raw volume and prices are
+    not scaled, so the columns are bounded by sin.
+    """
+
+    def create_dataset(self, market_train, features, train_batch_size, valid_batch_size):
+        return None, None
+
+    def train(self, **kwargs):
+        return self
+
+    def predict(self, X):
+        return 1 / (1 + np.exp(-np.sin(np.asarray(X, dtype="float64")).mean(axis=1)))
+
+
+class ShufflingPreprocess(object):
+    """
+    appends the market ids like IdAppender and shuffles the rows, which backtest has to put back in order.
+    """
+
+    def transform(self, df):
+        df = df.copy()
+        df[MARKET_ID] = df.index.astype("int32")
+        return df.sample(frac=1.0, random_state=10)
+
+
+class ReturnsFeatures(object):
+
+    def transform(self, market_df, news_df):
+        return market_df, news_df
+
+    def get_linked_feature_matrix(self, market_df, dequantize=False):
+        return market_df[["returnsOpenPrevMktres10"]].values
+
+
+def fit_predictor(market_df, news_df, max_day_diff=3):
+    market_preprocess, news_preprocess, features = MarketPreprocess(), NewsPreprocess(), Features()
+    market_df = market_preprocess.fit_transform(market_df.drop([NEXT_MKTRES_10, "universe"], axis=1))
+    features.fit_transform(market_df, news_preprocess.fit_transform(news_df))
+    return Predictor(MarketNewsLinker(max_day_diff), SumModel(), features, market_preprocess, news_preprocess)
+
+
+class TestPredictor(TestCase):
+
+    def setUp(self):
+        self.settings = (FeatureSetting.update_every_days, FeatureSetting.update_buffer_rows,
+                         FeatureSetting.should_use_news_feature)
+        FeatureSetting.update_every_days, FeatureSetting.update_buffer_rows = 2, 5
+
+    def tearDown(self):
+        (FeatureSetting.update_every_days, FeatureSetting.update_buffer_rows,
+         FeatureSetting.should_use_news_feature) = self.settings
+
+    def test_backtest(self):
+        FeatureSetting.should_use_news_feature = False
+        market_df, news_df = generate_train_dfs(3000, seed=10)
+        days = np.sort(market_df["time"].unique())
+        start, end = days[20], days[40]
+        sut = Predictor(None, ReturnsModel(), ReturnsFeatures(), ShufflingPreprocess(), ShufflingPreprocess())
+
+        daily_predictions, score, daily_sums = sut.backtest(market_df, news_df, start, end)
+
+        expected_df = market_df[(market_df["time"] >= start) & (market_df["time"] <= end)]
+        confidence = 2 / (1 + np.exp(-expected_df["returnsOpenPrevMktres10"].values * 10)) - 1
+        self.assertListEqual([time for time, _ in daily_predictions], list(days[20:41]))
+        for time, predictions_df in daily_predictions:
+            day = (expected_df["time"] == time).values
+            self.assertListEqual(predictions_df.columns.tolist(), ["assetCode", "confidenceValue"])
+            np.testing.assert_array_equal(predictions_df["assetCode"].values, expected_df["assetCode"].values[day])
+            np.testing.assert_allclose(predictions_df["confidenceValue"].values, confidence[day])
+        metric = CompetitionMetric(expected_df["time"], expected_df[NEXT_MKTRES_10], expected_df["universe"])
+        self.assertAlmostEqual(score, metric.score(confidence))
+        np.testing.assert_allclose(daily_sums.values, metric.daily_sums(confidence))
+
+    def test_backtest_with_news(self):
+        FeatureSetting.should_use_news_feature, FeatureSetting.update_every_days = True, None
+        market_df, news_df = generate_train_dfs(2000, seed=10)
+        days = np.sort(market_df["time"].unique())
+        start, end = days[-5], days[-1]
+        sut = fit_predictor(market_df[market_df["time"] < start].reset_index(drop=True),
+                            news_df[news_df["firstCreated"] < start].reset_index(drop=True))
+
+        daily_predictions, score, daily_sums = sut.backtest(market_df, news_df, start, end)
+
+        expected_df = market_df[market_df["time"] >= start]
+        self.assertListEqual([time for time, _ in daily_predictions], list(days[-5:]))
+        for time, predictions_df in daily_predictions:
+            np.testing.assert_array_equal(predictions_df["assetCode"].values,
+                                          expected_df["assetCode"].values[(expected_df["time"] == time).values])
+        confidence = np.concatenate([predictions_df["confidenceValue"].values
+                                     for _, predictions_df in daily_predictions])
+        self.assertEqual(len(np.unique(confidence)), len(confidence))
+        metric = CompetitionMetric(expected_df["time"], expected_df[NEXT_MKTRES_10], expected_df["universe"])
+        self.assertAlmostEqual(score, metric.score(confidence))
+        np.testing.assert_allclose(daily_sums.values, metric.daily_sums(confidence))
+
+    def test_predict_day_with_news(self):
+        FeatureSetting.should_use_news_feature, FeatureSetting.update_every_days = True, None
+        market_df, news_df = generate_train_dfs(2000, seed=10)
+        days = np.sort(market_df["time"].unique())
+        train_end = days[-8]
+        sut = fit_predictor(market_df[market_df["time"] <= train_end].reset_index(drop=True),
+                            news_df[news_df["firstCreated"] <= train_end].reset_index(drop=True))
+
+        # the days before the compared ones fill the news window of the linker
+        predicted = {}
+        for previous_day, day in zip(days[-8:-1], days[-7:]):
+            market_obs_df = market_df[market_df["time"] == day].drop([NEXT_MKTRES_10, "universe"], axis=1)
+            news_obs_df = news_df[(news_df["firstCreated"] > previous_day) & (news_df["firstCreated"] <= day)]
+            predictions_df = pd.DataFrame({"assetCode": market_obs_df["assetCode"].values, "confidenceValue": 0.0})
+            sut.predict_day(market_obs_df.reset_index(drop=True), news_obs_df, predictions_df)
+            predicted[day] = predictions_df
+        daily_predictions, _, _ = sut.backtest(market_df, news_df, days[-3], days[-1])
+
+        self.assertListEqual([time for time, _ in daily_predictions], list(days[-3:]))
+        for time, predictions_df in daily_predictions:
+            np.testing.assert_array_equal(predictions_df["assetCode"].values, predicted[time]["assetCode"].values)
+            np.testing.assert_allclose(predictions_df["confidenceValue"].values,
+                                       predicted[time]["confidenceValue"].values, rtol=1e-5)
+
+    def test_learn_day(self):
+        model = RecordingModel()
+        sut = Predictor(None, model, None, None, None)
+        for day in range(TARGET_HORIZON_DAYS + 4):
+            returns_df = pd.DataFrame({"assetCode": ["A", "B", "C"],
+                                       "returnsOpenPrevMktres10": [day - 12.5, 12.5 - day, np.nan]})
+            sut.learn_day(returns_df, np.full((3, 1), day, dtype="float32"))
+
+        # the rows of day 0, 1 and 2 are labelled by the returns of day 11, 12 and 13, and the model is updated
+        # after day 11 and 13
+        self.assertEqual(len(model.updates), 2)
+        np.testing.assert_array_equal(model.updates[0][0].ravel(), [0, 0])
+        np.testing.assert_array_equal(model.updates[0][1], [False, True])
+        np.testing.assert_array_equal(model.updates[1][0].ravel(), [0, 1, 1, 2, 2])
+        np.testing.assert_array_equal(model.updates[1][1], [True, False, True, True, False])
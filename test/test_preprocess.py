@@ -6,7 +6,9 @@ import numpy as np
 import pandas as pd
 
 from not_final_kernels.final_local_but_oom_kernel import NewsPreprocess, load_train_dfs, MarketPreprocess, \
-    TahnEstimators
+    TahnEstimators, LatestTakeTransformer, RowPruningTransformer, LagAggregationTransformer, CalendarTransformer, \
+    MARKET_ID
+from test.synthetic_data import generate_train_dfs
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -37,3 +39,91 @@ class TestTahnEstimators(TestCase):
         sut = TahnEstimators()
         result = sut.fit_transform(seq)
         logger.info(result)
+
+
+class TestCalendarTransformer(TestCase):
+
+    def test_transform(self):
+        days = pd.Series(pd.date_range("2010-01-25", periods=40, tz="UTC"))
+        times = days.sample(500, replace=True, random_state=10).reset_index(drop=True)
+        sut = CalendarTransformer()
+        result = sut.transform(times)
+
+        # the per row values of WeekDayTransformer, MonthTransformer and DayTransformer
+        expected = np.stack([np.cos(times.dt.dayofweek.values / 7).astype("float32"),
+                             np.cos(times.dt.month.values / 12).astype("float32"),
+                             np.cos(times.dt.day.values / 31).astype("float32")], axis=1)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_array_equal(result, expected)
+
+
+class TestLatestTakeTransformer(TestCase):
+
+    def test_transform(self):
+        df = pd.DataFrame({"sourceId": ["b", "a", "b", "c", "a", "b"],
+                           "takeSequence": [1, 1, 2, 1, 2, 3],
+                           "value": np.arange(6)})
+        sut = LatestTakeTransformer(keep_take_count=True)
+        result = sut.transform(df)
+
+        self.assertListEqual(result["sourceId"].tolist(), ["c", "a", "b"])
+        self.assertListEqual(result["takeSequence"].tolist(), [1, 2, 3])
+        self.assertListEqual(result[LatestTakeTransformer.TAKE_COUNT].tolist(), [1, 2, 3])
+        self.assertListEqual(result.index.tolist(), [0, 1, 2])
+
+
+class TestRowPruningTransformer(TestCase):
+
+    def test_transform(self):
+        times = pd.date_range("2010-01-01", periods=6, tz="UTC")
+        df = pd.DataFrame({"time": np.repeat(times, 2),
+                           "assetCode": ["A", "B"] * 6,
+                           "universe": [0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1.0]})
+        sut = RowPruningTransformer(n_context_rows=2, drop_date_ranges=[("2010-01-06", "2010-01-06")])
+        result = sut.transform(df)
+
+        self.assertListEqual(result["assetCode"].tolist(), ["B", "A", "A", "A"])
+        self.assertListEqual(result[RowPruningTransformer.LAG_CONTEXT].tolist(), [False, True, True, False])
+
+        result[MARKET_ID] = -1
+        result = sut.drop_lag_context(result)
+        self.assertListEqual(result["assetCode"].tolist(), ["B", "A"])
+        self.assertListEqual(result[MARKET_ID].tolist(), [0, 1])
+        self.assertNotIn(RowPruningTransformer.LAG_CONTEXT, result.columns)
+
+
+class TestLagAggregationTransformer(TestCase):
+
+    def test_transform_next(self):
+        market_df, _ = generate_train_dfs(3000, news_per_market_row=0.1, seed=3)
+        market_df[MARKET_ID] = market_df.index.astype("int32")
+        days = market_df["time"].unique()
+        sut = LagAggregationTransformer(lags=[3, 5, 10], shift_size=1, n_pool=2)
+        sut.fit_transform(market_df[market_df["time"] < days[-2]].copy())
+
+        sut.transform_next(market_df[market_df["time"] == days[-2]].reset_index(drop=True))
+        actual = sut.transform_next(market_df[market_df["time"] == days[-1]].reset_index(drop=True))
+
+        expected = LagAggregationTransformer(lags=[3, 5, 10], shift_size=1, n_pool=2).transform(market_df.copy())
+        expected = expected[expected["time"] == days[-1]].sort_values(by=MARKET_ID).reset_index(drop=True)
+        columns = sut.lag_column_names()
+        pd.testing.assert_frame_equal(actual[columns], expected[columns])
+
+    def test_predict_after_pruning(self):
+        market_df, _ = generate_train_dfs(3000, news_per_market_row=0.1, seed=3)
+        days = market_df["time"].unique()
+        sut = MarketPreprocess()
+        train_df = sut.fit_transform(market_df[market_df["time"] < days[-2]].copy())
+        self.assertLess(len(train_df), (market_df["time"] < days[-2]).sum())
+        # transform runs on the rows of a backtest, which must not replace the history
+        sut.transform(market_df[market_df["time"] < days[5]].copy())
+
+        sut.transform_next(market_df[market_df["time"] == days[-2]].reset_index(drop=True))
+        actual = sut.transform_next(market_df[market_df["time"] == days[-1]].reset_index(drop=True))
+
+        expected_df = market_df.copy()
+        expected_df[MARKET_ID] = expected_df.index.astype("int32")
+        expected = LagAggregationTransformer(lags=[3, 5, 10], shift_size=1, n_pool=2).transform(expected_df)
+        expected = expected[expected["time"] == days[-1]].sort_values(by=MARKET_ID).reset_index(drop=True)
+        columns = sut.lag_transformer.lag_column_names()
+        pd.testing.assert_frame_equal(actual[columns], expected[columns])
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+import numpy as np
+
+from not_final_kernels.final_local_but_oom_kernel import QuantileBinner
+
+
+class TestQuantileBinner(TestCase):
+    RANDOM_SEED = 10
+
+    def test_fit_transform(self):
+        random_state = np.random.RandomState(self.RANDOM_SEED)
+        X = np.c_[random_state.randn(10000), random_state.randint(0, 3, 10000)].astype("float32")
+        X[:10, 0] = np.nan
+
+        sut = QuantileBinner(n_bins=50, sample_size=5000)
+        codes = sut.fit(X).transform(X)
+
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertTrue((codes[:10, 0] == QuantileBinner.NAN_CODE).all())
+        self.assertLess(codes[10:, 0].max(), 50)
+        self.assertEqual(len(np.unique(codes[:, 1])), 3)
+
+    def test_dequantize(self):
+        random_state = np.random.RandomState(self.RANDOM_SEED)
+        X = np.c_[random_state.rand(10000), random_state.randint(0, 3, 10000)].astype("float32")
+
+        sut = QuantileBinner(n_bins=100)
+        dequantized = sut.dequantize(sut.fit(X).transform(X))
+
+        self.assertEqual(dequantized.dtype, np.float32)
+        self.assertLess(np.abs(dequantized[:, 0] - X[:, 0]).max(), 0.05)
+        np.testing.assert_array_equal(dequantized[:, 1], X[:, 1])
+
+    def test_codes_with_nan(self):
+        X = np.array([[0.0, 1.0], [np.nan, 2.0], [3.0, np.nan]], dtype="float32")
+
+        sut = QuantileBinner(n_bins=10)
+        codes = sut.fit(X).transform(X)
+        actual = sut.codes_with_nan(codes)
+
+        self.assertEqual(actual.dtype, np.float32)
+        np.testing.assert_array_equal(np.isnan(actual), np.isnan(X))
+        np.testing.assert_array_equal(actual[~np.isnan(X)], codes[~np.isnan(X)])
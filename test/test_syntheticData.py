@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from test.synthetic_data import generate_train_dfs, MARKET_COLUMNS, NEWS_COLUMNS
+
+
+class TestSyntheticData(TestCase):
+
+    def test_schema(self):
+        market_df, news_df = generate_train_dfs(10000, news_per_market_row=2.0)
+
+        self.assertEqual(market_df.shape, (10000, len(MARKET_COLUMNS)))
+        self.assertEqual(news_df.shape, (20000, len(NEWS_COLUMNS)))
+        self.assertEqual(str(market_df["time"].dt.tz), "UTC")
+        self.assertTrue(market_df["time"].is_monotonic_increasing)
+        self.assertTrue(news_df["firstCreated"].is_monotonic_increasing)
+        self.assertTrue(news_df["assetCodes"].astype(str).str.match(r"^\{'[^']+'(, '[^']+')*\}$").all())
+        self.assertTrue(news_df["subjects"].astype(str).str.startswith("{'").all())
+
+        market_codes = set(market_df["assetCode"])
+        news_codes = set(news_df["assetCodes"].astype(str).str.findall(r"'([^']+)'").explode())
+        self.assertTrue(market_codes & news_codes)
+        self.assertTrue(news_codes - market_codes)
+
+    def test_take_sequence(self):
+        _, news_df = generate_train_dfs(10000)
+
+        takes = news_df.groupby("sourceId")["takeSequence"].agg(["min", "max", "count"])
+        self.assertTrue((takes["min"] == 1).all())
+        self.assertTrue((takes["max"] == takes["count"]).all())
+        self.assertGreater(takes["count"].max(), 1)
+
+    def test_reproducible(self):
+        market_df1, news_df1 = generate_train_dfs(10000, seed=1)
+        market_df2, news_df2 = generate_train_dfs(10000, seed=1)
+        _, news_df3 = generate_train_dfs(10000, seed=2)
+
+        pd.testing.assert_frame_equal(market_df1, market_df2)
+        pd.testing.assert_frame_equal(news_df1, news_df2)
+        self.assertFalse(np.array_equal(news_df1["relevance"].values, news_df3["relevance"].values))
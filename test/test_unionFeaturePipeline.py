@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+import pandas as pd
+
+from not_final_kernels.final_local_but_oom_kernel import UnionFeaturePipeline, IdAppender, ConfidenceAppender, \
+    DropColumnsTransformer, DateFilterTransformer, DfTransformer, NEXT_MKTRES_10
+
+
+class EncodingTransformer(DfTransformer):
+    input_columns = ["volume", "time"]
+    release_columns = ["volume"]
+
+    def __init__(self):
+        self.columns = None
+
+    def transform(self, df):
+        self.columns = df.columns.tolist()
+        return df
+
+    def release_raw_field(self, df):
+        pass
+
+
+class TestUnionFeaturePipeline(TestCase):
+
+    def create_df(self):
+        return pd.DataFrame({"time": pd.to_datetime(["2009-12-31", "2010-01-01", "2010-01-02"]),
+                             NEXT_MKTRES_10: [0.1, -0.2, 0.3],
+                             "volume": [1., 2., 3.]})
+
+    def create_sut(self):
+        return UnionFeaturePipeline(DateFilterTransformer(pd.Timestamp("2010-01-01").date(), "time"),
+                                    IdAppender("id"),
+                                    ConfidenceAppender(),
+                                    DropColumnsTransformer([NEXT_MKTRES_10]),
+                                    n_jobs=2)
+
+    def test_plan(self):
+        sut = self.create_sut()
+        waves = sut.plan()
+
+        self.assertListEqual(waves, [[0], [1, 2, 3]])
+        self.assertDictEqual(sut.release_waves(waves), {NEXT_MKTRES_10: 1})
+
+    def test_transform(self):
+        sut = self.create_sut()
+        df, features = sut.transform(self.create_df(), include_sparse=False)
+
+        self.assertIsNone(features)
+        self.assertListEqual(sorted(df.columns.tolist()), ["confidence", "id", "time", "volume"])
+        self.assertListEqual(df["confidence"].tolist(), [False, True])
+
+    def test_release_after_encoding(self):
+        encoder = EncodingTransformer()
+        sut = UnionFeaturePipeline(encoder, ConfidenceAppender())
+        df, _ = sut.transform(self.create_df(), include_sparse=False)
+
+        self.assertListEqual(encoder.columns, ["volume", "time"])
+        self.assertListEqual(sorted(df.columns.tolist()), ["confidence", NEXT_MKTRES_10, "time"])
@@ -0,0 +1,86 @@
+import importlib.util
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from not_final_kernels.final_local_but_oom_kernel import walk_forward_folds, WalkForwardCV, ModelWrapper, \
+    LgbWrapper, MARKET_ID, NEXT_MKTRES_10
+
+
+class LinearModel(ModelWrapper):
+    accepts_binned_features = True
+
+    def create_dataset(self, df, features, train_batch_size, valid_batch_size):
+        self.y, _ = ModelWrapper.to_x_y(df)
+        self.x = features
+        return None, None
+
+    def train(self, **kwargs):
+        x = self.x.toarray() if sparse.issparse(self.x) else self.x
+        self.model = np.linalg.lstsq(x, self.y - 0.5, rcond=None)[0]
+        return self
+
+    def predict(self, X):
+        return 1 / (1 + np.exp(-(X @ self.model)))
+
+
+class TestWalkForwardCV(TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(10)
+        days = pd.bdate_range("2012-01-02", periods=120, tz="UTC")
+        self.times = pd.Series(np.repeat(days, 20)).sample(frac=1.0, random_state=10).reset_index(drop=True)
+        self.feature_matrix = random_state.normal(size=(len(self.times), 3)).astype("float32")
+        returns = self.feature_matrix[:, 0] * 0.01 + random_state.normal(0, 0.01, len(self.times))
+        self.df = pd.DataFrame({"time": self.times, MARKET_ID: np.arange(len(self.times)),
+                                "confidence": returns > 0, NEXT_MKTRES_10: returns, "universe": 1.0})
+
+    def test_walk_forward_folds(self):
+        days = np.sort(self.times.values)[::20]
+
+        folds = walk_forward_folds(self.times, n_folds=3, valid_days=20, embargo_days=10)
+
+        self.assertEqual(len(folds), 3)
+        for i, (train, valid) in enumerate(folds):
+            valid_days = np.unique(self.times.values[valid])
+            np.testing.assert_array_equal(valid_days, days[60 + i * 20:80 + i * 20])
+            train_times = self.times.values[train]
+            self.assertEqual(train_times.min(), days[0])
+            self.assertEqual(train_times.max(), days[49 + i * 20])
+            self.assertTrue((np.diff(train_times.astype("int64")) >= 0).all())
+
+        train, _ = walk_forward_folds(self.times, n_folds=3, valid_days=20, train_days=30, embargo_days=10)[2]
+        np.testing.assert_array_equal(np.unique(self.times.values[train]), days[60:90])
+        with self.assertRaises(ValueError):
+            walk_forward_folds(self.times, n_folds=6, valid_days=20)
+
+    def test_run(self):
+        sequential = WalkForwardCV(LinearModel, n_folds=3, valid_days=20, pool=1).run(self.df, self.feature_matrix)
+        parallel = WalkForwardCV(LinearModel, n_folds=3, valid_days=20, pool=3).run(self.df, self.feature_matrix)
+
+        self.assertListEqual(sequential["fold"].tolist(), [0, 1, 2])
+        self.assertTrue((sequential["score"] > 0).all())
+        self.assertTrue((sequential["wall"] > 0).all())
+        np.testing.assert_allclose(sequential["score"].values, parallel["score"].values)
+        self.assertListEqual(sequential["n_valid"].tolist(), [400, 400, 400])
+
+    def test_run_sparse(self):
+        feature_matrix = sparse.csr_matrix(np.where(np.abs(self.feature_matrix) > 1, self.feature_matrix, 0))
+        expected = WalkForwardCV(LinearModel, n_folds=3, valid_days=20, pool=1).run(self.df, feature_matrix.toarray())
+
+        actual = WalkForwardCV(LinearModel, n_folds=3, valid_days=20, pool=3).run(self.df, feature_matrix)
+
+        np.testing.assert_allclose(actual["score"].values, expected["score"].values, rtol=1e-5)
+
+    @skipUnless(importlib.util.find_spec("lightgbm"), "lightgbm is not installed")
+    def test_run_without_dataset_cache(self):
+        with tempfile.TemporaryDirectory() as dataset_dir:
+            results = WalkForwardCV(lambda: LgbWrapper(dataset_dir=dataset_dir), n_folds=2, valid_days=20,
+                                    pool=2).run(self.df, self.feature_matrix)
+
+            self.assertListEqual(results["fold"].tolist(), [0, 1])
+            self.assertListEqual(os.listdir(dataset_dir), [])